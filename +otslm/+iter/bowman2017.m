@@ -20,6 +20,27 @@ function pattern = bowman2017(target, varargin)
 %   - 'steepness'   -- Steepness for Bowman cost function (default: 9.0)
 %   - 'incident'    -- Incident illumination (default: ones)
 %   - 'roisize'     -- Optimisation region size (default: min(size)/2)
+%   - 'engine'      -- Cost/gradient engine, 'theano' or 'numpy'.
+%     The numpy engine avoids graph compilation (default: 'theano')
+%   - 'precision'   -- Precision of the optimisation, 'double' or
+%     'single'.  Single precision is faster (default: 'double')
+%   - 'levels'      -- Number of resolution levels.  With levels > 1
+%     the problem is first solved at 1/2^(levels-1) of the resolution
+%     and each solution is upsampled as the next guess (default: 1)
+%   - 'gs_iterations' -- Number of Gerchberg-Saxton iterations run from
+%     the guess to find the starting phase (default: 0)
+%   - 'gain_tolerance' -- Stop early once the fidelity gain is less
+%     than this per iteration over 10 iterations, [] to always run
+%     all iterations (default: [])
+%   - 'worker'      -- Address of a persistent python worker started
+%     with ``python wrapper.py --worker address``, e.g. 'localhost:6017'.
+%     Avoids starting python for every pattern.  The worker and the
+%     submitting process share the key in OTSLM_WORKER_AUTHKEY or the
+%     key file written by the worker (see worker.py) (default: '')
+%
+% The problem is passed to python in a binary job directory, which
+% needs MATLAB R2016b or later (jsonencode).  Earlier versions use a
+% .mat file, which needs the MATLAB Engine API for Python.
 
 % Copyright 2018 Isaac Lenton
 % This file is part of OTSLM, see LICENSE.md for information about
@@ -33,6 +54,12 @@ p.addParameter('iterations', 200);
 p.addParameter('steepness', 9.0);
 p.addParameter('incident', ones(size(target)));
 p.addParameter('roisize', min(size(target))/2);
+p.addParameter('engine', 'theano');
+p.addParameter('precision', 'double');
+p.addParameter('levels', 1);
+p.addParameter('gs_iterations', 0);
+p.addParameter('gain_tolerance', []);
+p.addParameter('worker', '');
 p.parse(varargin{:});
 
 % Get the directory for the python library
@@ -60,14 +87,27 @@ end
 % end
 
 % Create a structure to store the relevent data
-% At the same time, flip the data for python
 data = struct();
-data.target = target.';
-data.incident = p.Results.incident.';
+data.target = target;
+data.incident = p.Results.incident;
 data.roisize = p.Results.roisize;
 data.steepness = p.Results.steepness;
-data.guess = guess.';
+data.guess = guess;
 data.iterations = p.Results.iterations;
+data.engine = p.Results.engine;
+data.levels = p.Results.levels;
+data.gs_iter = p.Results.gs_iterations;
+if ~isempty(p.Results.gain_tolerance)
+  data.gain_tol = p.Results.gain_tolerance;
+end
+switch p.Results.precision
+  case 'double'
+    data.dtype = 'float64';
+  case 'single'
+    data.dtype = 'float32';
+  otherwise
+    error('Unknown precision, must be ''single'' or ''double''');
+end
 
 %% Method 1: Call the python wrapper for the method
 %
@@ -100,27 +140,135 @@ data.iterations = p.Results.iterations;
 % evalin('base', ['clear ', dataname]);
 
 %% Method 3: write the data to a mat file and read it in python
+% Replaced by method 4, reading the mat file requires a MATLAB engine
+% in python and converting every array to/from python lists
+%
+% % Flip the data for python
+% data.target = data.target.';
+% data.incident = data.incident.';
+% data.guess = data.guess.';
+%
+% % Save the data to a file
+% dataname = [tempname, '.mat'];
+% save(dataname, '-struct', 'data');
+%
+% % Call python with our data file
+% wrapper = fullfile(pypath, 'wrapper.py');
+% system(['python ', wrapper, ' ', dataname]);
+%
+% % Get the data from the file
+% try
+%   datapattern = load(dataname, 'pattern');
+%   pattern = datapattern.pattern;
+% catch
+%   pattern = [];
+% end
+%
+% % Clean up the data file
+% delete(dataname);
 
-% Save the data to a file
-dataname = [tempname, '.mat'];
-save(dataname, '-struct', 'data');
+%% Method 4: write raw binary arrays with a json header
+% Python memory-maps the arrays (see wrapper.run_job)
+% jsonencode needs MATLAB R2016b, earlier versions use the mat file of
+% method 3 (see runMatFile)
 
-% Call python with our data file
-wrapper = fullfile(pypath, 'wrapper.py');
-system(['python ', wrapper, ' ', dataname]);
+if verLessThan('matlab', '9.1')
+  pattern = runMatFile(pypath, data, p.Results.worker);
+else
 
-% Get the data from the file
-try
-  datapattern = load(dataname, 'pattern');
-  pattern = datapattern.pattern;
-catch
-  pattern = [];
-end
+  % Write the job to a temporary directory
+  dataname = tempname;
+  mkdir(dataname);
+
+  header = rmfield(data, {'target', 'incident', 'guess'});
+  header.sz = size(target);
+  header.arrays = struct();
+  header.arrays.target = writeJobArray(dataname, 'target', data.target);
+  header.arrays.incident = writeJobArray(dataname, 'incident', data.incident);
+  header.arrays.guess = writeJobArray(dataname, 'guess', data.guess);
+  header.result = struct('file', 'pattern.bin', 'dtype', '<f8');
 
-% Clean up the data file
-delete(dataname);
+  fid = fopen(fullfile(dataname, 'job.json'), 'w');
+  fwrite(fid, jsonencode(header));
+  fclose(fid);
+
+  % Call python with our job directory
+  if isempty(p.Results.worker)
+    wrapper = fullfile(pypath, 'wrapper.py');
+    system(['python ', wrapper, ' ', dataname]);
+  else
+    worker = fullfile(pypath, 'worker.py');
+    system(['python ', worker, ' --submit ', p.Results.worker, ' ', dataname]);
+  end
+
+  % Get the pattern from the result file
+  fid = fopen(fullfile(dataname, header.result.file), 'r');
+  if fid == -1
+    pattern = [];
+  else
+    pattern = fread(fid, size(target), 'double');
+    fclose(fid);
+  end
+
+  % Clean up the job directory
+  rmdir(dataname, 's');
+end
 
 if isempty(pattern)
   error('There was an error in they python script, see terminal for info');
 end
 
+end
+
+function pattern = runMatFile(pypath, data, address)
+% Run the method through a mat file (method 3), for MATLAB before R2016b
+% Python reads the file with the MATLAB engine (see wrapper.run_matfile)
+
+  % Flip the data for python
+  data.target = data.target.';
+  data.incident = data.incident.';
+  data.guess = data.guess.';
+
+  % Save the data to a file
+  dataname = [tempname, '.mat'];
+  save(dataname, '-struct', 'data');
+
+  % Call python with our data file
+  if isempty(address)
+    wrapper = fullfile(pypath, 'wrapper.py');
+    system(['python ', wrapper, ' ', dataname]);
+  else
+    worker = fullfile(pypath, 'worker.py');
+    system(['python ', worker, ' --submit ', address, ' ', dataname]);
+  end
+
+  % Get the data from the file
+  try
+    datapattern = load(dataname, 'pattern');
+    pattern = datapattern.pattern;
+  catch
+    pattern = [];
+  end
+
+  % Clean up the data file
+  delete(dataname);
+end
+
+function spec = writeJobArray(dataname, name, value)
+% Write an array as raw column-major data, complex values interleaved
+
+  spec = struct('file', [name, '.bin'], 'dtype', '<f8', ...
+      'shape', size(value));
+
+  value = double(value);
+  if isreal(value)
+    raw = value(:);
+  else
+    spec.dtype = '<c16';
+    raw = [real(value(:)).'; imag(value(:)).'];
+  end
+
+  fid = fopen(fullfile(dataname, spec.file), 'w');
+  fwrite(fid, raw, 'double');
+  fclose(fid);
+end
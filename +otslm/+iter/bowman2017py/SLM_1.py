@@ -3,6 +3,10 @@ Also contains definitions of various targets, weighting arrays, plot properties,
 
 Called by Laguerre_Gaussian1.py to calculate fields, targets etc. 
 
+Theano, matplotlib and the FFT backend are only imported when they are
+first used, so the targets and error metrics load quickly.  The SLM class
+and Fourier ops are in SLM_theano.py.
+
 
 Please cite Optics Express 25, 11692 (2017) - https://doi.org/10.1364/OE.25.011692 
 14/05/2017
@@ -10,179 +14,229 @@ Please cite Optics Express 25, 11692 (2017) - https://doi.org/10.1364/OE.25.0116
 
 #________________________________________________________________________________________________________________________________
 import numpy as np                          # Used for array manipulation
-#import matplotlib.pyplot as plt             # Plotting  
-import theano                               # Symbolic representation of phase; gradient calculation
-import theano.tensor as T                   # Using tensor in symbolic calculation (differentiation)
-from theano.gradient import DisconnectedType
-#import matplotlib.image as mpimg            # Reading images
-#from mpl_toolkits.mplot3d import Axes3D     # 3D plotting
-import os, shutil                           # Folder/file manipulation
-from fft2 import *                          # 2-D Fourier transform wrapper
+#import matplotlib.pyplot as plt             # Plotting, imported by n_plot
+#import theano                               # Imported by SLM_theano, see SLM
+#import matplotlib.image as mpimg            # Reading images, imported by target_image/phase_image
+#from mpl_toolkits.mplot3d import Axes3D     # 3D plotting, imported by n_plot
+import os                                   # Folder/file manipulation
+from collections import OrderedDict         # Caches of grids and patterns
+from fft2 import *                          # 2-D Fourier transform wrapper (backend selected on first use)
+import metrics                              # Error metrics without Theano
 
 
 ########################################################################
 ######################     beginning SLM class    ######################
-class SLM(object):
-    
-    def __init__(self, NT, initial_phi=None, profile_s=None):
-
-        self.n_pixels = int(NT/2) # target should be 512x512, but SLM pattern calculated should be 256x256.
-        self.intensity_calc = None
-        
-        self.cost = None # placeholder for cost function.
-        
-        if profile_s is None:
-            profile_s = np.ones((self.n_pixels, self.n_pixels)) # input amplitude set to flat ones if none given
-        if initial_phi is None:
-            initial_phi = np.random.uniform(low=0, high=2*np.pi, size=(self.n_pixels**2)) # input phase set to random if none given
-        
-        assert profile_s.shape == (self.n_pixels, self.n_pixels), 'profile_s is wrong shape, should be ({n},{n})'.format(n=self.n_pixels)
-        self.profile_s_r = profile_s.real.astype('float64')
-        self.profile_s_i = profile_s.imag.astype('float64')
-        
-        assert initial_phi.shape == (self.n_pixels**2,), "initial_phi must be a vector of phases of size N^2 (not (N,N)).  Shape is " + str(initial_phi.shape)
+def SLM(NT, initial_phi=None, profile_s=None, pruned=False, batch=None, dtype='float64'):
+    """
+    Create an SLM_theano.SLM, the symbolic SLM fields (imports Theano)
+    """
+    from SLM_theano import SLM
+    return SLM(NT, initial_phi=initial_phi, profile_s=profile_s,
+            pruned=pruned, batch=batch, dtype=dtype)
 
-        # Linked to the fourier transform. Keeps the same quantity of light between the input and the output
-        self.A0 = 1./NT
-        
-        # Set zeros matrix:
-        self.zero_frame = np.zeros((2*self.n_pixels, 2*self.n_pixels), dtype='float64')
-        self.zero_matrix = theano.shared(value=self.zero_frame,name='zero_matrix')
-        
-        # Phi and its momentum for use in gradient descent with momentum:
-        self.phi = theano.shared(value=initial_phi.astype('float64'),name='phi')
-        self.phi_rate = theano.shared(value=np.zeros_like(initial_phi).astype('float64'),name='phi_rate')
-        self.phi_reshaped = self.phi.reshape((self.n_pixels, self.n_pixels))
-        
-        # E_in (n_pixels**2): Need to split real and imaginary parts as differentiating complex numbers is difficult
-        self.S_r = theano.shared(value=self.profile_s_r,name='s_r')
-        self.S_i = theano.shared(value=self.profile_s_i,name='s_i')
-        self.E_in_r = self.A0 * (self.S_r*T.cos(self.phi_reshaped) - self.S_i*T.sin(self.phi_reshaped))
-        self.E_in_i = self.A0 * (self.S_i*T.cos(self.phi_reshaped) + self.S_r*T.sin(self.phi_reshaped))
-        
-        # E_in padded (4n_pixels**2):
-        idx_0, idx_1 = get_centre_range(self.n_pixels)
-        self.E_in_r_pad = T.set_subtensor(self.zero_matrix[idx_0:idx_1,idx_0:idx_1], self.E_in_r)
-        self.E_in_i_pad = T.set_subtensor(self.zero_matrix[idx_0:idx_1,idx_0:idx_1], self.E_in_i)
-        self.phi_padded = T.set_subtensor(self.zero_matrix[idx_0:idx_1,idx_0:idx_1], self.phi_reshaped)
-
-        ################################################################
-        # E_out:
-        self.E_out_r, self.E_out_i = (fft(self.E_in_r_pad, self.E_in_i_pad))        
-        
-        # Output intensity:
-        self.E_out_2 = T.add(T.pow(self.E_out_r, 2), T.pow(self.E_out_i, 2))
-        
-        # E_out_phi:
-        self.E_out_p = T.arctan2(self.E_out_i,self.E_out_r)
-        self.E_out_p_nopad = self.E_out_p[idx_0:idx_1,idx_0:idx_1]
-        
-        # Output amplitude:
-        self.E_out_amp = T.sqrt(self.E_out_2)
-        
 #########################    end SLM class    ##########################
 ########################################################################
 
 
-def get_centre_range(n):
-    # returns the indices to use given an nxn SLM
-    # e.g. if 8 pixels, then padding to 16 means the centre starts at 4 -> 12  (0 1 2 3   4 5 6 7 8 9 10 11   12 13 14 15)
-    return int(n/2), int(n + n/2)
+########################################################################
+####################    Fourier ops (SLM_theano)   #####################
+# The Theano ops are created by SLM_theano, these wrappers keep the names
+# available from SLM_1 without importing Theano until they are used.
+def FourierOp():
+    """
+    Create an SLM_theano.FourierOp (imports Theano)
+    """
+    from SLM_theano import FourierOp
+    return FourierOp()
 
+def InverseFourierOp():
+    """
+    Create an SLM_theano.InverseFourierOp (imports Theano)
+    """
+    from SLM_theano import InverseFourierOp
+    return InverseFourierOp()
 
-########################################################################
-##################   Beginning InverseFourierOp class   ################
-class InverseFourierOp(theano.Op):
-    __props__ = ()
-    
-    def make_node(self, xr, xi):
-        # check that the theano version has support for __props__
-        assert hasattr(self, '_props')
-        xr = T.as_tensor_variable(xr)
-        xi = T.as_tensor_variable(xi)
-        
-        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
-    
-    def perform(self, node, inputs, output_storage):
-        x = inputs[0] + 1j*inputs[1]
-        nx, ny = inputs[0].shape
-        z_r = output_storage[0]
-        z_i = output_storage[1]
-        #s = np.fft.ifft2(x) * (nx*ny)
-        #s = pyfftw.interfaces.numpy_fft.ifft2(x, threads=8) * (nx*ny)
-        #s = ifft2_call(x) * (nx*ny)
-        s = np.fft.fftshift(ifft2_call(np.fft.ifftshift(x))) * (nx*ny)
-        z_r[0] = np.real(s)
-        z_i[0] = np.imag(s)
-        
-####################    End InverseFourierOp class  ####################
-########################################################################
+def PaddedFourierOp(NT):
+    """
+    Create an SLM_theano.PaddedFourierOp (imports Theano)
+    """
+    from SLM_theano import PaddedFourierOp
+    return PaddedFourierOp(NT)
 
+def CroppedInverseFourierOp(n):
+    """
+    Create an SLM_theano.CroppedInverseFourierOp (imports Theano)
+    """
+    from SLM_theano import CroppedInverseFourierOp
+    return CroppedInverseFourierOp(n)
 
-########################################################################
-####################    Beginning FourierOp class   ####################
-class FourierOp(theano.Op):
-    __props__ = ()
-    
-    def make_node(self, xr, xi):
-        # check that the theano version has support for __props__
-        assert hasattr(self, '_props')
-        xr = T.as_tensor_variable(xr)
-        xi = T.as_tensor_variable(xi)
-        
-        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
-    
-    def perform(self, node, inputs, output_storage):
-        x = inputs[0] + 1j*inputs[1]
-        z_r = output_storage[0]
-        z_i = output_storage[1]
-        #s = np.fft.fft2(x)  # has "1" normalisation
-        #s = pyfftw.interfaces.numpy_fft.fft2(x, threads=8)
-        #s = fft2_call(x)
-        s = np.fft.ifftshift(fft2_call(np.fft.fftshift(x)))
-        z_r[0] = np.real(s)
-        z_i[0] = np.imag(s)
-        
-    def grad(self, inputs, output_gradients):
-        """
-        From the docs:
-        If an Op has a single vector-valued output y and a single vector-valued input x,
-        then the grad method will be passed x and a second vector z. Define J to be the 
-        Jacobian of y with respect to x. The Op's grad method should return dot(J.T,z).
-        When theano.tensor.grad calls the grad method, it will set z to be the gradient 
-        of the cost C with respect to y. If this op is the only op that acts on x, then
-        dot(J.T,z) is the gradient of C with respect to x. If there are other ops that 
-        act on x, theano.tensor.grad will have to add up the terms of x's gradient 
-        contributed by the other op's grad method.
-        """        
-        z_r = output_gradients[0]
-        z_i = output_gradients[1]
-        
-        # check at least one is not disconnected:
-        if (isinstance(z_r.type, DisconnectedType) and 
-            isinstance(z_i.type, DisconnectedType)):
-            return [DisconnectedType, DisconnectedType]
-        
-        if isinstance(z_r.type, DisconnectedType):
-            print('z_r using zeros_like')
-            z_r = z_i.zeros_like()
-        
-        if isinstance(z_i.type, DisconnectedType):
-            print('z_i using zeros_like')
-            z_i = z_r.zeros_like()
-        
-        y = InverseFourierOp()(z_r, z_i)
-        return y
+def fft(xr, xi):
+    """
+    Apply SLM_theano.fft to the real and imaginary parts (imports Theano)
+    """
+    from SLM_theano import fft
+    return fft(xr, xi)
+
+# get_centre_range is defined in fft2 (shared with engine and SLM_theano)
 
-######################    End FourierOp class    #######################
-########################################################################
 
+########################################################################
+#####################    Grids and pattern cache    ####################
+# Coordinate grids and generated patterns are kept for reuse, the least
+# recently used entries are discarded first once the cached arrays use more
+# than grid_cache_bytes (pattern_cache_bytes) bytes.  Cached grids are
+# read-only, the generators return copies of the cached patterns.
+grid_cache_bytes = 32*2**20
+pattern_cache_bytes = 64*2**20
+
+_grids = OrderedDict()
+_patterns = OrderedDict()
+
+class CoordinateGrid(object):
+    """
+    Read-only n x n coordinates relative to r0 = (x0,y0), see coordinate_grid
+     - X, Y  : same as np.meshgrid(x, x) - r0 for x = 0..n-1 (broadcast views)
+     - R     : distance from r0
+     - theta : np.arctan2(X, Y), the angle used by the phase windings
+    R and theta are calculated when they are first used.  X and Y have
+    the type of np.arange(n, dtype=dtype) - r0, integer grids (dtype=int)
+    are those of the generators which used np.array(range(n)).
+    """
 
-fft = FourierOp()
+    def __init__(self, n, r0, dtype='float64'):
+        x = np.arange(n, dtype=dtype)
+        self.X = np.broadcast_to(x - r0[0], (n,n))
+        self.Y = np.broadcast_to((x - r0[1])[:,np.newaxis], (n,n))
+        self._R = None
+        self._theta = None
+
+    @property
+    def nbytes(self):
+        # memory used by R and theta (X and Y are broadcast views)
+        return sum(a.nbytes for a in (self._R, self._theta) if a is not None)
+
+    @property
+    def R(self):
+        if self._R is None:
+            self._R = _readonly(np.sqrt(np.power(self.X,2.) + np.power(self.Y,2.)))
+            self._grown()
+        return self._R
+
+    @property
+    def theta(self):
+        if self._theta is None:
+            self._theta = _readonly(np.arctan2(self.X, self.Y))
+            self._grown()
+        return self._theta
+
+    def _grown(self):
+        # R and theta of cached grids count towards grid_cache_bytes
+        if any(grid is self for grid in _grids.values()):
+            _trim(_grids, grid_cache_bytes)
+
+
+def coordinate_grid(n, r0=(0,0), dtype='float64'):
+    """
+    Cached CoordinateGrid for an n x n pattern centred on r0 = (x0,y0),
+    grids are kept until they use more than grid_cache_bytes
+    """
+    # the types of r0 are part of the key, they set the type of X and Y
+    key = (n, _cache_key(tuple(r0)), np.dtype(dtype).name)
+    if key in _grids:
+        grid = _grids.pop(key)
+    else:
+        grid = CoordinateGrid(n, r0, dtype)
+    _grids[key] = grid
+    _trim(_grids, grid_cache_bytes)
+    return grid
+
+
+def memoise(fn):
+    """
+    Decorator caching the patterns returned by fn for each set of
+    arguments, callers get a copy of the cached pattern.  Patterns are
+    kept until they use more than pattern_cache_bytes.  Calls with array
+    arguments or an 'out' array are not cached.
+    """
+    def wrapped(*args, **kwargs):
+        if kwargs.get('out') is not None:
+            return fn(*args, **kwargs)
+        try:
+            key = (fn, _cache_key(args), _cache_key(sorted(kwargs.items())))
+            hash(key)
+        except TypeError:
+            return fn(*args, **kwargs)
+
+        if key in _patterns:
+            value = _patterns.pop(key)
+            _patterns[key] = value
+            _trim(_patterns, pattern_cache_bytes)
+            return _copy(value)
+
+        value = fn(*args, **kwargs)
+        if _nbytes(value) <= pattern_cache_bytes:
+            _patterns[key] = _readonly(_copy(value))
+            _trim(_patterns, pattern_cache_bytes)
+        return value
+
+    wrapped.__name__ = fn.__name__
+    wrapped.__doc__ = fn.__doc__
+    return wrapped
+
+
+def clear_caches():
+    # discard all cached grids and patterns
+    _grids.clear()
+    _patterns.clear()
+
+
+def _cache_key(value):
+    # hashable key for the arguments, the type distinguishes e.g. 1 and 1.0
+    if isinstance(value, np.ndarray):
+        raise TypeError('arrays are not cached')
+    if isinstance(value, (list, tuple)):
+        return tuple(_cache_key(v) for v in value)
+    return (type(value), value)
+
+
+def _nbytes(value):
+    # memory used by the arrays of a pattern, tuple of patterns or grid
+    if isinstance(value, tuple):
+        return sum(_nbytes(v) for v in value)
+    return getattr(value, 'nbytes', 0)
+
+
+def _trim(cache, limit):
+    # discard the least recently used entries until the cache uses at most limit bytes
+    total = sum(_nbytes(v) for v in cache.values())
+    while total > limit and len(cache) > 0:
+        total -= _nbytes(cache.popitem(last=False)[1])
+
+
+def _copy(value):
+    # writable copy of a pattern (or tuple of patterns)
+    if isinstance(value, tuple):
+        return tuple(_copy(v) for v in value)
+    if isinstance(value, np.ndarray):
+        return value.copy()
+    return value
+
+
+def _readonly(value):
+    # mark the arrays of a pattern (or tuple of patterns) read-only
+    if isinstance(value, tuple):
+        return tuple(_readonly(v) for v in value)
+    if isinstance(value, np.ndarray):
+        value.flags.writeable = False
+    return value
+
+###################    End grids and pattern cache    ##################
+########################################################################
 
 
 ########################################################################
 ##########################    Def Targets    ###########################
+@memoise
 def laser_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
     """
     Create n x n target:
@@ -190,9 +244,8 @@ def laser_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
     'sigmax' and 'sigmay' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n)) - n/2
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n, (n/2,n/2), dtype=int)
+    X, Y = grid.X, grid.Y
     sigmax = np.power(2,0.5)*sigmax # to convert between intensity sigma and amplitude sigma
     sigmay = np.power(2,0.5)*sigmay # to convert between intensity sigma and amplitude sigma
 
@@ -206,6 +259,7 @@ def laser_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def target_power2(n, r0, d, A=1.0, save_param=False):
     """
     Create n x n target: 
@@ -213,12 +267,10 @@ def target_power2(n, r0, d, A=1.0, save_param=False):
     amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n, r0)
 
     # target definition
-    delta_r2 = np.power(X - r0[0], 2) + np.power(Y - r0[1], 2)
+    delta_r2 = np.power(grid.X, 2) + np.power(grid.Y, 2)
     z = A - 4*A/d**2 * delta_r2
     z[z<1E-6] = 1E-6
 
@@ -229,6 +281,7 @@ def target_power2(n, r0, d, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def target_lg(n, r0, w, l ,A, save_param=False):
     """
     Create n x n target:
@@ -236,10 +289,7 @@ def target_lg(n, r0, w, l ,A, save_param=False):
     'l' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros(shape=(n,n))
-    r = np.power((np.power((X-r0[0]),2) + np.power((Y-r0[1]),2)),0.5)
+    r = coordinate_grid(n, r0).R
 
     # target definition
     z = A/w*np.power((r*np.sqrt(2)/w),np.abs(l))*np.exp( - np.power(r/w,2))*2*np.power(r/w,2)
@@ -251,6 +301,7 @@ def target_lg(n, r0, w, l ,A, save_param=False):
         return z
 
 
+@memoise
 def target_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
     """
     Create n x n target:
@@ -258,12 +309,10 @@ def target_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
     and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n, r0, dtype=int)
 
     # target definition
-    z = A*np.exp( -2*(np.power((X-r0[0])/sigmax,2) + np.power((Y-r0[1])/sigmay,2) ) )
+    z = A*np.exp( -2*(np.power(grid.X/sigmax,2) + np.power(grid.Y/sigmay,2) ) )
 
     if save_param :
         param_used = "target_gaussian | n={0} | r0={1} | sigmax={2} | sigmay={3} | A={4} ".format(n, r0, sigmax, sigmay, A)
@@ -272,26 +321,32 @@ def target_gaussian(n, r0, sigmax, sigmay, A=1.0, save_param=False):
         return z
 
 
-def target_ringlattice(n, r0, sigma, d, nb_spots=12., A=1.0, save_param=False):
+@memoise
+def target_ringlattice(n, r0, sigma, d, nb_spots=12., A=1.0, save_param=False, out=None):
     """
     Create n x n target: 
     Ring Lattice centered on r0 = (x0,y0) with spot size 'sigma',
     diameter 'd', number of spots 'nb_spots' and amplitude 'A'
+    'out' is an optional n x n float array for the result
     """
     # initialization
     r = d/2
     x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    z = _zeros_out((n,n), out)
+    spot = np.empty((n,n))
 
     # target definition
+    # spot coordinates are broadcast from rows/columns, each spot is
+    # calculated into the same buffer and accumulated in place.  The loop
+    # over spots is kept: a stack of all spots needs nb_spots frames and
+    # splitting exp(-(dx2+dy2)) into row and column factors changes the
+    # rounding, the loop body is vectorised over all pixels
     delta_theta = 2*np.pi/nb_spots
-    phiR = np.zeros(shape=(n,n))
     for n0 in range(0,nb_spots):
             x1 = r*np.cos(n0*delta_theta)
             y1 = r*np.sin(n0*delta_theta)
-            spot = np.exp( - (np.power((((X-r0[0])+x1)/sigma),2) + np.power((((Y-r0[1])+y1)/sigma),2)))
-            z = z + spot
+            _gaussian_spot(np.power((((x-r0[0])+x1)/sigma),2), np.power((((x-r0[1])+y1)/sigma),2), spot)
+            z += spot
     
     if save_param :
         param_used = "target_ringlattice | n={0} | r0={1} | sigma={2} | d={3} | nb_spots={4} | A={5}".format(n, r0, sigma, d, nb_spots, A)
@@ -300,33 +355,60 @@ def target_ringlattice(n, r0, sigma, d, nb_spots=12., A=1.0, save_param=False):
         return z
 
 
-def target_squarelattice(n, r0, sigma, d, dim=6, A=1.0, save_param=False):
+@memoise
+def target_squarelattice(n, r0, sigma, d, dim=6, A=1.0, save_param=False, out=None):
     """
     Create n x n target: 
     Square Lattice centered on r0 = (x0,y0) with spot size 'sigma',
     total width 'd', number of spots = dim^2 and amplitude 'A'
+    'out' is an optional n x n float array for the result
     """
     # initialization
     r0 = r0 + d/2 - 0.5*d/dim
     x1 = np.arange(0,d,d/dim)
     y1 = x1
     x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    z = _zeros_out((n,n), out)
+    spot = np.empty((n,n))
 
-    # target definition
+    # target definition, see target_ringlattice
+    # rows of (x - x_spot)^2 for every spot column and row
+    DX = np.power((((x[np.newaxis,:]-r0[0])+x1[:dim,np.newaxis])/sigma),2)
+    DY = np.power((((x[np.newaxis,:]-r0[1])+y1[:dim,np.newaxis])/sigma),2)
     for n0 in range(0,dim):
         for n1 in range (0,dim):
-            spot = np.exp( - (np.power((((X-r0[0])+x1[n0])/sigma),2) + np.power((((Y-r0[1])+y1[n1])/sigma),2)))
-            z = z + spot
+            _gaussian_spot(DX[n0], DY[n1], spot)
+            z += spot
     
     if save_param :
         param_used = "target_squarelattice | n={0} | r0={1} | sigma={2} | d={3} | dim={4} | A={5}".format(n, r0, sigma, d, dim, A)
         return z, param_used
     else :
         return z
-    
 
+
+def ringlattice_spots(r0, d, nb_spots=12.):
+    """
+    Spot centres (x,y) of target_ringlattice as a nb_spots x 2 array,
+    see spots.SpotArray
+    """
+    r = d/2
+    theta = np.arange(int(nb_spots))*(2*np.pi/nb_spots)
+    return np.stack([r0[0] - r*np.cos(theta), r0[1] - r*np.sin(theta)], axis=1)
+
+
+def squarelattice_spots(r0, d, dim=6):
+    """
+    Spot centres (x,y) of target_squarelattice as a dim^2 x 2 array,
+    see spots.SpotArray
+    """
+    r0 = np.asarray(r0) + d/2 - 0.5*d/dim
+    x1 = np.arange(0,d,d/dim)[:dim]
+    y, x = np.meshgrid(r0[1] - x1, r0[0] - x1, indexing='ij')
+    return np.stack([x.ravel(), y.ravel()], axis=1)
+
+
+@memoise
 def gaussian_ring(n, r0, d, sigma, A=1.0, save_param=False):
     """
     Create n x n target: 
@@ -334,12 +416,9 @@ def gaussian_ring(n, r0, d, sigma, A=1.0, save_param=False):
     'sigma' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    r = coordinate_grid(n, r0).R
 
     # target definition
-    r= np.sqrt(np.power(X-r0[0],2.) + np.power(Y-r0[1],2.))
     z = A*np.exp(-np.power((d/2.-r)/sigma,2.))
 
     if save_param :
@@ -349,6 +428,7 @@ def gaussian_ring(n, r0, d, sigma, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def gaussian_line(n, r0, d, sigma, A=1.0, save_param=False):
     """
     Create n x n target: 
@@ -356,9 +436,8 @@ def gaussian_line(n, r0, d, sigma, A=1.0, save_param=False):
     'sigma' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n)
+    X, Y = grid.X, grid.Y
 
     # target definition
     fx = 0.5*(np.abs(X-d/2.-r0[0])+np.abs(X+d/2.-r0[0])-d)
@@ -371,6 +450,7 @@ def gaussian_line(n, r0, d, sigma, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def gaussian_top_square(n, r0, dx, dy, sigmax, sigmay, A=1.0, save_param=False):
     """
     Create n x n target: 
@@ -378,9 +458,8 @@ def gaussian_top_square(n, r0, dx, dy, sigmax, sigmay, A=1.0, save_param=False):
     'dx' and 'dy', tail widths 'sigmax' and 'sigmay' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n)
+    X, Y = grid.X, grid.Y
 
     # target definition
     fx = 0.5*(np.abs(X-dx/2.-r0[0])+np.abs(X+dx/2.-r0[0])-dx)
@@ -395,6 +474,7 @@ def gaussian_top_square(n, r0, dx, dy, sigmax, sigmay, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def gaussian_top_round(n, r0, d, sigma, A=1.0, save_param=False):
     """
     Create n x n target: 
@@ -402,10 +482,7 @@ def gaussian_top_round(n, r0, d, sigma, A=1.0, save_param=False):
     'd', tail width 'sigma' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
-    r = np.sqrt(np.power(X-r0[0],2.) + np.power(Y-r0[1],2.))
+    r = coordinate_grid(n, r0).R
 
     # target definition
     inter = 0.5*(np.abs(r-d/2.)+np.abs(r+d/2.)-d)
@@ -419,16 +496,15 @@ def gaussian_top_round(n, r0, d, sigma, A=1.0, save_param=False):
         return z
 
 
+@memoise
 def flat_top_round(n, r0, d, A=1.0, save_param=False):
     """
     Create n x n target: 
     Circle centered on r0 = (x0,y0) with diameter 'd' and amplitude 'A'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
     z = np.zeros((n,n))
-    r = np.sqrt(np.power(X-r0[0],2.) + np.power(Y-r0[1],2.))
+    r = coordinate_grid(n, r0).R
     
     # target definition
     z[r<d/2]=A
@@ -440,22 +516,32 @@ def flat_top_round(n, r0, d, A=1.0, save_param=False):
         return z
 
 
-def graphene(n, r0, l=35, A=1., save_param=False):
+@memoise
+def graphene(n, r0, l=35, A=1., save_param=False, out=None):
     """
     Create n x n target: 
     Graphene lattice centered on r0 = (x0,y0) with characteristic size
     'l' and amplitude 'A'
+    'out' is an optional n x n float array for the target amplitude
     """
     # initialization
-    z = np.zeros((n,n))
+    z = np.zeros((n,n), dtype=complex)
     x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
+    kr = np.empty((n,n))
+    wave = np.empty((n,n), dtype=complex)
 
     # target definition
+    # plane wave phases are broadcast from rows/columns into buffers, the
+    # six waves are summed in order (see target_ringlattice)
+    k = 1j*2*np.pi/l
     for i in range(0,6):
-        z = z+ A*(-1)**(i)*np.exp( 1j*2*np.pi/l*((X-r0[0])*np.cos(2*np.pi*i/6) + (Y-r0[1])*np.sin(2*np.pi*i/6)) )
+        np.add(((x-r0[0])*np.cos(2*np.pi*i/6))[np.newaxis,:], ((x-r0[1])*np.sin(2*np.pi*i/6))[:,np.newaxis], out=kr)
+        np.multiply(k, kr, out=wave)
+        np.exp(wave, out=wave)
+        wave *= A*(-1)**(i)
+        z += wave
 
-    target = np.abs(z)
+    target = np.abs(z, out=out)
     phase = np.angle(z)
 
     if save_param :
@@ -465,18 +551,18 @@ def graphene(n, r0, l=35, A=1., save_param=False):
         return target, phase
 
 
+@memoise
 def hexagon(n, r0, d=35, A=1., save_param=False):
     """
     Create n x n target: 
     Hexagon centered on r0 = (x0,y0) with size 'd' and amplitude 'A'
     """
     # initialization
-    z = np.zeros((n,n))
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
+    grid = coordinate_grid(n, r0)
+    X, Y = grid.X, grid.Y
 
     # target definition
-    z = (np.abs(X-r0[0]) <= d) & (np.abs((np.power(3,0.5)*0.5)*(Y-r0[1]) + (0.5)*(X-r0[0])) <= d) & (np.abs((np.power(3,0.5)*0.5)*(Y-r0[1]) - (0.5)*(X-r0[0])) <= d);
+    z = (np.abs(X) <= d) & (np.abs((np.power(3,0.5)*0.5)*Y + (0.5)*X) <= d) & (np.abs((np.power(3,0.5)*0.5)*Y - (0.5)*X) <= d);
 
     if save_param :
         param_used = "hexagon | n={0} | r0={1} | d={2} | A={3}".format(n, r0, d, A)
@@ -491,6 +577,8 @@ def target_image(n, r0, name, A=1.0, save_param=False):
     Image centered on r0 = (x0,y0) from filename 'name', must be
     128x128 size (can be changed but z must be changed accordingly)
     """
+    import matplotlib.image as mpimg
+
     # initialization
     img = mpimg.imread(name)
     img = img.astype(float)
@@ -506,17 +594,18 @@ def target_image(n, r0, name, A=1.0, save_param=False):
     else :
         return z
 
-def ring_and_barrierM(n, r0, d, sigma, A=1.0, save_param=False):
+@memoise
+def ring_and_barrierM(n, r0, d, sigma, A=1.0, save_param=False, out=None):
     """
     Create n x n target: 
     Multi-wavelength ring and barrier for 1064nm and 670nm centered
     on r0 = (x0,y0) with ring diameter 'd', ring width 'sigma' and
     amplitude 'A'
+    'out' is an optional n x n float array for the target
     """
     # initialization
-    x = np.array(range(n))*1. - n/2
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    grid = coordinate_grid(n, (n/2,n/2))
+    X, Y = grid.X, grid.Y
     XT = X+r0[0];
     YT = Y+r0[1];
     lambda_ratio = 670./1064;
@@ -543,17 +632,14 @@ def ring_and_barrierM(n, r0, d, sigma, A=1.0, save_param=False):
     SR1064[np.abs(M2)<v2] = 0
     
     SR = SR670+SR1064;
-    for iter_n in range(0,len(SR)):
-        for iter_m in range(0,len(SR)):
-            if SR670[iter_n,iter_m]==SR1064[iter_n,iter_m]:
-                SR[iter_n,iter_m]=SR670[iter_n,iter_m]
+    np.copyto(SR, SR670, where=(SR670==SR1064))
 
     MRring = SR1064
 
     # target definition
     Ring = np.exp( -np.power((np.power(np.power(XT,2)+np.power(YT,2),0.5)-d),2)/np.power(sigma,2));
     Barrier = np.exp( -(np.power(XT1/sigmax,2) + (np.power((YT1-d1)/sigmay,2))));
-    z = Ring + Barrier;
+    z = np.add(Ring, Barrier, out=out);
     
     if save_param :
         param_used = "target_power2 | n={0} | r0={1} | d={2} | A={3}".format(n,r0,d,A)
@@ -561,12 +647,29 @@ def ring_and_barrierM(n, r0, d, sigma, A=1.0, save_param=False):
     else :
         return z, SR, MRring,
 
+def _zeros_out(shape, out=None):
+    # zeroed output buffer for the lattice targets
+    if out is None:
+        return np.zeros(shape)
+    assert out.shape == shape, 'out is wrong shape, should be {s}'.format(s=shape)
+    out[...] = 0
+    return out
+
+
+def _gaussian_spot(dx2, dy2, spot):
+    # spot = exp(-(dy2[:,None] + dx2[None,:])) calculated in place
+    np.add(dx2[np.newaxis,:], dy2[:,np.newaxis], out=spot)
+    np.negative(spot, out=spot)
+    np.exp(spot, out=spot)
+    return spot
+
 ##########################    End Targets    ###########################
 ########################################################################
 
 
 ########################################################################
 ###########################    Def Phases    ###########################
+@memoise
 def phase_guess(n, D, asp, R, ang, B, save_param=False):
     """
     Create n x n guess phase: 
@@ -577,14 +680,13 @@ def phase_guess(n, D, asp, R, ang, B, save_param=False):
     'B' radius of ring in output plane
     """
     # initialization
-    x = np.array(range(n))*1 - n/2
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros(shape=(n,n))
+    grid = coordinate_grid(n, (n/2,n/2), dtype=int)
+    X, Y = grid.X, grid.Y
 
     # target definition
     KL = D*(X*np.cos(ang)+Y*np.sin(ang));
     KQ = 3*R*((asp*(np.power(X,2))+(1-asp)*(np.power(Y,2))));
-    KC = B*np.power((np.power(X,2)+np.power(Y,2)),0.5);
+    KC = B*grid.R;
     z = KC+KQ+KL;
     z = np.reshape(z, n**2)
     
@@ -595,18 +697,17 @@ def phase_guess(n, D, asp, R, ang, B, save_param=False):
         return z
 
 
+@memoise
 def phase_spinning_continuous(n, r0, save_param=False):
     """
     Create n x n target phase:
     0->2pi phase winding centered on r0 = (x0,y0)
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    theta = coordinate_grid(n, r0).theta
     
     # target definition
-    z = np.mod(np.arctan2(X-r0[0],Y-r0[1]),2.*np.pi)-np.pi
+    z = np.mod(theta,2.*np.pi)-np.pi
 
     if save_param :
         param_used = "phase_spinning_continuous | n={0} | r0={1}".format(n, r0)
@@ -615,18 +716,17 @@ def phase_spinning_continuous(n, r0, save_param=False):
         return z
 
 
+@memoise
 def phase_spinning_continuous10(n, r0, save_param=False):
     """
     Create n x n target phase:
     0->20pi phase winding centered on r0 = (x0,y0)
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    theta = coordinate_grid(n, r0).theta
     
     # target definition
-    z = np.mod(10*np.arctan2(X-r0[0],Y-r0[1]),2.*np.pi)-np.pi
+    z = np.mod(10*theta,2.*np.pi)-np.pi
 
     if save_param :
         param_used = "phase_spinning_continuous | n={0} | r0={1}".format(n, r0)
@@ -635,6 +735,7 @@ def phase_spinning_continuous10(n, r0, save_param=False):
         return z
 
 
+@memoise
 def phase_spinning_discrete(n, r0, nb_spots, save_param=False):
     """
     Create n x n target phase:
@@ -642,13 +743,11 @@ def phase_spinning_discrete(n, r0, nb_spots, save_param=False):
     of steps given by 'nb_spots'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    angle = coordinate_grid(n, r0).theta
 
     # target definition
     theta = np.pi/nb_spots + np.pi/2 # shift
-    z1 = np.mod(np.arctan2(X-r0[0],Y-r0[1])+theta,2.*np.pi) # phase ring lattice continuous shifted
+    z1 = np.mod(angle+theta,2.*np.pi) # phase ring lattice continuous shifted
     z = np.mod(z1-np.mod(z1,2*np.pi/nb_spots), 2*np.pi)-np.pi # discrete phase ring lattice
 
     if save_param :
@@ -658,15 +757,14 @@ def phase_spinning_discrete(n, r0, nb_spots, save_param=False):
         return z
 
 
+@memoise
 def phase_tape(n, save_param=False):
     """
     Create n x n target phase:
     Phase tape across entire plane
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    X = coordinate_grid(n).X
     
     # target definition
     z = ((X/10)//np.pi)%(2*np.pi)-np.pi
@@ -678,14 +776,13 @@ def phase_tape(n, save_param=False):
         return z
 
 
+@memoise
 def phase_flat(n, v, save_param=False):
     """
     Create n x n target phase:
     Flat phase across entire plane with value 'v'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
     z = np.zeros((n,n))
 
     # target definition
@@ -698,6 +795,7 @@ def phase_flat(n, v, save_param=False):
         return z
 
 
+@memoise
 def gaussian_line_phase(n, r0, d, sigma, save_param=False):
     """
     Create n x n target: 
@@ -705,9 +803,7 @@ def gaussian_line_phase(n, r0, d, sigma, save_param=False):
     and width 'sigma'
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros((n,n))
+    X = coordinate_grid(n).X
 
     # target definition
     z = np.mod( (X+d/2+3*sigma-r0[0])*(2*np.pi/(d+6*sigma)) , 2*np.pi)-np.pi
@@ -719,16 +815,14 @@ def gaussian_line_phase(n, r0, d, sigma, save_param=False):
         return z
 
 
+@memoise
 def phase_inverse_square(n, r0, save_param=False):
     """
     Create n x n target:
     Inverse square law phase centered on r0 = (x0,y0)
     """
     # initialization
-    x = np.array(range(n))*1.
-    X, Y = np.meshgrid(x, x)
-    z = np.zeros(shape=(n,n))
-    r = np.abs(np.power(np.power(X-r0[0],2) + np.power(Y-r0[1],2),0.5))
+    r = coordinate_grid(n, r0).R
 
     # target definition
     inverse_square = np.abs(np.power(r+1,-0.5))
@@ -748,6 +842,8 @@ def phase_image(n, r0, name, save_param=False):
     Image centered on r0 = (x0,y0) from filename 'name', must be
     128x128 size (can be changed but z must be changed accordingly)
     """
+    import matplotlib.image as mpimg
+
     # initialization
     img = mpimg.imread(name)
     img = img.astype(float)
@@ -811,6 +907,9 @@ def n_plot(p,d=[],sc=[],v=[],t=[],c=[], save=False):
      - t  : list of title
      - c  : list of color ( http://matplotlib.org/examples/color/colormaps_reference.html )
     """
+    import matplotlib.pyplot as plt
+    from mpl_toolkits.mplot3d import Axes3D # registers projection='3d'
+
     nbplot=len(p)
 
     # ===  Warning messages ============================================
@@ -876,7 +975,7 @@ def n_plot(p,d=[],sc=[],v=[],t=[],c=[], save=False):
                         ax.plot(p1D[j], color=c1D[j])
                     else :
                         if len(sc1D[j]) != len(p1D[j]) :
-                            print '        /\  \n       /  \ \nd=1 | /____\  sc[{0}][{1}] and p[{0}][{1}]have different sizes'.format(i,j) ; return
+                            print('        /\  \n       /  \ \nd=1 | /____\  sc[{0}][{1}] and p[{0}][{1}]have different sizes'.format(i,j)) ; return
                         else : ax.plot(sc1D[j], p1D[j], color=c1D[j])
                         
             # limits
@@ -888,10 +987,10 @@ def n_plot(p,d=[],sc=[],v=[],t=[],c=[], save=False):
         if d[i]==3 :
             ax = fig.add_subplot(nrow, ncol, i+1, projection='3d') # define 3d subplot for figure
             if len(sc)==0 :
-                print '        /\  \n       /  \ \nd=3 | /____\  we need to give plotting limits in arguments' ; return
+                print('        /\  \n       /  \ \nd=3 | /____\  we need to give plotting limits in arguments') ; return
             else :
                 if len(sc[i])==0 :
-                    print '        /\  \n       /  \ \nd=3 | /____\  we need to give plotting limits in sc[{0}]'.format(i) ; return
+                    print('        /\  \n       /  \ \nd=3 | /____\  we need to give plotting limits in sc[{0}]'.format(i)) ; return
                 else :
                     p3D = p[i]
                     
@@ -988,55 +1087,22 @@ def give_plot_scale(M, p, extension):
 
 ########################################################################
 ###########################    Def errors    ###########################
+# NumPy only, see metrics.py (metrics.all_metrics computes all four at once)
 def Fidelity(weighting, target, phase, E_out_amp, E_out_p):
-    E_test_w = (target*np.exp(1j*phase))*weighting
-    E_out_w = (E_out_amp*np.exp(1j*E_out_p))*weighting
-
-    F = np.sum(E_test_w*np.conjugate(E_out_w))/np.power((np.sum(np.power(np.abs(E_test_w),2)))*(np.sum(np.power(np.abs(E_out_w),2))),0.5)
-    F = np.power(np.abs(F),2)
-
-    return F
+    return metrics.fidelity(E_out_amp*np.exp(1j*E_out_p),
+            target*np.exp(1j*phase), weighting)
 
 
 def RMS_error(weighting, I_target, I_out):
-    I_target_w = I_target*weighting
-    I_out_w = I_out*weighting
-    
-    MR = np.count_nonzero(weighting)
-    
-    I_target_w_norm = I_target_w/np.sum(I_target_w)
-    I_out_w_norm = I_out_w/np.sum(I_out_w)
-
-    n = np.power((I_out_w_norm - I_target_w_norm)/I_target_w_norm,2)
-
-    where_are_NaNs = np.isnan(n)
-    where_are_inf = np.isinf(n)
-    n[where_are_NaNs] = 0
-    n[where_are_inf] = 0
-
-    n = np.power(np.sum(n)*1/MR,0.5)
-
-    return n
+    return metrics.rms_error(I_out, I_target, weighting)
 
 
 def Phase_error(weighting, phase, E_out_p):
-    phase_w = phase * weighting
-    E_out_p_w = E_out_p * weighting
-    
-    P2 = T.ge(T.abs_(phase_w-E_out_p_w), np.pi)*( 2*T.le(E_out_p_w,phase) -1)*2*np.pi*weighting
-    P2 = np.asarray(P2.eval())
-    e = np.sum(np.power(np.abs(E_out_p_w-phase_w+P2),2))/np.sum(np.power(np.abs(phase_w),2))
-
-    return e
+    return metrics.phase_error(E_out_p, phase, weighting)
 
 
 def Efficiency(weighting, I_out):
-    I_out_tot = np.sum(I_out)
-    I_out_w_tot = np.sum(I_out*weighting)
-
-    Efficiency = I_out_w_tot / I_out_tot
-
-    return Efficiency
+    return metrics.efficiency(I_out, weighting)
 
 ###########################    End errors    ###########################
 ########################################################################
@@ -1059,6 +1125,8 @@ def create_folder(name_folder, initial_path=os.getcwd(), message = False):
 
 
 def delete_file_folder(path_folder, number, message = False):
+    import shutil
+
     more=0
     if len(os.listdir(path_folder)) != 0 :
         if os.listdir(path_folder)[0] == ".DS_Store" : more=1 # Thumbs.db for windows
@@ -0,0 +1,278 @@
+""" SLM class and Fourier transform ops (Theano) used by SLM_1
+
+Split from SLM_1.py so the targets, weightings and error metrics can be
+used without importing Theano.  SLM_1.SLM creates an SLM from this
+module on first use.
+
+
+Please cite Optics Express 25, 11692 (2017) - https://doi.org/10.1364/OE.25.011692 
+14/05/2017
+"""
+
+#________________________________________________________________________________________________________________________________
+import numpy as np                          # Used for array manipulation
+import theano                               # Symbolic representation of phase; gradient calculation
+import theano.tensor as T                   # Using tensor in symbolic calculation (differentiation)
+from theano.gradient import DisconnectedType
+from fft2 import fft2_centred, ifft2_centred, fft2_padded, ifft2_cropped
+from fft2 import get_centre_range
+import profiling                            # Optional timing of the ops, see OTSLM_PROFILE
+
+########################################################################
+######################     beginning SLM class    ######################
+class SLM(object):
+    
+    def __init__(self, NT, initial_phi=None, profile_s=None, pruned=False, batch=None, dtype='float64'):
+
+        self.n_pixels = int(NT/2) # target should be 512x512, but SLM pattern calculated should be 256x256.
+        self.intensity_calc = None
+        
+        self.cost = None # placeholder for cost function.
+        
+        # dtype: float32 for single precision (complex64 FFTs), float64 otherwise
+        self.dtype = dtype
+        
+        # batch: number of SLM patterns calculated together (leading axis), None for a single pattern
+        self.batch = batch
+        if batch is None:
+            shape = (self.n_pixels, self.n_pixels)
+        else:
+            shape = (batch, self.n_pixels, self.n_pixels)
+        size = int(np.prod(shape))
+        
+        if profile_s is None:
+            profile_s = np.ones(shape) # input amplitude set to flat ones if none given
+        if initial_phi is None:
+            initial_phi = np.random.uniform(low=0, high=2*np.pi, size=(size)) # input phase set to random if none given
+        
+        assert profile_s.shape == shape, 'profile_s is wrong shape, should be {s}'.format(s=shape)
+        self.profile_s_r = profile_s.real.astype(dtype)
+        self.profile_s_i = profile_s.imag.astype(dtype)
+        
+        assert initial_phi.shape == (size,), "initial_phi must be a vector of phases of size B*N^2 (not (N,N)).  Shape is " + str(initial_phi.shape)
+
+        # Linked to the fourier transform. Keeps the same quantity of light between the input and the output
+        self.A0 = 1./NT
+        
+        # Set zeros matrix:
+        self.zero_frame = np.zeros(shape[:-2] + (2*self.n_pixels, 2*self.n_pixels), dtype=dtype)
+        self.zero_matrix = theano.shared(value=self.zero_frame,name='zero_matrix')
+        
+        # Phi and its momentum for use in gradient descent with momentum:
+        self.phi = theano.shared(value=initial_phi.astype(dtype),name='phi')
+        self.phi_rate = theano.shared(value=np.zeros_like(initial_phi).astype(dtype),name='phi_rate')
+        self.phi_reshaped = self.phi.reshape(shape)
+        
+        # E_in (n_pixels**2): Need to split real and imaginary parts as differentiating complex numbers is difficult
+        self.S_r = theano.shared(value=self.profile_s_r,name='s_r')
+        self.S_i = theano.shared(value=self.profile_s_i,name='s_i')
+        self.E_in_r = self.A0 * (self.S_r*T.cos(self.phi_reshaped) - self.S_i*T.sin(self.phi_reshaped))
+        self.E_in_i = self.A0 * (self.S_i*T.cos(self.phi_reshaped) + self.S_r*T.sin(self.phi_reshaped))
+        
+        # E_in padded (4n_pixels**2):
+        idx_0, idx_1 = get_centre_range(self.n_pixels)
+        centre = (slice(None),)*(len(shape)-2) + (slice(idx_0,idx_1), slice(idx_0,idx_1))
+        self.E_in_r_pad = T.set_subtensor(self.zero_matrix[centre], self.E_in_r)
+        self.E_in_i_pad = T.set_subtensor(self.zero_matrix[centre], self.E_in_i)
+        self.phi_padded = T.set_subtensor(self.zero_matrix[centre], self.phi_reshaped)
+
+        ################################################################
+        # E_out:
+        if pruned:
+            # Skip the zero padding, the op only transforms non-zero rows
+            self.E_out_r, self.E_out_i = PaddedFourierOp(NT)(self.E_in_r, self.E_in_i)
+        else:
+            self.E_out_r, self.E_out_i = (fft(self.E_in_r_pad, self.E_in_i_pad))        
+        
+        # Output intensity:
+        self.E_out_2 = T.add(T.pow(self.E_out_r, 2), T.pow(self.E_out_i, 2))
+        
+        # E_out_phi:
+        self.E_out_p = T.arctan2(self.E_out_i,self.E_out_r)
+        self.E_out_p_nopad = self.E_out_p[centre]
+        
+        # Output amplitude:
+        self.E_out_amp = T.sqrt(self.E_out_2)
+        
+#########################    end SLM class    ##########################
+########################################################################
+
+
+########################################################################
+##################   Beginning InverseFourierOp class   ################
+class InverseFourierOp(theano.Op):
+    __props__ = ()
+    
+    def make_node(self, xr, xi):
+        # check that the theano version has support for __props__
+        assert hasattr(self, '_props')
+        xr = T.as_tensor_variable(xr)
+        xi = T.as_tensor_variable(xi)
+        
+        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
+    
+    def perform(self, node, inputs, output_storage):
+        t0 = profiling.start()
+        # leading dimensions (if any) are a batch of independent patterns
+        x = inputs[0] + 1j*inputs[1]
+        nx, ny = inputs[0].shape[-2:]
+        z_r = output_storage[0]
+        z_i = output_storage[1]
+        #s = np.fft.ifft2(x) * (nx*ny)
+        #s = pyfftw.interfaces.numpy_fft.ifft2(x, threads=8) * (nx*ny)
+        #s = ifft2_call(x) * (nx*ny)
+        #s = np.fft.fftshift(ifft2_call(np.fft.ifftshift(x, axes=(-2,-1))), axes=(-2,-1)) * (nx*ny)
+        s = ifft2_centred(x, overwrite_x=True) # no shift copies, see fft2.shift_free
+        s *= (nx*ny)
+        z_r[0] = np.real(s).astype(inputs[0].dtype, copy=False)
+        z_i[0] = np.imag(s).astype(inputs[0].dtype, copy=False)
+        profiling.stop('InverseFourierOp', t0, z_r[0].nbytes + z_i[0].nbytes)
+        
+####################    End InverseFourierOp class  ####################
+########################################################################
+
+
+########################################################################
+####################    Beginning FourierOp class   ####################
+class FourierOp(theano.Op):
+    __props__ = ()
+    
+    def make_node(self, xr, xi):
+        # check that the theano version has support for __props__
+        assert hasattr(self, '_props')
+        xr = T.as_tensor_variable(xr)
+        xi = T.as_tensor_variable(xi)
+        
+        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
+    
+    def perform(self, node, inputs, output_storage):
+        t0 = profiling.start()
+        x = inputs[0] + 1j*inputs[1]
+        z_r = output_storage[0]
+        z_i = output_storage[1]
+        #s = np.fft.fft2(x)  # has "1" normalisation
+        #s = pyfftw.interfaces.numpy_fft.fft2(x, threads=8)
+        #s = fft2_call(x)
+        #s = np.fft.ifftshift(fft2_call(np.fft.fftshift(x, axes=(-2,-1))), axes=(-2,-1))
+        s = fft2_centred(x, overwrite_x=True) # no shift copies, see fft2.shift_free
+        z_r[0] = np.real(s).astype(inputs[0].dtype, copy=False)
+        z_i[0] = np.imag(s).astype(inputs[0].dtype, copy=False)
+        profiling.stop('FourierOp', t0, z_r[0].nbytes + z_i[0].nbytes)
+        
+    def grad(self, inputs, output_gradients):
+        """
+        From the docs:
+        If an Op has a single vector-valued output y and a single vector-valued input x,
+        then the grad method will be passed x and a second vector z. Define J to be the 
+        Jacobian of y with respect to x. The Op's grad method should return dot(J.T,z).
+        When theano.tensor.grad calls the grad method, it will set z to be the gradient 
+        of the cost C with respect to y. If this op is the only op that acts on x, then
+        dot(J.T,z) is the gradient of C with respect to x. If there are other ops that 
+        act on x, theano.tensor.grad will have to add up the terms of x's gradient 
+        contributed by the other op's grad method.
+        """        
+        z_r = output_gradients[0]
+        z_i = output_gradients[1]
+        
+        # check at least one is not disconnected:
+        if (isinstance(z_r.type, DisconnectedType) and 
+            isinstance(z_i.type, DisconnectedType)):
+            return [DisconnectedType, DisconnectedType]
+        
+        if isinstance(z_r.type, DisconnectedType):
+            print('z_r using zeros_like')
+            z_r = z_i.zeros_like()
+        
+        if isinstance(z_i.type, DisconnectedType):
+            print('z_i using zeros_like')
+            z_i = z_r.zeros_like()
+        
+        y = InverseFourierOp()(z_r, z_i)
+        return y
+
+######################    End FourierOp class    #######################
+########################################################################
+
+
+fft = FourierOp()
+
+
+########################################################################
+#################   Beginning pruned Fourier op classes   ##############
+class CroppedInverseFourierOp(theano.Op):
+    """
+    Same as InverseFourierOp but only produces the central n x n window
+    (the SLM pixels) of the NT x NT result, see fft2.ifft2_cropped.
+    """
+    __props__ = ('n',)
+
+    def __init__(self, n):
+        self.n = n
+        super(CroppedInverseFourierOp, self).__init__()
+
+    def make_node(self, xr, xi):
+        assert hasattr(self, '_props')
+        xr = T.as_tensor_variable(xr)
+        xi = T.as_tensor_variable(xi)
+
+        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
+
+    def perform(self, node, inputs, output_storage):
+        t0 = profiling.start()
+        x = inputs[0] + 1j*inputs[1]
+        s = ifft2_cropped(x, self.n)
+        output_storage[0][0] = np.real(s).astype(inputs[0].dtype, copy=False)
+        output_storage[1][0] = np.imag(s).astype(inputs[0].dtype, copy=False)
+        profiling.stop('CroppedInverseFourierOp', t0,
+                2*output_storage[0][0].nbytes)
+
+
+class PaddedFourierOp(theano.Op):
+    """
+    Same as FourierOp applied to the n x n input zero padded into the
+    centre of a NT x NT frame, without building the padded frame.
+    Only the non-zero rows are transformed, see fft2.fft2_padded.
+    """
+    __props__ = ('NT',)
+
+    def __init__(self, NT):
+        self.NT = NT
+        super(PaddedFourierOp, self).__init__()
+
+    def make_node(self, xr, xi):
+        assert hasattr(self, '_props')
+        xr = T.as_tensor_variable(xr)
+        xi = T.as_tensor_variable(xi)
+
+        return theano.Apply(self, [xr, xi], [xr.type(), xr.type()])
+
+    def perform(self, node, inputs, output_storage):
+        t0 = profiling.start()
+        x = inputs[0] + 1j*inputs[1]
+        s = fft2_padded(x, self.NT)
+        output_storage[0][0] = np.real(s).astype(inputs[0].dtype, copy=False)
+        output_storage[1][0] = np.imag(s).astype(inputs[0].dtype, copy=False)
+        profiling.stop('PaddedFourierOp', t0,
+                2*output_storage[0][0].nbytes)
+
+    def grad(self, inputs, output_gradients):
+        """
+        Same as FourierOp.grad, the adjoint is cropped to the input size.
+        """
+        z_r = output_gradients[0]
+        z_i = output_gradients[1]
+
+        if (isinstance(z_r.type, DisconnectedType) and
+            isinstance(z_i.type, DisconnectedType)):
+            return [DisconnectedType, DisconnectedType]
+
+        if isinstance(z_r.type, DisconnectedType):
+            z_r = z_i.zeros_like()
+
+        if isinstance(z_i.type, DisconnectedType):
+            z_i = z_r.zeros_like()
+
+        return CroppedInverseFourierOp(self.NT//2)(z_r, z_i)
+
+##################   End pruned Fourier op classes   ###################
+########################################################################
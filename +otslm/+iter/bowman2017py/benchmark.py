@@ -0,0 +1,530 @@
+# Benchmarks for the slm-cg python code
+#
+# Run with: python benchmark.py
+#
+# The full suite (sizes, FFT backends, precisions and SLM_1 targets)
+# writes JSON results for tracking regressions between versions:
+#   python benchmark.py --suite results.json
+#
+# Cold start (import) times of the modules, each in a new interpreter:
+#   python benchmark.py --imports
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+import fft2
+from engine import NumpyEngine
+
+def _problem(NT, batch=None):
+    """ Normalised aperture target, weighting and incident illumination
+
+    Similar to the output of wrapper.prepare_problem for a flat target
+    with a circular region of interest, without the Theano import.
+    """
+
+    n = NT//2
+    x = np.arange(NT) - NT/2.
+    X, Y = np.meshgrid(x, x)
+    R = np.sqrt(X**2 + Y**2)
+
+    Wcg = (R < NT/4.).astype('float64')
+    target = (R < NT/8.).astype('complex128')
+
+    incident = np.ones((n, n))
+    incident = incident*np.power(10000.0/np.sum(incident**2), 0.5)
+    target = target*np.power(np.sum(incident**2)/np.sum(np.abs(target)**2), 0.5)
+
+    if batch is not None:
+        target = np.stack([target]*batch)
+        incident = np.stack([incident]*batch)
+
+    return target, Wcg, incident
+
+def _time(fn, repeats):
+    # Best of three runs of repeats calls to fn, in seconds per call
+    times = timeit.repeat(fn, number=repeats, repeat=3)
+    return min(times) / repeats
+
+def batch_throughput(NT=512, batches=(1, 2, 4, 8, 16), repeats=5):
+    """ Cost and gradient evaluations per second versus batch size
+
+    Returns a list of dicts with the batch size, time per evaluation
+    of the whole batch and the throughput in holograms per second
+    (one hologram evaluation is one cost and gradient calculation).
+    """
+
+    results = []
+    for B in batches:
+        target, Wcg, incident = _problem(NT, B)
+        eng = NumpyEngine(NT, target, Wcg, incident, 9.0)
+        phi = np.random.uniform(0, 2*np.pi, size=eng.size)
+
+        t = _time(lambda: eng.evaluate(phi), repeats)
+        results.append({'batch': B, 'time': t, 'holograms_per_second': B/t})
+
+    return results
+
+def shift_free_savings(sizes=(512, 2048), repeats=5):
+    """ Time of a forward and adjoint centred FFT pair with and without shifts
+
+    Compares fftshift/ifftshift copies (as SLM_1.FourierOp did) with
+    checkerboard modulation (fft2.fft2_centred) and with the shifts
+    folded into constant arrays (engine.NumpyEngine, full FFTs).
+    Returns a list of dicts with the times in seconds per pair.
+    """
+
+    results = []
+    for NT in sizes:
+        x = np.random.rand(NT, NT) + 1j*np.random.rand(NT, NT)
+        axes = (-2, -1)
+
+        def shifted():
+            y = np.fft.ifftshift(fft2.fft2_call(np.fft.fftshift(x, axes)), axes)
+            np.fft.fftshift(fft2.ifft2_call(np.fft.ifftshift(y, axes)), axes)
+
+        def modulated():
+            y = fft2.fft2_centred(x, use_shift_free=True)
+            fft2.ifft2_centred(y, overwrite_x=True, use_shift_free=True)
+
+        def folded():
+            fft2.ifft2_call(fft2.fft2_call(x))
+
+        results.append({'NT': NT,
+            'shifted': _time(shifted, repeats),
+            'checkerboard': _time(modulated, repeats),
+            'folded': _time(folded, repeats)})
+
+    return results
+
+def sequence_throughput(n=128, frames=20, nb_iter=10, first_iter=100,
+        engine='numpy'):
+    """ Frame rate and fidelity of wrapper.run_sequence
+
+    The targets are a Gaussian ring on a n x n SLM moving by one pixel
+    per frame.  Warm started frames (run_sequence) are compared with
+    solving every frame from the same quadratic guess with the same
+    iterations.  Returns a list of dicts with the mode, the frames per
+    second (excluding the first frame) and the mean fidelity.
+    """
+
+    import wrapper
+    import SLM_1 as slm
+
+    sz = (n, n)
+    roisize = n/2.
+    incident = np.ones(sz)
+    guess = slm.phase_guess(n, 0, 0.5, 0.003, 0, 0).reshape(sz)
+
+    def targets():
+        for i in range(frames):
+            yield slm.gaussian_ring(n, (n/2. + i - frames/2., n/2.),
+                    d=n/4., sigma=2.).astype('complex128')
+
+    def fidelity(target, pattern):
+        NT, T, S, Wcg = wrapper.prepare_problem(sz, target, incident, roisize)
+        eng = NumpyEngine(NT, T, Wcg, S, 9.0)
+        eng.evaluate(pattern.flatten(), gradient=False)
+        return eng.metrics()['fidelity']
+
+    def cold(frames):
+        for i, target in enumerate(frames):
+            yield wrapper.run(sz, target, incident, roisize, 9.0, guess,
+                    first_iter if i == 0 else nb_iter, engine=engine,
+                    gain_tol=None)
+
+    def warm(frames):
+        return wrapper.run_sequence(sz, frames, incident, roisize, 9.0,
+                guess, nb_iter, first_iter=first_iter, engine=engine,
+                gain_tol=None)
+
+    results = []
+    for mode, solve in (('cold', cold), ('warm', warm)):
+        scores = []
+        t = 0.0
+        patterns = solve(targets())
+        for i, target in enumerate(targets()):
+            t0 = timeit.default_timer()
+            pattern = next(patterns)
+            if i > 0:
+                t += timeit.default_timer() - t0
+            scores.append(fidelity(target, pattern))
+        results.append({'mode': mode,
+            'frames_per_second': (frames - 1)/t if frames > 1 else None,
+            'fidelity': float(np.mean(scores))})
+
+    return results
+
+def spot_throughput(n=256, counts=(4, 16, 64, 256, 1024), repeats=5):
+    """ Cost and gradient evaluations of spots.SpotArray
+
+    Times one evaluation for K uniformly placed spots on a n x n SLM
+    with the direct DFT and with the pruned FFTs.  Returns a list of
+    dicts with K, the times in seconds and the method chosen
+    automatically.
+    """
+
+    from spots import SpotArray
+
+    incident = np.ones((n, n))
+    phi = np.random.uniform(0, 2*np.pi, n*n)
+
+    results = []
+    for K in counts:
+        spots = np.random.uniform(0, n, (K, 2))
+        times = {}
+        for name, direct in (('direct', True), ('fft', False)):
+            problem = SpotArray(n, spots, incident, direct=direct)
+            problem.evaluate(phi)
+            times[name] = _time(lambda: problem.evaluate(phi), repeats)
+        auto = SpotArray(n, spots, incident).direct
+        results.append({'spots': K, 'direct': times['direct'],
+            'fft': times['fft'], 'auto': 'direct' if auto else 'fft'})
+
+    return results
+
+#
+# Benchmark suite
+#
+
+def suite_targets():
+    """ Target generators from SLM_1 used by the suite
+
+    Returns an OrderedDict of name -> function of the SLM size n
+    returning a n x n target (the size of the unpadded target).
+    """
+    import SLM_1 as slm
+
+    def centre(n):
+        return (n/2., n/2.)
+
+    return OrderedDict([
+        ('target_lg', lambda n: slm.target_lg(n, centre(n), w=n/8., l=3,
+            A=1.0)),
+        ('target_ringlattice', lambda n: slm.target_ringlattice(n, centre(n),
+            sigma=n/64., d=n/2., nb_spots=12)),
+        ('gaussian_ring', lambda n: slm.gaussian_ring(n, centre(n), d=n/2.,
+            sigma=n/32.)),
+    ])
+
+def peak_rss():
+    """ Peak resident set size of this process in bytes, or None
+
+    This is the high-water mark of the whole process, including the
+    memory of anything run before (and, for a forked process, of its
+    parent), see run_case for the increase during a case.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss*1024
+
+def run_case(NT, backend, dtype, target, engine='numpy', iterations=50,
+        threshold=0.95):
+    """ Benchmark one optimisation
+
+    Optimises the SLM_1 target (a suite_targets name) for a NT x NT
+    output plane with the given FFT backend and dtype from the guess
+    used by bowman2017.m (scaled with NT), for a fixed number of
+    iterations.  Returns a dict with the case parameters and
+      - compile_time -- seconds to construct the cost function, the
+        Theano graph compilation for engine='theano' and the NumPy
+        engine setup (no compilation) for engine='numpy'.
+      - time_per_iteration -- mean seconds per optimiser iteration
+      - time_to_threshold -- seconds until the fidelity (see
+        metrics.field_metrics) first reached threshold, or None
+      - fidelity -- final fidelity
+      - evaluations -- number of cost and gradient evaluations
+      - peak_rss -- peak resident set size of the process in bytes
+      - peak_rss_increase -- increase of peak_rss during the case,
+        excluding the memory in use before it (such as earlier cases
+        run in the same process)
+    """
+
+    rss = peak_rss()
+
+    import wrapper
+
+    fft2.select_backend(backend)
+
+    n = NT//2
+    sz = (n, n)
+    tgt = suite_targets()[target](n)
+
+    x = np.arange(n) - n/2.
+    X, Y = np.meshgrid(x, x)
+    incident = np.exp(-(X**2 + Y**2)/(n/4.)**2)
+    guess = 3*0.003*(0.5*X**2 + 0.5*Y**2) * 512./NT
+
+    NT, tgt, incident, Wcg = wrapper.prepare_problem(sz, tgt, incident,
+            n/2., dtype=dtype)
+    fft2.tune_for((NT, NT), np.result_type(dtype, np.complex64))
+
+    t0 = timeit.default_timer()
+    if engine == 'theano':
+        evaluator = wrapper.theano_functions(NT, tgt, incident, Wcg, 9.0,
+                guess, dtype=dtype)
+    else:
+        evaluator = wrapper.numpy_functions(NT, tgt, incident, Wcg, 9.0,
+                dtype=dtype)
+    compile_time = timeit.default_timer() - t0
+
+    records = []
+    t0 = timeit.default_timer()
+    wrapper.minimise(evaluator, guess.flatten(), iterations,
+            scale=np.power(10., 9.0), gain_tol=None,
+            telemetry=records.append)
+    total = timeit.default_timer() - t0
+
+    reached = [r['time'] for r in records if r['fidelity'] >= threshold]
+    peak = peak_rss()
+
+    return {'NT': NT, 'backend': fft2.backend, 'dtype': dtype,
+        'target': target, 'engine': engine, 'iterations': len(records),
+        'compile_time': compile_time,
+        'time_per_iteration': total/max(len(records), 1),
+        'threshold': threshold,
+        'time_to_threshold': reached[0] if reached else None,
+        'fidelity': records[-1]['fidelity'] if records else None,
+        'evaluations': evaluator.nevals,
+        'peak_rss': peak,
+        'peak_rss_increase': None if peak is None else peak - rss}
+
+def _run_case_safe(kwargs):
+    # Failures are recorded in the results instead of stopping the suite
+    try:
+        return run_case(**kwargs)
+    except Exception as e:
+        result = dict(kwargs)
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+        return result
+
+# Runs one case in a new interpreter, see suite (isolate)
+_case_script = '''
+import sys, json
+import benchmark
+print(json.dumps(benchmark._run_case_safe(json.loads(sys.argv[1]))))
+'''
+
+def run_case_isolated(**kwargs):
+    """ run_case in a new python process
+
+    The process starts from a fresh interpreter, so its peak RSS and
+    FFT plans are those of the case only (a forked process inherits
+    the parent's memory high-water mark).  Failures are recorded in
+    the result ('error').
+    """
+
+    try:
+        out = subprocess.check_output([sys.executable, '-c', _case_script,
+                json.dumps(kwargs)],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.STDOUT)
+    except subprocess.CalledProcessError as e:
+        message = e.output.decode('ascii', 'replace').strip()
+        result = dict(kwargs)
+        result['error'] = message.splitlines()[-1] if message else str(e)
+        return result
+
+    # The optimisers print to stdout, the result is the last line
+    return json.loads(out.decode('ascii').strip().splitlines()[-1])
+
+def default_engines():
+    """ 'numpy', and 'theano' if Theano can be imported """
+    try:
+        import theano
+    except ImportError:
+        return ('numpy',)
+    return ('numpy', 'theano')
+
+# Statements timed by import_times, the worker and CLI start up by
+# importing wrapper (python wrapper.py and worker.Worker)
+import_cases = OrderedDict([
+    ('fft2', 'import fft2'),
+    ('fft2 + backend', 'import fft2; fft2.select_backend()'),
+    ('metrics', 'import metrics'),
+    ('SLM_1', 'import SLM_1'),
+    ('engine', 'import engine'),
+    ('wrapper', 'import wrapper'),
+    ('worker', 'import worker; worker.Worker()'),
+])
+
+# Modules which should only be imported when they are first used
+deferred_modules = ('theano', 'matplotlib', 'scipy', 'pyfftw', 'mkl_fft',
+        'matlab')
+
+_import_script = '''
+import sys, json, timeit
+t0 = timeit.default_timer()
+exec(sys.argv[1])
+t1 = timeit.default_timer()
+print(json.dumps({'time': t1 - t0,
+    'loaded': [m for m in sys.argv[2:] if m in sys.modules]}))
+'''
+
+def import_times(cases=None, repeats=5):
+    """ Cold start time of the import_cases
+
+    Each statement is run repeats times, each time in a new python
+    process started in this directory.  Returns a list of dicts with
+    the case name, the best time of the statement and of the whole
+    process (including interpreter start up) in seconds and the
+    deferred_modules which were loaded by the statement, or the last
+    line of the output ('error') if the statement failed.
+    """
+
+    if cases is None:
+        cases = import_cases
+
+    results = []
+    for name, statement in cases.items():
+        times = []
+        totals = []
+        try:
+            for i in range(repeats):
+                t0 = timeit.default_timer()
+                out = subprocess.check_output([sys.executable, '-c',
+                        _import_script, statement] + list(deferred_modules),
+                        cwd=os.path.dirname(os.path.abspath(__file__)),
+                        stderr=subprocess.STDOUT)
+                totals.append(timeit.default_timer() - t0)
+                out = json.loads(out.decode('ascii').strip().splitlines()[-1])
+                times.append(out['time'])
+        except subprocess.CalledProcessError as e:
+            # Failures are recorded, as for the suite cases
+            message = e.output.decode('ascii', 'replace').strip()
+            results.append({'name': name,
+                'error': message.splitlines()[-1] if message else str(e)})
+            continue
+        results.append({'name': name, 'time': min(times),
+            'total': min(totals), 'loaded': out['loaded']})
+
+    return results
+
+def suite_metadata():
+    """ Machine and version information stored with the results """
+
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'fft_threads': fft2.default_nthreads()}
+
+def suite(sizes=(128, 256, 512, 1024, 2048), backends=None,
+        dtypes=('float64', 'float32'), targets=None, engines=None,
+        iterations=50, threshold=0.95, isolate=True, imports=True,
+        path=None):
+    """ Run the benchmark suite
+
+    Runs run_case for every combination of the sizes, FFT backends
+    (default fft2.available_backends()), dtypes, targets (default all
+    suite_targets) and engines (default default_engines(), so the
+    compile times include Theano when it is installed).  With isolate,
+    each case runs in a new python process (run_case_isolated) so the
+    peak RSS and FFT plans of one case do not affect the next.  If imports, the cold start times (import_times) are measured
+    too.  Returns a dict with 'meta' (suite_metadata and the suite
+    parameters), the list of 'results' and the 'imports', also written
+    as JSON to path if given.
+    """
+
+    if backends is None:
+        backends = fft2.available_backends()
+    if targets is None:
+        targets = list(suite_targets().keys())
+    if engines is None:
+        engines = default_engines()
+
+    cases = [dict(NT=NT, backend=b, dtype=d, target=t, engine=e,
+            iterations=iterations, threshold=threshold)
+            for NT in sizes for b in backends for d in dtypes
+            for t in targets for e in engines]
+
+    results = []
+    for case in cases:
+        if isolate:
+            result = run_case_isolated(**case)
+        else:
+            result = _run_case_safe(case)
+        results.append(result)
+        print(json.dumps(result))
+
+    meta = suite_metadata()
+    meta.update({'sizes': list(sizes), 'backends': list(backends),
+        'dtypes': list(dtypes), 'targets': list(targets),
+        'engines': list(engines), 'iterations': iterations,
+        'threshold': threshold})
+    out = {'meta': meta, 'results': results,
+        'imports': import_times() if imports else None}
+
+    if path is not None:
+        with open(path, 'w') as fp:
+            json.dump(out, fp, indent=2)
+
+    return out
+
+if __name__ == '__main__':
+
+    if len(sys.argv) >= 2 and sys.argv[1] == '--suite':
+        suite(path=sys.argv[2] if len(sys.argv) == 3 else 'benchmark.json')
+        sys.exit(0)
+
+    if len(sys.argv) == 2 and sys.argv[1] == '--imports':
+        print('{0:<16} {1:>10} {2:>10}  {3}'.format('import', 'time [ms]',
+            'total [ms]', 'deferred modules loaded'))
+        for r in import_times():
+            if 'error' in r:
+                print('{0:<16} {1}'.format(r['name'], r['error']))
+                continue
+            print('{0:<16} {1:>10.1f} {2:>10.1f}  {3}'.format(r['name'],
+                1e3*r['time'], 1e3*r['total'], ', '.join(r['loaded'])))
+        sys.exit(0)
+
+    print('Forward + adjoint centred FFT pair [ms]')
+    print('{0:>6} {1:>10} {2:>13} {3:>10}'.format('NT', 'shifted',
+        'checkerboard', 'folded'))
+    for r in shift_free_savings():
+        print('{0:>6} {1:>10.2f} {2:>13.2f} {3:>10.2f}'.format(r['NT'],
+            1e3*r['shifted'], 1e3*r['checkerboard'], 1e3*r['folded']))
+    print('')
+
+    print('Sequence of moving targets (n=128, 10 iterations per frame)')
+    print('{0:>6} {1:>10} {2:>10}'.format('mode', 'frames/s', 'fidelity'))
+    for r in sequence_throughput():
+        print('{0:>6} {1:>10.2f} {2:>10.4f}'.format(r['mode'],
+            r['frames_per_second'], r['fidelity']))
+    print('')
+
+    print('Spot array evaluation (n=256) [ms]')
+    print('{0:>6} {1:>10} {2:>10} {3:>8}'.format('K', 'direct', 'fft', 'auto'))
+    for r in spot_throughput():
+        print('{0:>6} {1:>10.2f} {2:>10.2f} {3:>8}'.format(r['spots'],
+            1e3*r['direct'], 1e3*r['fft'], r['auto']))
+    print('')
+
+    print('Batched evaluation throughput (NT=512)')
+    print('{0:>6} {1:>12} {2:>14}'.format('B', 'time [s]', 'holograms/s'))
+    for r in batch_throughput():
+        print('{0:>6} {1:>12.4f} {2:>14.2f}'.format(r['batch'], r['time'],
+            r['holograms_per_second']))
@@ -0,0 +1,346 @@
+# NumPy cost and gradient engine for slm-cg
+#
+# Evaluates the same squared-error overlap cost as the Theano graph built
+# in wrapper.run, but computes the gradient with respect to the SLM phase
+# in closed form: one forward FFT, a pointwise adjoint in the output
+# plane, and one inverse FFT back to the SLM plane.
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import timeit
+import numpy as np
+import fft2
+from fft2 import get_centre_range
+import profiling
+from metrics import field_metrics, _sum, _expand
+
+class NumpyEngine(object):
+    """ Cost and gradient of cost_SE without Theano
+
+    The field in the output plane is calculated in the same way as
+    SLM_1.SLM: the incident field is modulated by exp(1j*phi), scaled
+    by A0 = 1/NT, padded into the centre of a NT x NT frame and
+    transformed with the shifted FFT used by SLM_1.FourierOp.
+
+    The cost is
+
+        cost = 10^steepness * (1 - overlap)^2
+        overlap = Re(sum(W conj(T) E)) / sqrt(sum(|T|^2) sum(|W E|^2))
+
+    and the gradient with respect to the complex output field E is
+    back-propagated through the adjoint FFT (SLM_1.InverseFourierOp)
+    to the SLM plane, where d(cost)/d(phi) = Im(G conj(E_in)).
+
+    A stack of B problems can be evaluated together by giving target
+    (and optionally Wcg and incident) a leading batch axis.  The cost
+    is then the sum of the B independent costs and phi is the
+    concatenation of the B flat phase vectors.
+
+    With shift_free, the fftshift/ifftshift pairs around the FFTs are
+    replaced by (-1)^(x+y) modulation (see fft2.checkerboard) which is
+    folded into the incident profile and the target when the engine is
+    constructed, so the transforms are plain FFTs of the padded field.
+    The output plane field is then c*E_out; use output_field to
+    undo the modulation.
+
+    The weighting is zero outside the region of interest, so with roi
+    the overlap is only evaluated for the pixels with non-zero weight
+    (gathered with a precomputed index set) and the gradient is
+    scattered back into an otherwise zero output plane.  The pruned
+    adjoint then skips the columns outside the region.
+
+    With dtype='float32' the fields and FFTs are single precision
+    (complex64).  The overlap sums are always accumulated in double
+    precision and the gradient is returned as float64.
+    """
+
+    def __init__(self, NT, target, Wcg, incident, steepness, pruned=True,
+            shift_free=True, dtype='float64', roi=None):
+        """ Construct the engine for a normalised target
+
+        Parameters
+          - NT -- size of the padded output plane
+          - target -- complex [B x] NT x NT normalised target
+          - Wcg -- [B x] NT x NT weighting array
+          - incident -- [B x] NT/2 x NT/2 incident field
+          - steepness -- cost function steepness (power of 10)
+          - pruned -- use fft2.fft2_padded/ifft2_cropped which skip
+            the known zero rows of the padded SLM plane
+          - shift_free -- fold the FFT shifts into the constant arrays
+          - dtype -- real dtype of the fields, float32 or float64
+          - roi -- only evaluate the overlap for pixels with non-zero
+            weight.  Default (None) uses the region of interest if it
+            covers less than roi_fraction of the output plane.
+        """
+
+        self.NT = NT
+        self.pruned = pruned
+        self.shift_free = shift_free and NT % 2 == 0
+        self.n_pixels = NT//2
+        self.A0 = 1./NT
+
+        self.rdtype = np.dtype(dtype)
+        self.cdtype = np.result_type(self.rdtype, np.complex64)
+
+        self.target = np.asarray(target).astype(self.cdtype)
+        self.batch = self.target.shape[:-2]
+        self.shape = self.batch + (self.n_pixels, self.n_pixels)
+        self.size = int(np.prod(self.shape))
+
+        self.profile_s = np.asarray(incident).astype(self.cdtype)
+        assert self.profile_s.shape[-2:] == (self.n_pixels, self.n_pixels), \
+            'incident is wrong shape, should be ({n},{n})'.format(n=self.n_pixels)
+        self.profile_s = np.broadcast_to(self.profile_s, self.shape)
+
+        self.Wcg = np.asarray(Wcg).astype(self.rdtype)
+        self.scale = np.power(10., steepness)
+
+        # Constant parts of the overlap
+        self.T = self.target
+        self.W = self.Wcg
+        self.WT = self.Wcg * self.target
+        self.W2 = np.power(self.Wcg, 2)
+        self.I_target = _sum(np.power(np.abs(self.target), 2), (-2, -1))
+
+        idx_0, idx_1 = get_centre_range(self.n_pixels)
+        self.centre = (Ellipsis, slice(idx_0, idx_1), slice(idx_0, idx_1))
+
+        if self.shift_free:
+            # ifftshift(fft2(fftshift(pad))) = c*fft2(c*pad), the input
+            # sign goes into the profile and the output sign into WT
+            c = fft2.checkerboard((NT, NT), self.rdtype)
+            self.profile_s = self.profile_s * c[self.centre]
+            self.WT = self.WT * c
+            self.T = self.T * c
+
+        # Total output intensity, sum|E_out|^2 = NT^2 sum|E_in|^2
+        self.I_total = _sum(np.power(np.abs(self.profile_s), 2), (-2, -1))
+
+        self.roi_index = region_of_interest(self.Wcg, roi)
+        self.roi = self.roi_index is not None
+
+        self.support = None
+        self.axes = (-2, -1)
+        if self.roi:
+            self.axes = (-1,)
+            self.WT = self.gather(self.WT)
+            self.W2 = self.gather(self.W2)
+            self.T = self.gather(self.T)
+            self.W = self.gather(self.W)
+
+            if self.pruned and self.shift_free:
+                cols = np.unique(self.roi_index % NT)
+                self.support = (cols[0], cols[-1]+1)
+
+    def gather(self, a):
+        """ Values of the [B x] NT x NT array a in the region of interest """
+        return np.reshape(a, a.shape[:-2] + (self.NT*self.NT,))[..., self.roi_index]
+
+    def scatter(self, a):
+        """ Inverse of gather, pixels outside the region are zero """
+        out = np.zeros(a.shape[:-1] + (self.NT*self.NT,), dtype=a.dtype)
+        out[..., self.roi_index] = a
+        return np.reshape(out, a.shape[:-1] + (self.NT, self.NT))
+
+    def incident_field(self, phi):
+        """ Field in the SLM plane for the flat phase vector phi """
+        phi = np.reshape(phi[0:self.size], self.shape).astype(self.rdtype,
+                copy=False)
+        E_in = np.exp(1j*phi).astype(self.cdtype, copy=False)
+        E_in *= self.profile_s
+        E_in *= self.A0
+        return E_in
+
+    def forward(self, E_in):
+        """ Output plane field for the unpadded SLM plane field """
+        t0 = profiling.start()
+        shift = not self.shift_free
+        if self.pruned:
+            E_out = fft2.fft2_padded(E_in, self.NT, shift=shift)
+        else:
+            pad = np.zeros(self.batch + (self.NT, self.NT), dtype=E_in.dtype)
+            pad[self.centre] = E_in
+            if not shift:
+                E_out = fft2.fft2_call(pad)
+            else:
+                E_out = np.fft.ifftshift(fft2.fft2_call(np.fft.fftshift(pad,
+                        axes=(-2, -1))), axes=(-2, -1))
+
+        # Some backends always return double precision
+        E_out = E_out.astype(self.cdtype, copy=False)
+        profiling.stop('NumpyEngine.forward', t0, E_out.nbytes)
+        return E_out
+
+    def adjoint(self, G):
+        """ Adjoint of forward, cropped to the SLM plane """
+        t0 = profiling.start()
+        shift = not self.shift_free
+        if self.pruned:
+            s = fft2.ifft2_cropped(G, self.n_pixels, shift=shift,
+                    support=self.support)
+        else:
+            NT2 = self.NT*self.NT
+            if not shift:
+                s = (fft2.ifft2_call(G) * NT2)[self.centre]
+            else:
+                s = np.fft.fftshift(fft2.ifft2_call(np.fft.ifftshift(G,
+                        axes=(-2, -1))), axes=(-2, -1))[self.centre] * NT2
+
+        s = s.astype(self.cdtype, copy=False)
+        profiling.stop('NumpyEngine.adjoint', t0, s.nbytes)
+        return s
+
+    def output_field(self, E_out):
+        """ Output plane field in the SLM_1.SLM convention
+
+        Undoes the checkerboard modulation of shift_free engines.
+        """
+        if self.shift_free:
+            return E_out * fft2.checkerboard(E_out.shape, self.rdtype)
+        return E_out
+
+    def evaluate(self, phi, gradient=True):
+        """ Calculate the cost and (optionally) the gradient at phi
+
+        Returns the tuple (cost, grad), grad is None if not requested.
+        For batched problems the per-problem costs are kept in
+        self.costs and cost is their sum.
+        """
+
+        E_in = self.incident_field(phi)
+        E_out = self.forward(E_in)
+        if self.roi:
+            E_out = self.gather(E_out)
+        self.E_out = E_out
+
+        num = _sum(np.real(np.conj(self.WT) * E_out), self.axes)
+        Q = _sum(self.W2 * np.power(np.abs(E_out), 2), self.axes)
+        norm = np.power(self.I_target * Q, 0.5)
+        overlap = num / norm
+
+        self.costs = self.scale * np.power(1 - overlap, 2)
+        cost = np.sum(self.costs)
+        if not gradient:
+            return cost, None
+
+        # d(cost)/d(E_out), using the (real, imag) => complex convention
+        # G = dcost*(WT/norm - overlap/Q*W2*E_out), coefficients in double
+        dcost = -2.*self.scale*(1 - overlap)
+        a = _expand(dcost / norm, self.axes).astype(self.rdtype)
+        b = _expand(dcost * overlap / Q, self.axes).astype(self.rdtype)
+        G = a*self.WT - b*self.W2*E_out
+        if self.roi:
+            G = self.scatter(G)
+
+        G_in = self.adjoint(G)
+        grad = np.imag(G_in * np.conj(E_in))
+
+        return cost, grad.astype('float64').flatten()
+
+    def metrics(self, E_out=None):
+        """ Fidelity, Efficiency and RMS_error of an evaluated field
+
+        E_out is self.E_out (the default, from the last evaluate) or a
+        field saved from an earlier evaluation, so no FFTs are needed.
+        See metrics.field_metrics.
+        """
+        if E_out is None:
+            E_out = self.E_out
+        return field_metrics(E_out, self.T, self.W, self.I_total, self.axes)
+
+    def cost(self, phi):
+        """ Calculate the cost at phi """
+        return self.evaluate(phi, gradient=False)[0]
+
+    def grad(self, phi):
+        """ Calculate the gradient of the cost at phi """
+        return self.evaluate(phi)[1]
+
+class FusedEvaluator(object):
+    """ Memoised cost and gradient evaluation for scipy optimisers
+
+    Wraps a function returning (cost, grad) for a phase vector.  The
+    results for the last few phase vectors are kept, so calling cost
+    and then grad (as fmin_cg does) at the same phi only evaluates the
+    forward and adjoint transforms once.
+
+    Usage with scipy.optimize
+      fmin_cg(f=ev.cost, fprime=ev.grad, ...)
+      minimize(ev, jac=True, ...)
+
+    If state and metrics are given, state() is saved with each result
+    (e.g. the output field of the evaluation) and metrics(state) gives
+    the error metrics at a cached phi without another evaluation.
+    The cumulative evaluation time (seconds) is kept in time.
+    """
+
+    def __init__(self, fn, cache_size=2, state=None, metrics=None):
+        """ Wrap fn(phi) -> (cost, grad), caching cache_size results """
+        self.fn = fn
+        self.cache_size = cache_size
+        self.cache = []
+        self.nevals = 0
+        self.time = 0.0
+        self.state = state
+        self.metrics_fn = metrics
+
+    def _lookup(self, phi):
+        # Cache entry for phi, evaluating fn if required
+
+        for entry in self.cache:
+            if np.array_equal(entry[0], phi):
+                return entry
+
+        t0 = timeit.default_timer()
+        value = self.fn(phi)
+        state = self.state() if self.state is not None else None
+        self.time += timeit.default_timer() - t0
+        self.nevals += 1
+
+        # Copy the key, the optimiser may reuse the phi buffer
+        entry = (np.array(phi, copy=True), value, state)
+        self.cache.insert(0, entry)
+        del self.cache[self.cache_size:]
+
+        return entry
+
+    def __call__(self, phi):
+        """ Return (cost, grad) at phi """
+        return self._lookup(phi)[1]
+
+    def metrics(self, phi):
+        """ Return the metrics dict at phi, or None if not available """
+        if self.metrics_fn is None:
+            return None
+        return self.metrics_fn(self._lookup(phi)[2])
+
+    def cost(self, phi):
+        """ Return the cost at phi """
+        return self(phi)[0]
+
+    def grad(self, phi):
+        """ Return the gradient of the cost at phi """
+        return self(phi)[1]
+
+# Largest fraction of the output plane for automatic ROI evaluation
+roi_fraction = 0.5
+
+def region_of_interest(Wcg, roi=None):
+    """ Flat indices of the pixels with non-zero weight, or None
+
+    Wcg is a [B x] NT x NT weighting, the region is the union over the
+    batch.  If roi is None the indices are only returned if the region
+    covers less than roi_fraction of the plane, if roi is False (or no
+    pixel has weight) None is returned.
+    """
+
+    Wcg = np.asarray(Wcg)
+    mask = np.reshape(Wcg != 0, (-1,) + Wcg.shape[-2:]).any(axis=0)
+    count = np.count_nonzero(mask)
+    if roi is None:
+        roi = count < roi_fraction * mask.size
+    if not roi or count == 0:
+        return None
+    return np.flatnonzero(mask)
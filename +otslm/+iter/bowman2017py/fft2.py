@@ -4,27 +4,163 @@
 # This file is part of OTSLM, see LICENSE.md for information about
 # using/distributing this file.
 
-def use_pyfftw():
+import os
+import json
+import timeit
+import numpy as np
+from collections import OrderedDict
+
+# Planner effort names accepted by use_pyfftw (shortest first)
+planner_efforts = ['ESTIMATE', 'MEASURE', 'PATIENT', 'EXHAUSTIVE']
+
+def default_cache_dir():
+    """ Directory for files shared between runs (FFTW wisdom, tuning)
+
+    Set by the OTSLM_CACHE environment variable.
+    """
+    default = os.path.join(os.path.expanduser('~'), '.cache', 'otslm')
+    return os.environ.get('OTSLM_CACHE', default)
+
+def default_wisdom_dir():
+    """ Directory for FFTW wisdom files
+
+    Set by the OTSLM_FFTW_WISDOM environment variable, an empty
+    value disables the on-disk wisdom cache.
+    """
+    default = os.path.join(default_cache_dir(), 'fftw')
+    return os.environ.get('OTSLM_FFTW_WISDOM', default) or None
+
+def wisdom_filename(shape, dtype, axes, nthreads, effort):
+    """ Name of the wisdom file for a transform """
+    return '{0}_t{1}_{2}_{3}_a{4}.wisdom'.format(effort, nthreads,
+        np.dtype(dtype).name, 'x'.join(str(d) for d in shape),
+        ''.join(str(a % len(shape)) for a in axes))
+
+def load_wisdom(path):
+    """ Import FFTW wisdom from path, returns True if successful
+
+    The file is the plain text wisdom of save_wisdom, nothing in it is
+    executed.
+    """
+    import pyfftw
+    try:
+        with open(path, 'rb') as fp:
+            data = fp.read()
+    except (IOError, OSError):
+        return False
+
+    # One wisdom string for each precision, each starts with (fftw-
+    wisdom = []
+    for line in data.splitlines(True):
+        if line.startswith(b'(fftw-'):
+            wisdom.append(line)
+        elif wisdom:
+            wisdom[-1] += line
+        else:
+            return False
+    if len(wisdom) != 3:
+        return False
+    return any(pyfftw.import_wisdom(tuple(wisdom)))
+
+def wisdom_delta(before, after):
+    """ Wisdom in after which is not in before, for each precision
+
+    before and after are pyfftw.export_wisdom() tuples.  FFTW wisdom is
+    a header line, one line for each entry and a closing line, the
+    result keeps the header and the new entries.
+    """
+    delta = []
+    for old, new in zip(before, after):
+        lines = new.splitlines(True)
+        if len(lines) < 2:
+            delta.append(new)
+            continue
+        known = set(old.splitlines(True))
+        delta.append(b''.join(lines[:1]
+                + [l for l in lines[1:-1] if l not in known] + lines[-1:]))
+    return tuple(delta)
+
+def save_wisdom(path, wisdom):
+    """ Write a pyfftw.export_wisdom() tuple (or wisdom_delta) to path
+
+    The wisdom strings are written one after the other as plain text.
+    The file is written to a temporary name first so concurrent
+    processes never see a partial file.
+    """
+    import tempfile
+    directory = os.path.dirname(path)
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as fp:
+            for w in wisdom:
+                fp.write(w if w.endswith(b'\n') else w + b'\n')
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        print("Warning: unable to save FFTW wisdom to " + path)
+
+def use_pyfftw(nthreads=4, effort=None, wisdom_dir=None):
+    """ FFTs from pyfftw with planning wisdom kept between processes
+
+    effort is the FFTW planner effort: ESTIMATE, MEASURE (default),
+    PATIENT or EXHAUSTIVE, or the OTSLM_FFTW_EFFORT environment variable.
+    Wisdom for each (shape, dtype, axes, nthreads, effort) is loaded
+    from wisdom_dir (see default_wisdom_dir) the first time it is
+    needed.  After a new plan is made the wisdom it added is saved to
+    the file of the transform, so expensive plans are only calculated
+    once per machine.
+    """
 
     import pyfftw
     pyfftw.interfaces.cache.enable()
 
-    nthreads = 4
+    if effort is None:
+        effort = os.environ.get('OTSLM_FFTW_EFFORT', 'MEASURE')
+    effort = effort.upper().replace('FFTW_', '')
+    if effort not in planner_efforts:
+        raise ValueError('Unknown FFTW planner effort: ' + effort)
+
+    if wisdom_dir is None:
+        wisdom_dir = default_wisdom_dir()
+
+    planned = set()
+
+    def with_wisdom(fn, a, axes):
+        if wisdom_dir is None:
+            return fn(a, axes=axes, threads=nthreads,
+                    planner_effort='FFTW_' + effort)
+
+        name = fn.__name__ + '_' + wisdom_filename(a.shape, a.dtype,
+                axes, nthreads, effort)
+        if name in planned:
+            return fn(a, axes=axes, threads=nthreads,
+                    planner_effort='FFTW_' + effort)
+
+        path = os.path.join(wisdom_dir, name)
+        have_wisdom = load_wisdom(path)
+        before = pyfftw.export_wisdom()
+        res = fn(a, axes=axes, threads=nthreads,
+                planner_effort='FFTW_' + effort)
 
-    def wrap_fft(*args, **kwargs):
-        fft2 = pyfftw.interfaces.numpy_fft.fft2(threads=nthreads, *args, **kwargs)
-        return fft2
+        if not have_wisdom:
+            save_wisdom(path, wisdom_delta(before, pyfftw.export_wisdom()))
+        planned.add(name)
 
-    def wrap_ifft(*args, **kwargs):
-        ifft2 = pyfftw.interfaces.numpy_fft.ifft2(threads=nthreads, *args, **kwargs)
-        return ifft2
+        return res
+
+    def wrap_fft(a, axes=(-2, -1)):
+        return with_wisdom(pyfftw.interfaces.numpy_fft.fft2, a, axes)
+
+    def wrap_ifft(a, axes=(-2, -1)):
+        return with_wisdom(pyfftw.interfaces.numpy_fft.ifft2, a, axes)
 
     fft2_call = wrap_fft
     ifft2_call = wrap_ifft
 
     return [fft2_call, ifft2_call]
 
-def use_numpy():
+def use_numpy(nthreads=None):
 
     import numpy as np
 
@@ -33,14 +169,54 @@ def use_numpy():
 
     return [fft2_call, ifft2_call]
 
-def use_matlab():
+def use_scipy(nthreads=4):
+
+    import scipy.fft
+
+    def wrap_fft(a, axes=(-2, -1)):
+        return scipy.fft.fft2(a, axes=axes, workers=nthreads)
+
+    def wrap_ifft(a, axes=(-2, -1)):
+        return scipy.fft.ifft2(a, axes=axes, workers=nthreads)
+
+    fft2_call = wrap_fft
+    ifft2_call = wrap_ifft
+
+    return [fft2_call, ifft2_call]
+
+def use_mkl_fft(nthreads=4):
+
+    import mkl_fft
+
+    try:
+        import mkl
+        mkl.set_num_threads(nthreads)
+    except ImportError:
+        pass
+
+    def wrap_fft(a, axes=(-2, -1)):
+        return mkl_fft.fft2(a, axes=axes)
+
+    def wrap_ifft(a, axes=(-2, -1)):
+        return mkl_fft.ifft2(a, axes=axes)
+
+    fft2_call = wrap_fft
+    ifft2_call = wrap_ifft
+
+    return [fft2_call, ifft2_call]
+
+def use_matlab(nthreads=None):
 
     import matlab
     import matlab.engine
     import numpy as np
     eng = matlab.engine.start_matlab()
 
-    def wrap_fft(a):
+    def wrap_fft(a, axes=(-2, -1)):
+        if tuple(axes) != (-2, -1) or a.ndim != 2:
+            # Partial and batched transforms (pruned FFTs, batch mode)
+            return np.fft.fft2(a, axes=axes)
+
         pattern = eng.fft2(matlab.double(a.tolist(),
             size=a.shape, is_complex=True));
         if hasattr(pattern, '_data'):
@@ -51,7 +227,10 @@ def use_matlab():
 
         return pattern
 
-    def wrap_ifft(a):
+    def wrap_ifft(a, axes=(-2, -1)):
+        if tuple(axes) != (-2, -1) or a.ndim != 2:
+            return np.fft.ifft2(a, axes=axes)
+
         pattern = eng.ifft2(matlab.double(a.tolist(),
             size=a.shape, is_complex=True));
         if hasattr(pattern, '_data'):
@@ -67,14 +246,364 @@ def use_matlab():
 
     return [fft2_call, ifft2_call]
 
-try:
-    #[fft2_call, ifft2_call] = use_matlab()
-    raise Exception()       # Seems matlab is slow
-except:
-    try:
-        [fft2_call, ifft2_call] = use_pyfftw()
-        #print("Warning: using pyfftw FFT, unable to use matlab")
-    except ImportError:
-        print("Warning: using numpy FFT, consider installing pyfftw")
-        [fft2_call, ifft2_call] = use_matlab()
+#
+# Backend registry
+#
+
+# Name => function returning [fft2_call, ifft2_call] for nthreads.
+# The order is the preference for automatic selection, matlab is slow
+# and is only used if requested explicitly.
+backends = OrderedDict([
+    ('pyfftw', use_pyfftw),
+    ('mkl_fft', use_mkl_fft),
+    ('scipy', use_scipy),
+    ('numpy', use_numpy),
+    ('matlab', use_matlab),
+])
+auto_backends = ['pyfftw', 'mkl_fft', 'scipy', 'numpy']
+
+# Currently selected backend, see select_backend.  No backend is
+# selected on import, the first transform selects the default backend.
+backend = None
+nthreads = None
+
+def _select_fft2(a, axes=(-2, -1)):
+    select_backend()
+    return _fft2(a, axes=axes)
+
+def _select_ifft2(a, axes=(-2, -1)):
+    select_backend()
+    return _ifft2(a, axes=axes)
+
+_fft2 = _select_fft2
+_ifft2 = _select_ifft2
+
+# Fastest backend found by autotune for (shape, dtype, nthreads)
+_tuned = {}
+
+def register_backend(name, factory, auto=True):
+    """ Add a backend to the registry
+
+    factory(nthreads) should return [fft2_call, ifft2_call], functions
+    with the same signature as numpy.fft.fft2 (including axes).
+    If auto, the backend is considered by automatic selection and by
+    autotune (with lower preference than the built in backends).
+    """
+    backends[name] = factory
+    if auto and name not in auto_backends:
+        auto_backends.append(name)
+
+def available_backends():
+    """ Names of the automatic backends which can be imported """
+    names = []
+    for name in auto_backends:
+        try:
+            backends[name](nthreads=1)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+def default_nthreads():
+    """ Number of FFT threads, from OTSLM_FFT_THREADS or the CPU count """
+    value = os.environ.get('OTSLM_FFT_THREADS')
+    if value:
+        return int(value)
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+def select_backend(name=None, threads=None):
+    """ Select the backend used by fft2_call and ifft2_call
+
+    name is a key in backends, 'auto' for the first backend which can
+    be imported, or 'autotune' to select the fastest backend for each
+    problem size (see tune_for).  Defaults to the OTSLM_FFT_BACKEND
+    environment variable or 'auto'.  threads defaults to
+    default_nthreads().  If no backend has been selected, the first
+    transform selects the default backend.
+    """
+    global backend, nthreads, _fft2, _ifft2
+
+    if name is None:
+        name = os.environ.get('OTSLM_FFT_BACKEND', 'auto')
+    if threads is None:
+        threads = default_nthreads()
+
+    if name in ('auto', 'autotune'):
+        for candidate in auto_backends:
+            try:
+                [_fft2, _ifft2] = backends[candidate](nthreads=threads)
+            except ImportError:
+                continue
+            if candidate == 'numpy':
+                print("Warning: using numpy FFT, consider installing pyfftw")
+            break
+    else:
+        if name not in backends:
+            raise ValueError('Unknown FFT backend: ' + str(name))
+        [_fft2, _ifft2] = backends[name](nthreads=threads)
+
+    backend = name if name != 'auto' else candidate
+    nthreads = threads
+
+def autotune(shape, dtype='complex128', repeats=5, save=True):
+    """ Select the fastest available backend for a transform shape
+
+    Each available backend is timed on a forward and inverse FFT of
+    the given shape.  The choice is remembered for the process and,
+    if save, in fft_autotune.json in default_cache_dir() so later
+    processes skip the timing.  Returns the name of the backend.
+    """
+    global _fft2, _ifft2
+
+    threads = nthreads if nthreads is not None else default_nthreads()
+    key = '{0}_{1}_t{2}'.format('x'.join(str(d) for d in shape),
+            np.dtype(dtype).name, threads)
+    path = os.path.join(default_cache_dir(), 'fft_autotune.json')
+
+    if key not in _tuned:
+        try:
+            with open(path) as fp:
+                _tuned.update(json.load(fp))
+        except (IOError, OSError, ValueError):
+            pass
+
+    if key not in _tuned or _tuned[key] not in backends:
+
+        a = (np.random.rand(*shape) + 1j*np.random.rand(*shape)).astype(dtype)
+
+        times = {}
+        for name in available_backends():
+            fft, ifft = backends[name](nthreads=threads)
+            ifft(fft(a))        # Plan/warm up
+            times[name] = min(timeit.repeat(lambda: ifft(fft(a)),
+                    number=repeats, repeat=3))
+
+        _tuned[key] = min(times, key=times.get)
+
+        if save:
+            try:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as fp:
+                    json.dump(_tuned, fp, indent=2, sort_keys=True)
+            except (IOError, OSError):
+                print("Warning: unable to save FFT tuning to " + path)
+
+    [_fft2, _ifft2] = backends[_tuned[key]](nthreads=threads)
+    return _tuned[key]
+
+def tune_for(shape, dtype='complex128'):
+    """ Run autotune for shape if the 'autotune' backend was selected """
+    if backend is None:
+        select_backend()
+    if backend == 'autotune':
+        return autotune(shape, dtype)
+    return backend
+
+# Cumulative number of calls and time (seconds) of fft2_call/ifft2_call
+fft_stats = {'calls': 0, 'time': 0.0}
+
+def fft2_call(a, axes=(-2, -1)):
+    """ 2-D FFT using the selected backend (see select_backend) """
+    t0 = timeit.default_timer()
+    out = _fft2(a, axes=axes)
+    fft_stats['time'] += timeit.default_timer() - t0
+    fft_stats['calls'] += 1
+    return out
+
+def ifft2_call(a, axes=(-2, -1)):
+    """ 2-D inverse FFT using the selected backend (see select_backend) """
+    t0 = timeit.default_timer()
+    out = _ifft2(a, axes=axes)
+    fft_stats['time'] += timeit.default_timer() - t0
+    fft_stats['calls'] += 1
+    return out
+
+#
+# Centred (shifted) transforms
+#
+
+# Replace fftshift/ifftshift by checkerboard modulation when possible
+shift_free = True
+
+_checkerboards = {}
+
+def checkerboard(shape, dtype='float64'):
+    """ (-1)^(x+y) over the last two axes of shape
+
+    For even sizes, shifting by half the period in one domain is the
+    same as multiplying by this checkerboard in the other domain, so
+
+        ifftshift(fft2(fftshift(x))) == c * fft2(c * x) * shift_sign(x.shape)
+
+    The arrays are cached and read-only.
+    """
+    shape = tuple(shape[-2:])
+    key = (shape, np.dtype(dtype).name)
+    if key not in _checkerboards:
+        c = 1 - 2*(np.add.outer(np.arange(shape[0]), np.arange(shape[1])) % 2)
+        c = c.astype(dtype)
+        c.flags.writeable = False
+        _checkerboards[key] = c
+    return _checkerboards[key]
+
+def shift_sign(shape):
+    """ Sign of the checkerboard identity for the last two axes of shape
+
+    The half period shifts give a factor (-1)^(N/2) for each axis, so
+    the sign is -1 if N0/2 + N1/2 is odd (e.g. 6 x 4 frames).
+    """
+    return 1 - 2*((shape[-2]//2 + shape[-1]//2) % 2)
+
+def _real_dtype(x):
+    # float32 for single precision arrays, float64 otherwise
+    if x.dtype in (np.float32, np.complex64):
+        return np.float32
+    return np.float64
+
+def _can_shift_free(shape, use):
+    if use is None:
+        use = shift_free
+    return use and shape[-2] % 2 == 0 and shape[-1] % 2 == 0
+
+def fft2_centred(x, overwrite_x=False, use_shift_free=None):
+    """ Centred FFT, ifftshift(fft2_call(fftshift(x))) over the last two axes
+
+    If shift_free (the module default, or use_shift_free) and the
+    sizes are even, the shifts are replaced by in-place multiplication
+    by checkerboard(x.shape), so no shifted copies are made.  If
+    overwrite_x, x may be used as the modulated input.
+    """
+    if not _can_shift_free(x.shape, use_shift_free):
+        return np.fft.ifftshift(fft2_call(np.fft.fftshift(x,
+                axes=(-2, -1))), axes=(-2, -1))
+
+    c = checkerboard(x.shape, _real_dtype(x))
+    if overwrite_x and np.iscomplexobj(x):
+        x = np.multiply(x, c, out=x)
+    else:
+        x = x * c
+    s = fft2_call(x)
+    s *= c
+    if shift_sign(x.shape) < 0:
+        np.negative(s, out=s)
+    return s
+
+def ifft2_centred(y, overwrite_x=False, use_shift_free=None):
+    """ Centred inverse FFT, fftshift(ifft2_call(ifftshift(y)))
+
+    See fft2_centred.
+    """
+    if not _can_shift_free(y.shape, use_shift_free):
+        return np.fft.fftshift(ifft2_call(np.fft.ifftshift(y,
+                axes=(-2, -1))), axes=(-2, -1))
+
+    c = checkerboard(y.shape, _real_dtype(y))
+    if overwrite_x and np.iscomplexobj(y):
+        y = np.multiply(y, c, out=y)
+    else:
+        y = y * c
+    s = ifft2_call(y)
+    s *= c
+    if shift_sign(y.shape) < 0:
+        np.negative(s, out=s)
+    return s
+
+def get_centre_range(n):
+    # returns the indices to use given an nxn SLM
+    # e.g. if 8 pixels, then padding to 16 means the centre starts at 4 -> 12  (0 1 2 3   4 5 6 7 8 9 10 11   12 13 14 15)
+    return int(n/2), int(n + n/2)
+
+def _corner_split(n, NT):
+    """ Where a centred n-wide block ends up after fftshift
+
+    The block starting at get_centre_range(n) in a NT wide frame
+    is split by the shift: the first k entries move to the end of the
+    frame and the remaining n-k entries move to the start.
+    """
+    k = n - int(n/2)
+    return k, n - k
+
+def fft2_padded(x, NT, shift=True):
+    """ Pruned shifted FFT of x zero padded into a NT x NT frame
+
+    Equivalent to ifftshift(fft2_call(fftshift(pad))) where pad is the
+    n x n array x placed in the centre of a NT x NT frame of zeros
+    (see SLM_1.SLM) and NT is even.  Only the n non-zero rows are
+    transformed in the first pass and the padded frame is never built.
+
+    If not shift, calculates fft2_call(pad) instead.  The shifts can
+    then be applied by the caller with checkerboard(pad.shape) (or
+    folded into constant arrays, see engine.NumpyEngine).
+
+    Leading dimensions of x are treated as a batch of independent fields.
+    """
+
+    n = x.shape[-1]
+    k, m = _corner_split(n, NT)
+    batch = x.shape[:-2]
+
+    rows = np.zeros(batch + (n, NT), dtype=np.result_type(x.dtype, np.complex64))
+    if shift:
+        rows[..., :m] = x[..., k:]
+        rows[..., NT-k:] = x[..., :k]
+    else:
+        rows[..., m:m+n] = x
+    rows = fft2_call(rows, axes=(-1,))
+
+    frame = np.zeros(batch + (NT, NT), dtype=rows.dtype)
+    if shift:
+        frame[..., :m, :] = rows[..., k:, :]
+        frame[..., NT-k:, :] = rows[..., :k, :]
+    else:
+        frame[..., m:m+n, :] = rows
+    frame = fft2_call(frame, axes=(-2,))
+
+    if not shift:
+        return frame
+
+    return np.fft.ifftshift(frame, axes=(-2, -1))
+
+def ifft2_cropped(y, n, shift=True, support=None):
+    """ Pruned adjoint of fft2_padded
+
+    Equivalent to the centre n x n window of
+    fftshift(ifft2_call(ifftshift(y))) * NT**2 for the NT x NT array y.
+    The second pass is only evaluated for the n rows in the window.
+
+    If not shift, the window of ifft2_call(y) * NT**2 is calculated.
+    In this case support=(c0, c1) can give the range of columns outside
+    which y is zero, only these columns are transformed in the first pass.
+
+    Leading dimensions of y are treated as a batch of independent fields.
+    """
+
+    NT = y.shape[-1]
+    k, m = _corner_split(n, NT)
+    batch = y.shape[:-2]
+
+    if not shift:
+        if support is None:
+            cols = ifft2_call(y, axes=(-2,))[..., m:m+n, :]
+        else:
+            c0, c1 = support
+            cols = np.zeros(batch + (n, NT),
+                    dtype=np.result_type(y.dtype, np.complex64))
+            cols[..., c0:c1] = ifft2_call(y[..., c0:c1],
+                    axes=(-2,))[..., m:m+n, :]
+        rows = ifft2_call(cols, axes=(-1,))
+        return rows[..., m:m+n] * (NT*NT)
+
+    cols = ifft2_call(np.fft.ifftshift(y, axes=(-2, -1)), axes=(-2,))
+
+    rows = np.empty(batch + (n, NT), dtype=cols.dtype)
+    rows[..., :k, :] = cols[..., NT-k:, :]
+    rows[..., k:, :] = cols[..., :m, :]
+    rows = ifft2_call(rows, axes=(-1,))
+
+    out = np.empty(batch + (n, n), dtype=rows.dtype)
+    out[..., :k] = rows[..., NT-k:]
+    out[..., k:] = rows[..., :m]
 
+    return out * (NT*NT)
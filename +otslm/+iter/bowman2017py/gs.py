@@ -0,0 +1,137 @@
+# Gerchberg-Saxton initialiser for slm-cg
+#
+# NumPy version of the Gerchberg-Saxton algorithm (see
+# otslm.iter.GerchbergSaxton) with the weighted GS and mixed region
+# variants.  The transforms are those of engine.NumpyEngine, so the SLM
+# padding, the FFT backends (fft2.py) and the shift-free convention are
+# the same as for the CG optimisation.  A few GS iterations, each one
+# forward and one inverse FFT, give a much better starting phase than
+# the quadratic guess, see wrapper.gs_phase and wrapper.run (gs_iter).
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import numpy as np
+from engine import NumpyEngine
+from metrics import _sum, _expand
+
+class GerchbergSaxton(object):
+    """ Gerchberg-Saxton iterations for a normalised slm-cg problem
+
+    Each iteration propagates the SLM field to the output plane
+    (NumpyEngine.forward), replaces the field in the weighted region by
+    the target and propagates back (NumpyEngine.adjoint), keeping only
+    the phase on the SLM.  The target amplitude is scaled to the output
+    power in the region.  The slm-cg cost compares complex fields, so
+    the target phase is imposed too.  With free_phase the output phase
+    is kept instead, which is the classic algorithm for intensity
+    targets.
+
+    Outside the region the output field is multiplied by 1 - mixing.
+    mixing = 1 is Gerchberg-Saxton with a zero target outside the
+    region, smaller values leave some of the light outside the region
+    free (mixed-region amplitude freedom), which trades efficiency for
+    accuracy in the region.  Plain Gerchberg-Saxton stagnates at a
+    stationary point of the slm-cg cost, where CG makes no progress,
+    so the default is 0.3.
+
+    adaptive is the adaptive-adaptive factor of otslm.iter.GerchbergSaxton,
+    the amplitude in the region is adaptive*|T| + (1 - adaptive)*|E_out|.
+
+    With weighted, the target amplitude is multiplied by weights which
+    are updated every iteration by the ratio of the target to the
+    output amplitude (weighted GS, Di Leonardo et al., Optics Express
+    15, 1913 (2007)), which evens out the spots of lattice targets.
+
+    Phases are flat vectors, the same as for NumpyEngine.evaluate, and
+    stacks of B problems are supported in the same way.
+    """
+
+    def __init__(self, NT, target, Wcg, incident, weighted=False, mixing=0.3,
+            adaptive=1.0, free_phase=False, pruned=True, shift_free=True,
+            dtype='float64'):
+        """ Construct the GS iterations for a normalised target
+
+        NT, target, Wcg, incident, pruned, shift_free and dtype are the
+        same as for engine.NumpyEngine.
+        """
+
+        self.engine = eng = NumpyEngine(NT, target, Wcg, incident, 0.0,
+                pruned=pruned, shift_free=shift_free, dtype=dtype, roi=False)
+
+        self.weighted = weighted
+        self.mixing = mixing
+        self.adaptive = adaptive
+        self.free_phase = free_phase
+
+        self.region = np.broadcast_to(eng.Wcg > 0, eng.target.shape)
+        self.amplitude = np.abs(eng.target) * self.region
+        self.signal = self.amplitude > 0
+        self.weights = np.ones(self.amplitude.shape)
+
+        # Target phase in the convention of the output field (eng.T)
+        tiny = np.finfo(eng.rdtype).tiny
+        self.target_phase = eng.T / np.maximum(np.abs(eng.T), tiny)
+
+        # Phase of the (modulated) incident field, removed from the SLM field
+        self.incident_phase = np.conj(eng.profile_s) / np.maximum(
+                np.abs(eng.profile_s), tiny)
+
+        self.E_out = None
+        self.nevals = 0
+
+    def iteration(self, phi):
+        """ One iteration from the flat phase vector phi, returns the new phase """
+
+        eng = self.engine
+        E_out = eng.forward(eng.incident_field(phi))
+        self.E_out = E_out
+        self.nevals += 1
+
+        amp = np.abs(E_out)
+        axes = (-2, -1)
+
+        # Target amplitude with the output power in the region
+        power = _sum(np.power(amp*self.region, 2), axes)
+        def scaled(a):
+            return a * _expand(np.power(power / _sum(np.power(a, 2), axes),
+                    0.5), axes)
+
+        if self.weighted:
+            # The ratio is to the unweighted target, so the weights
+            # converge where the output matches the target
+            target = scaled(self.amplitude)
+            tiny = 1e-6*_expand(np.max(target, axis=axes), axes)
+            ratio = np.where(self.signal, target / np.maximum(amp, tiny), 1.)
+            self.weights = self.weights * ratio
+            self.weights /= _expand(_sum(self.weights*self.signal, axes)
+                    / _sum(self.signal, axes), axes)
+
+        target = scaled(self.amplitude * self.weights)
+
+        if self.adaptive != 1.0:
+            target = self.adaptive*target + (1 - self.adaptive)*amp
+
+        if self.free_phase:
+            phase = E_out / np.maximum(amp, np.finfo(eng.rdtype).tiny)
+        else:
+            phase = self.target_phase
+        D = np.where(self.region, target*phase, (1 - self.mixing)*E_out)
+
+        s = eng.adjoint(D.astype(eng.cdtype, copy=False))
+        return np.angle(s * self.incident_phase).astype('float64').flatten()
+
+    def run(self, phi, nb_iter):
+        """ nb_iter iterations from the flat phase vector phi """
+        for i in range(nb_iter):
+            phi = self.iteration(phi)
+        return phi
+
+    def metrics(self):
+        """ Error metrics of the output field of the last iteration
+
+        The field is the output of the phase given to the last
+        iteration, see NumpyEngine.metrics.
+        """
+        return self.engine.metrics(self.E_out)
@@ -0,0 +1,109 @@
+# Error metrics for slm-cg output fields, NumPy only
+#
+# Vectorised versions of the SLM_1 error metrics (Fidelity, RMS_error,
+# Phase_error and Efficiency).  All functions reduce over the last
+# two (image) axes, so stacks of output fields (e.g. candidate
+# holograms) give arrays of per-field values.  Sums are accumulated
+# in double precision.
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import numpy as np
+
+def fidelity(E, T, W, axes=(-2, -1)):
+    """ Overlap |sum(T W conj(E W))|^2 / (sum|T W|^2 sum|E W|^2)
+
+    E is the complex output field and T the complex target.
+    """
+    TW = T*W
+    EW = E*W
+    F = np.sum(TW*np.conj(EW), axis=axes, dtype='complex128')
+    return np.power(np.abs(F), 2) / (_sum(np.power(np.abs(TW), 2), axes)
+            * _sum(np.power(np.abs(EW), 2), axes))
+
+def efficiency(I_out, W, I_total=None, axes=(-2, -1)):
+    """ Fraction of the output intensity in the weighted region
+
+    I_total defaults to the sum of I_out.
+    """
+    if I_total is None:
+        I_total = _sum(I_out, axes)
+    return _sum(I_out*W, axes) / I_total
+
+def rms_error(I_out, I_target, W, axes=(-2, -1)):
+    """ RMS relative error of the normalised weighted intensities
+
+    Pixels where the relative error is not finite (zero target) are
+    ignored, the mean is over the non-zero weights.
+    """
+
+    # Relative errors in double precision, they can be very large
+    I_target_w = (I_target*W).astype('float64')
+    I_target_w = I_target_w / _expand(_sum(I_target_w, axes), axes)
+    I_out_w = I_out*W
+    I_out_w = I_out_w / _expand(_sum(I_out_w, axes), axes)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        n = np.power((I_out_w - I_target_w)/I_target_w, 2)
+        n[~np.isfinite(n)] = 0
+        MR = np.count_nonzero(np.broadcast_to(W, n.shape), axis=axes)
+        return np.power(_sum(n, axes)/MR, 0.5)
+
+def phase_error(E_out_p, phase, W, axes=(-2, -1)):
+    """ Relative error of the weighted output phase
+
+    Differences of at least pi are wrapped by 2 pi, as in
+    SLM_1.Phase_error.
+    """
+    phase_w = phase*W
+    E_out_p_w = E_out_p*W
+    P2 = (np.abs(phase_w - E_out_p_w) >= np.pi) \
+            * (2*(E_out_p_w <= phase) - 1) * 2*np.pi*W
+    return _sum(np.power(np.abs(E_out_p_w - phase_w + P2), 2), axes) \
+            / _sum(np.power(np.abs(phase_w), 2), axes)
+
+def field_metrics(E, T, W, I_total=None, axes=(-2, -1), phase=None):
+    """ Error metrics of the output field E in a single pass
+
+    Computes fidelity, efficiency and rms_error (and phase_error if
+    the target phase is given) sharing the intensities between them.
+    E, T and W must use the same convention, e.g. gathered to a region
+    of interest or checkerboard modulated.  I_total is the total output
+    intensity used for the efficiency (default: the sum of |E|^2).
+
+    Returns a dict with 'fidelity', 'efficiency', 'rms_error' and
+    (with phase) 'phase_error'.
+    """
+
+    I_out = np.power(np.abs(E), 2)
+    I_target = np.power(np.abs(T), 2)
+
+    out = {'fidelity': fidelity(E, T, W, axes),
+        'efficiency': efficiency(I_out, W, I_total, axes),
+        'rms_error': rms_error(I_out, I_target, W, axes)}
+
+    if phase is not None:
+        out['phase_error'] = phase_error(np.angle(E), phase, W, axes)
+
+    return out
+
+def all_metrics(weighting, target, phase, E_out):
+    """ SLM_1 Fidelity, RMS_error, Phase_error and Efficiency at once
+
+    weighting, target (amplitude) and phase (target phase) are the
+    arguments of the SLM_1 functions and E_out is the complex output
+    field.  E_out can be a stack of fields (B x N x N), the targets
+    are broadcast and each metric is then an array of B values.
+    """
+    T = target*np.exp(1j*phase)
+    return field_metrics(E_out, T, weighting, phase=phase)
+
+def _sum(a, axes):
+    # Sum over the image axes, accumulating in double precision
+    return np.sum(a, axis=axes, dtype='float64')
+
+def _expand(a, axes):
+    # Inverse of _sum for broadcasting per-image values over images
+    return np.reshape(a, np.shape(a) + (1,)*len(axes))
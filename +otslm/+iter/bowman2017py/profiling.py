@@ -0,0 +1,153 @@
+# Low overhead instrumentation of the slm-cg hot path
+#
+# Enable by setting the environment variable OTSLM_PROFILE before
+# starting python:
+#   OTSLM_PROFILE=1              print a summary when python exits
+#   OTSLM_PROFILE=trace.json     also write a Chrome trace (load in
+#                                chrome://tracing, Perfetto or speedscope)
+#
+# Instrumented sections (FourierOp.perform, InverseFourierOp.perform,
+# the pruned ops, compiled Theano functions and the NumPy engine
+# transforms) use
+#   t0 = profiling.start()
+#   ...
+#   profiling.stop('name', t0, out_bytes)
+# which only checks a flag when profiling is disabled.  out_bytes is
+# the size of the arrays the section returns (not its peak allocation).
+#
+# Memory use is bounded: each section keeps running totals and the last
+# max_samples durations (for the percentiles), the trace keeps the last
+# max_events sections.  The persistent worker dumps and resets after
+# every job, see dump.
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import json
+import atexit
+import threading
+import timeit
+import collections
+import numpy as np
+
+enabled = False
+trace_path = None
+max_samples = 10000
+max_events = 100000
+
+# name -> [calls, total, max, output bytes]
+_totals = {}
+
+# name -> recent durations (seconds)
+_durations = {}
+
+# Trace events (name, start, duration, thread) relative to _origin
+_events = collections.deque(maxlen=max_events)
+_origin = timeit.default_timer()
+_registered = False
+
+def enable(trace=None):
+    """ Enable recording, trace is an optional Chrome trace file name
+
+    The summary (and trace) are written when python exits.
+    """
+    global enabled, trace_path, _registered
+    enabled = True
+    if trace is not None:
+        trace_path = trace
+    if not _registered:
+        atexit.register(dump)
+        _registered = True
+
+def disable():
+    """ Stop recording, recorded data is kept until reset """
+    global enabled
+    enabled = False
+
+def reset():
+    """ Discard all recorded data (and apply a new max_events) """
+    global _events, _origin
+    _totals.clear()
+    _durations.clear()
+    _events = collections.deque(maxlen=max_events)
+    _origin = timeit.default_timer()
+
+def start():
+    """ Start time for stop, or None if profiling is disabled """
+    if enabled:
+        return timeit.default_timer()
+    return None
+
+def stop(name, t0, out_bytes=0):
+    """ Record a section started with start()
+
+    out_bytes is the size of the section's output arrays.
+    """
+    if t0 is None:
+        return
+    dt = timeit.default_timer() - t0
+    totals = _totals.get(name)
+    if totals is None:
+        totals = _totals[name] = [0, 0., 0., 0]
+        _durations[name] = collections.deque(maxlen=max_samples)
+    totals[0] += 1
+    totals[1] += dt
+    totals[2] = max(totals[2], dt)
+    totals[3] += out_bytes
+    _durations[name].append(dt)
+    _events.append((name, t0 - _origin, dt,
+            threading.current_thread().ident))
+
+def summary():
+    """ Statistics for each section
+
+    Returns a dict of name -> dict with calls, total, mean, p50, p90,
+    p99 and max (seconds) and out_bytes (total size of the outputs).
+    The percentiles are of the last max_samples calls.
+    """
+    out = {}
+    for name, (calls, total, longest, out_bytes) in _totals.items():
+        p50, p90, p99 = np.percentile(np.asarray(_durations[name]),
+                [50, 90, 99])
+        out[name] = {'calls': calls, 'total': total, 'mean': total/calls,
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99),
+            'max': longest, 'out_bytes': int(out_bytes)}
+    return out
+
+def print_summary():
+    """ Print the summary table, sorted by total time """
+    stats = summary()
+    print('{0:<28} {1:>8} {2:>10} {3:>9} {4:>9} {5:>9} {6:>10}'.format(
+        'section', 'calls', 'total [s]', 'p50 [ms]', 'p90 [ms]',
+        'p99 [ms]', 'MB out'))
+    for name in sorted(stats, key=lambda k: -stats[k]['total']):
+        s = stats[name]
+        print('{0:<28} {1:>8} {2:>10.3f} {3:>9.3f} {4:>9.3f} {5:>9.3f} '
+            '{6:>10.1f}'.format(name, s['calls'], s['total'], 1e3*s['p50'],
+            1e3*s['p90'], 1e3*s['p99'], s['out_bytes']/1e6))
+
+def dump_trace(path):
+    """ Write the recorded sections in the Chrome trace event format """
+    pid = os.getpid()
+    events = [{'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+        'ts': 1e6*ts, 'dur': 1e6*dur} for name, ts, dur, tid in _events]
+    with open(path, 'w') as fp:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+
+def dump():
+    """ Print the summary, write the trace (if any) and reset
+
+    Does nothing if nothing was recorded since the last reset.
+    """
+    if not _totals:
+        return
+    print_summary()
+    if trace_path is not None:
+        dump_trace(trace_path)
+    reset()
+
+_setting = os.environ.get('OTSLM_PROFILE', '')
+if _setting and _setting != '0':
+    enable(_setting if _setting.endswith('.json') else None)
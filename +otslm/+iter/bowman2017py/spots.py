@@ -0,0 +1,249 @@
+# Spot array holograms for slm-cg
+#
+# Lattice targets (SLM_1.target_ringlattice, target_squarelattice) are a
+# few Gaussian spots, so only the output field at the K spot positions
+# matters.  SpotArray evaluates this field with a direct DFT (two
+# K x n matrix products for a n x n SLM, K*n^2 operations) instead of
+# padded FFTs of the whole output plane, which is faster and needs no
+# NT x NT arrays for the small arrays used for optical traps.  Spot
+# positions can be sub-pixel.  For large K the same iterations use the
+# pruned FFTs of engine.NumpyEngine, see direct_max_spots.
+#
+# Example
+#   spots = SLM_1.ringlattice_spots((n/2., n/2.), d=n/4., nb_spots=12)
+#   pattern = wrapper.run_spots((n, n), spots, incident, guess, 50)
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import numpy as np
+import fft2
+import profiling
+from fft2 import get_centre_range
+from metrics import field_metrics
+
+# The direct DFT is used for at most direct_spot_factor*NT spots.  The
+# exponentials and products in the SLM plane cost the same for both
+# methods, so the direct DFT is faster than the pruned FFT pair for up
+# to 2-3 n spots (see benchmark.spot_throughput).
+direct_spot_factor = 1.0
+
+def direct_max_spots(NT):
+    """ Largest number of spots evaluated with the direct DFT """
+    return int(direct_spot_factor * NT)
+
+class SpotArray(object):
+    """ Output field, cost and weighted GS for an array of spots
+
+    The output plane is the same as for wrapper.run: the n x n SLM is
+    padded into the centre of a NT x NT frame (NT = 2n), the incident
+    field is scaled by A0 = 1/NT and the target image of size n sits in
+    the centre of the output plane.  Spot positions (x, y) are (column,
+    row) coordinates of the target image, as r0 for the SLM_1 targets.
+
+    The spot amplitudes are free in phase, so the cost is
+
+        cost = 10^steepness * (1 - overlap)^2
+        overlap = sum(a |E|) / sqrt(sum(a^2) sum(|E|^2))
+
+    for the target amplitudes a and the output field E at the spots.
+    This is the slm-cg overlap with the target phase set to the output
+    phase (see engine.NumpyEngine).
+
+    With direct, E is calculated as E_k = A0 sum_(r,c) ey[k,r] E_in[r,c]
+    ex[k,c] with the K x n DFT rows ex and ey of the spot frequencies.
+    Otherwise E is gathered from the shift-free pruned FFT of the SLM
+    field (fft2.fft2_padded) and positions are rounded to pixels.
+    """
+
+    def __init__(self, n, spots, incident, amplitudes=None, steepness=9.0,
+            direct=None, dtype='float64'):
+        """ Construct the spot array problem
+
+        Parameters
+          - n -- size of the (square) SLM and target image
+          - spots -- K x 2 array of spot positions (x, y)
+          - incident -- n x n incident field
+          - amplitudes -- K target amplitudes (default: uniform)
+          - steepness -- cost function steepness (power of 10)
+          - direct -- use the direct DFT.  Default (None) uses it for
+            at most direct_max_spots(NT) spots.
+          - dtype -- real dtype of the fields, float32 or float64
+        """
+
+        self.n_pixels = n
+        self.NT = NT = 2*n
+        self.A0 = 1./NT
+        self.scale = np.power(10., steepness)
+
+        self.rdtype = np.dtype(dtype)
+        self.cdtype = np.result_type(self.rdtype, np.complex64)
+
+        spots = np.asarray(spots, dtype='float64').reshape((-1, 2))
+        self.spots = spots
+        self.nb_spots = K = len(spots)
+        if amplitudes is None:
+            amplitudes = np.ones(K)
+        self.amplitudes = np.broadcast_to(np.asarray(amplitudes,
+                dtype='float64'), (K,))
+        self.I_target = np.sum(np.power(self.amplitudes, 2))
+
+        self.profile_s = np.asarray(incident).astype(self.cdtype)
+        assert self.profile_s.shape == (n, n), \
+            'incident is wrong shape, should be ({n},{n})'.format(n=n)
+
+        # Total output intensity, sum|E_out|^2 = NT^2 sum|E_in|^2
+        self.I_total = np.sum(np.power(np.abs(self.profile_s), 2),
+                dtype='float64')
+
+        self.direct = K <= direct_max_spots(NT) if direct is None else direct
+
+        # Output plane pixels (row, column) of the spots
+        p = spots[:, ::-1] + NT//4
+
+        if self.direct:
+            # DFT rows, centred coordinates of the padded SLM plane
+            r = np.arange(n) + get_centre_range(n)[0] - NT/2
+            f = -2j*np.pi*(p - NT/2)/NT
+            self.ey = np.exp(f[:, 0, np.newaxis]*r).astype(self.cdtype)
+            self.ex = np.exp(f[:, 1, np.newaxis]*r).astype(self.cdtype)
+        else:
+            # Shifted FFT = c*fft2(c*pad), see NumpyEngine (shift_free)
+            p = np.round(p).astype(int) % NT
+            self.index = p[:, 0]*NT + p[:, 1]
+            c = fft2.checkerboard((NT, NT), self.rdtype)
+            idx_0, idx_1 = get_centre_range(n)
+            self.profile_s = self.profile_s * c[idx_0:idx_1, idx_0:idx_1]
+            self.sign = c.flatten()[self.index]
+            self.support = (p[:, 1].min(), p[:, 1].max()+1)
+
+        # Phase of the incident field, removed from the SLM field by wgs
+        tiny = np.finfo(self.rdtype).tiny
+        self.incident_phase = np.conj(self.profile_s) / np.maximum(
+                np.abs(self.profile_s), tiny)
+
+        self.weights = np.ones(K)
+        self.E_out = None
+
+    def incident_field(self, phi):
+        """ Field in the SLM plane for the flat phase vector phi """
+        phi = np.reshape(phi, self.profile_s.shape).astype(self.rdtype,
+                copy=False)
+        E_in = np.exp(1j*phi).astype(self.cdtype, copy=False)
+        E_in *= self.profile_s
+        E_in *= self.A0
+        return E_in
+
+    def forward(self, E_in):
+        """ Field at the spots for the n x n SLM plane field """
+        t0 = profiling.start()
+        if self.direct:
+            E = np.sum(np.dot(self.ey, E_in) * self.ex, axis=-1)
+        else:
+            E = fft2.fft2_padded(E_in, self.NT, shift=False)
+            E = E.flatten()[self.index] * self.sign
+        E = E.astype(self.cdtype, copy=False)
+        profiling.stop('SpotArray.forward', t0, E.nbytes)
+        return E
+
+    def adjoint(self, G):
+        """ Adjoint of forward, G is a value for each spot """
+        t0 = profiling.start()
+        if self.direct:
+            s = np.dot(np.conj(self.ey).T, G[:, np.newaxis]*np.conj(self.ex))
+        else:
+            NT = self.NT
+            y = np.zeros(NT*NT, dtype=self.cdtype)
+            np.add.at(y, self.index, G*self.sign)
+            s = fft2.ifft2_cropped(y.reshape((NT, NT)), self.n_pixels,
+                    shift=False, support=self.support)
+        s = s.astype(self.cdtype, copy=False)
+        profiling.stop('SpotArray.adjoint', t0, s.nbytes)
+        return s
+
+    def evaluate(self, phi, gradient=True):
+        """ Calculate the cost and (optionally) the gradient at phi
+
+        Returns the tuple (cost, grad), grad is None if not requested.
+        """
+
+        E_in = self.incident_field(phi)
+        E = self.forward(E_in)
+        self.E_out = E
+
+        amp = np.abs(E).astype('float64')
+        num = np.sum(self.amplitudes*amp)
+        Q = np.sum(np.power(amp, 2))
+        norm = np.power(self.I_target * Q, 0.5)
+        overlap = num / norm
+
+        cost = self.scale * np.power(1 - overlap, 2)
+        if not gradient:
+            return cost, None
+
+        # d(cost)/d(E) = dcost*(a E/|E|/norm - overlap/Q*E)
+        dcost = -2.*self.scale*(1 - overlap)
+        unit = E / np.maximum(amp, np.finfo(self.rdtype).tiny)
+        G = (dcost/norm)*self.amplitudes*unit - (dcost*overlap/Q)*E
+
+        G_in = self.adjoint(G.astype(self.cdtype, copy=False))
+        grad = np.imag(G_in * np.conj(E_in))
+
+        return cost, grad.astype('float64').flatten()
+
+    def cost(self, phi):
+        """ Calculate the cost at phi """
+        return self.evaluate(phi, gradient=False)[0]
+
+    def iteration(self, phi):
+        """ One weighted GS iteration from phi, returns the new phase
+
+        The spot fields are replaced by the weighted target amplitudes
+        with the output phase and propagated back to the SLM (weighted
+        gratings and lenses, Di Leonardo et al., Optics Express 15, 1913
+        (2007)).  The weights are multiplied by the ratio of the target
+        to the output amplitude every iteration.
+        """
+
+        E = self.forward(self.incident_field(phi))
+        self.E_out = E
+
+        amp = np.abs(E).astype('float64')
+        target = self.amplitudes * np.power(np.sum(np.power(amp, 2))
+                / self.I_target, 0.5)
+        ratio = target / np.maximum(amp, 1e-6*np.max(target))
+        self.weights = self.weights * ratio
+        self.weights /= np.mean(self.weights)
+
+        unit = E / np.maximum(amp, np.finfo(self.rdtype).tiny)
+        D = (self.amplitudes * self.weights * unit).astype(self.cdtype)
+        s = self.adjoint(D)
+        return np.angle(s * self.incident_phase).astype('float64').flatten()
+
+    def wgs(self, phi, nb_iter):
+        """ nb_iter weighted GS iterations from the flat phase vector phi """
+        for i in range(nb_iter):
+            phi = self.iteration(phi)
+        return phi
+
+    def metrics(self, E_out=None):
+        """ Error metrics of the field at the spots
+
+        E_out is self.E_out (the default, from the last evaluation) or a
+        field saved from an earlier evaluation.  Returns the
+        metrics.field_metrics of the spots (the fidelity is overlap^2,
+        the efficiency the fraction of the light in the spot pixels)
+        and the uniformity 1 - (max - min)/(max + min) of the spot
+        intensities relative to the target intensities.
+        """
+
+        if E_out is None:
+            E_out = self.E_out
+        amp = np.abs(E_out)
+        T = self.amplitudes * E_out / np.maximum(amp, np.finfo(amp.dtype).tiny)
+        result = field_metrics(E_out, T, 1.0, self.I_total, axes=(-1,))
+
+        I = np.power(amp, 2) / np.power(self.amplitudes, 2)
+        result['uniformity'] = 1 - (I.max() - I.min())/(I.max() + I.min())
+        return result
@@ -0,0 +1,191 @@
+# Parallel parameter sweeps of wrapper.run
+#
+# Runs the optimisation for every point of a parameter grid (steepness,
+# roisize and the SLM_1.phase_guess parameters D, asp, R, ang, B) on a
+# process pool.  The target and incident arrays are placed in shared
+# memory once, only the parameters are sent with each task.
+#
+# Example
+#   best, table = sweep.sweep(sz, target, incident,
+#       {'steepness': [7, 8, 9], 'roisize': [64, 96], 'R': [0.002, 0.003]},
+#       nb_iter=200, path='sweep.jsonl')
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import json
+import timeit
+import itertools
+import traceback
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+# Defaults for the parameters which are not part of the grid, the
+# guess parameters give the guess used by bowman2017.m
+default_parameters = OrderedDict([
+    ('steepness', 9.0),
+    ('roisize', None),          # default: min(sz)/2
+    ('D', 0.0),
+    ('asp', 0.5),
+    ('R', 0.003),
+    ('ang', 0.0),
+    ('B', 0.0),
+])
+
+def parameter_grid(grid):
+    """ List of parameter dicts for every combination of the grid values
+
+    grid is a dict of parameter name -> list of values.  Parameters
+    are iterated in the order of default_parameters, then any others
+    in sorted order.
+    """
+    names = [k for k in default_parameters if k in grid]
+    names += sorted(k for k in grid if k not in default_parameters)
+    return [OrderedDict(zip(names, values))
+            for values in itertools.product(*[grid[k] for k in names])]
+
+def shared_array(a):
+    """ Copy a into shared memory, returns a spec for from_shared
+
+    Complex arrays are stored as interleaved doubles.  The memory is a
+    multiprocessing.RawArray, so it is inherited by pool workers
+    without pickling the data.
+    """
+    a = np.ascontiguousarray(a)
+    dtype = np.result_type(a.dtype, np.float64)
+    raw = multiprocessing.RawArray('d', a.size*(2 if dtype.kind == 'c' else 1))
+    np.frombuffer(raw, dtype=dtype)[:] = a.ravel()
+    return (raw, a.shape, dtype.str)
+
+def from_shared(spec):
+    """ Array view of a shared_array (no copy) """
+    raw, shape, dtype = spec
+    return np.frombuffer(raw, dtype=dtype).reshape(shape)
+
+# Per-process state of the pool workers, see _init_worker
+_worker = {}
+
+def _init_worker(sz, target, incident, nb_iter, kwargs):
+    # One FFT thread per worker, the pool provides the parallelism
+    os.environ['OTSLM_FFT_THREADS'] = '1'
+    import fft2
+    fft2.select_backend(fft2.backend, threads=1)
+
+    _worker.update(sz=sz, target=from_shared(target),
+            incident=from_shared(incident), nb_iter=nb_iter, kwargs=kwargs)
+
+def evaluate(sz, target, incident, params, nb_iter, **kwargs):
+    """ Run wrapper.run for one parameter set and score the result
+
+    params is a dict with the values of default_parameters (missing
+    values use the defaults).  Returns a dict with the parameters, the
+    phase pattern, the final cost, the metrics.field_metrics of the
+    output field and the run time in seconds.
+    """
+
+    import SLM_1 as slm
+    import wrapper
+    from engine import NumpyEngine
+
+    p = OrderedDict(default_parameters)
+    p.update(params)
+    if p['roisize'] is None:
+        p['roisize'] = min(sz)/2.
+
+    n = sz[0]
+    guess = slm.phase_guess(n, p['D'], p['asp'], p['R'], p['ang'],
+            p['B']).reshape(sz)
+
+    t0 = timeit.default_timer()
+    pattern = wrapper.run(sz, target, incident, p['roisize'], p['steepness'],
+            guess, nb_iter, **kwargs)
+    run_time = timeit.default_timer() - t0
+
+    # Score with the numpy engine, independent of the steepness
+    NT, T, S, Wcg = wrapper.prepare_problem(sz, target, incident,
+            p['roisize'])
+    eng = NumpyEngine(NT, T, Wcg, S, p['steepness'])
+    cost, _ = eng.evaluate(pattern.flatten(), gradient=False)
+
+    result = OrderedDict(params)
+    result['cost'] = float(cost)
+    for name, value in eng.metrics().items():
+        result[name] = float(value)
+    result['time'] = run_time
+    result['pattern'] = pattern
+    return result
+
+def _run_task(args):
+    index, params = args
+    w = _worker
+    try:
+        result = evaluate(w['sz'], w['target'], w['incident'], params,
+                w['nb_iter'], **w['kwargs'])
+    except Exception as e:
+        traceback.print_exc()
+        result = OrderedDict(params)
+        result['error'] = '{0}: {1}'.format(type(e).__name__, e)
+    return index, result
+
+def sweep(sz, target, incident, grid, nb_iter, processes=None, path=None,
+        score='fidelity', maximise=True, keep_patterns=False, **kwargs):
+    """ Run wrapper.run over a parameter grid on a process pool
+
+    Parameters
+      - sz, target, incident, nb_iter -- as for wrapper.run
+      - grid -- dict of parameter -> list of values, or a list of
+        parameter dicts (see parameter_grid and default_parameters)
+      - processes -- number of workers (default: cpu_count)
+      - path -- JSON lines file, each result is appended as it arrives
+      - score -- result column used to choose the best configuration
+      - maximise -- True if larger scores are better
+      - keep_patterns -- keep the phase pattern of every result in the
+        table (the best pattern is always returned)
+      - kwargs -- other arguments for wrapper.run (engine, dtype, ...)
+
+    Each worker uses one FFT thread.  Returns (best, table) where best
+    is the result dict (with 'pattern') of the best configuration and
+    table is the list of results in grid order.
+    """
+
+    if isinstance(grid, dict):
+        grid = parameter_grid(grid)
+    sz = tuple(sz)
+
+    shared = (shared_array(target), shared_array(incident))
+    pool = multiprocessing.Pool(processes, initializer=_init_worker,
+            initargs=(sz, shared[0], shared[1], nb_iter, kwargs))
+
+    table = [None]*len(grid)
+    best = None
+    fp = open(path, 'a') if path is not None else None
+    try:
+        for index, result in pool.imap_unordered(_run_task,
+                list(enumerate(grid))):
+
+            pattern = result.pop('pattern', None)
+            if fp is not None:
+                fp.write(json.dumps(result) + '\n')
+                fp.flush()
+
+            value = result.get(score)
+            if value is not None and (best is None
+                    or (value > best[score] if maximise
+                        else value < best[score])):
+                best = OrderedDict(result)
+                best['pattern'] = pattern
+
+            if keep_patterns:
+                result['pattern'] = pattern
+            table[index] = result
+
+        pool.close()
+    finally:
+        pool.terminate()
+        if fp is not None:
+            fp.close()
+
+    return best, table
@@ -0,0 +1,121 @@
+# Per-iteration telemetry for slm-cg optimisations
+#
+# A Telemetry object is passed to wrapper.run (telemetry=...) and
+# emits one record per optimiser iteration, to a JSON lines file
+# and/or a python callback.  Watch a running optimisation with
+#   tail -f telemetry.jsonl
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import json
+import timeit
+import collections
+import numpy as np
+import fft2
+
+class Telemetry(object):
+    """ Emits one record per iteration of an optimisation
+
+    Records are dicts with
+      - iteration, nevals -- iteration and number of evaluations
+      - cost, grad_norm -- cost and gradient norm at the iterate
+      - fidelity, efficiency, rms_error -- see metrics.field_metrics,
+        from the output field saved with the evaluation (no extra
+        FFTs).  Lists for batched problems, None if not available.
+      - time -- seconds since the start
+      - time_fft, time_elementwise, time_optimiser -- wall time of the
+        iteration in FFTs (fft2.fft2_call/ifft2_call), in the rest of
+        the cost and gradient evaluations and in the optimiser.
+
+    The time spent calculating the record itself is not included.
+    """
+
+    def __init__(self, callback=None, path=None, metrics=True, keep=None):
+        """ Create a new telemetry stream
+
+        Parameters
+          - callback -- called with each record dict
+          - path -- file name for JSON lines output (appended)
+          - metrics -- include fidelity, efficiency and rms_error
+          - keep -- number of recent records kept in self.records.
+            The default keeps all records without a path and none
+            with a path, so long streams to a file use no memory.
+        """
+
+        if keep is None:
+            keep = None if path is None else 0
+
+        self.callback = callback
+        self.path = path
+        self.metrics = metrics
+        self.records = collections.deque(maxlen=keep)
+        self._fp = None
+
+    def start(self, evaluator):
+        """ Start recording iterations of evaluator """
+
+        self.evaluator = evaluator
+        self.iteration = 0
+        self.start_time = timeit.default_timer()
+        self._mark()
+
+        if self.path is not None and self._fp is None:
+            self._fp = open(self.path, 'a')
+
+    def _mark(self):
+        # Reference times for the next iteration
+        self._wall = timeit.default_timer()
+        self._eval = self.evaluator.time
+        self._fft = fft2.fft_stats['time']
+
+    def record(self, x, cost=None):
+        """ Emit the record for the iterate x """
+
+        wall = timeit.default_timer() - self._wall
+        evaluate = self.evaluator.time - self._eval
+        fft = fft2.fft_stats['time'] - self._fft
+
+        value = self.evaluator(x)
+        if cost is None:
+            cost = value[0]
+
+        self.iteration += 1
+        rec = {'iteration': self.iteration,
+            'nevals': self.evaluator.nevals,
+            'cost': float(cost),
+            'grad_norm': float(np.linalg.norm(value[1])),
+            'time': self._wall + wall - self.start_time,
+            'time_fft': fft,
+            'time_elementwise': evaluate - fft,
+            'time_optimiser': wall - evaluate}
+
+        metrics = self.evaluator.metrics(x) if self.metrics else None
+        for name in ('fidelity', 'efficiency', 'rms_error'):
+            rec[name] = None if metrics is None \
+                    else np.asarray(metrics[name]).tolist()
+
+        self.records.append(rec)
+        if self._fp is not None:
+            self._fp.write(json.dumps(rec) + '\n')
+            self._fp.flush()
+        if self.callback is not None:
+            self.callback(rec)
+
+        self._mark()
+        return rec
+
+    def close(self):
+        """ Close the JSON lines file """
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+def as_telemetry(telemetry):
+    """ Telemetry for a Telemetry, callable, JSON lines file name or None """
+    if telemetry is None or isinstance(telemetry, Telemetry):
+        return telemetry
+    if callable(telemetry):
+        return Telemetry(callback=telemetry)
+    return Telemetry(path=telemetry)
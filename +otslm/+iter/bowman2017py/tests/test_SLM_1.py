@@ -0,0 +1,291 @@
+# Tests for the targets, grids and pattern cache in SLM_1.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import SLM_1 as slm
+
+class TestPatternCache(unittest.TestCase):
+
+    def setUp(self):
+        slm.clear_caches()
+        self.limits = (slm.grid_cache_bytes, slm.pattern_cache_bytes)
+
+    def tearDown(self):
+        slm.grid_cache_bytes, slm.pattern_cache_bytes = self.limits
+        slm.clear_caches()
+
+    def test_returns_copies(self):
+        a = slm.gaussian_ring(64, (32., 32.), 20., 2.)
+        b = slm.gaussian_ring(64, (32., 32.), 20., 2.)
+        self.assertTrue(a.flags.writeable)
+        self.assertTrue(b.flags.writeable)
+        self.assertFalse(np.shares_memory(a, b))
+        np.testing.assert_array_equal(a, b)
+
+        # Modifying a result does not change the cached pattern
+        a[...] = 0
+        np.testing.assert_array_equal(slm.gaussian_ring(64, (32., 32.),
+                20., 2.), b)
+
+    def test_tuple_results(self):
+        a, param = slm.phase_flat(16, 1., save_param=True)
+        b, _ = slm.phase_flat(16, 1., save_param=True)
+        self.assertFalse(np.shares_memory(a, b))
+        self.assertIsInstance(param, str)
+
+    def test_same_as_uncached(self):
+        a = slm.target_lg(64, (32., 32.), 5., 2, 1.)
+        slm.pattern_cache_bytes = 0
+        slm.clear_caches()
+        np.testing.assert_array_equal(slm.target_lg(64, (32., 32.), 5., 2,
+                1.), a)
+        self.assertEqual(len(slm._patterns), 0)
+
+    def test_bytes_limit(self):
+        n = 32
+        slm.pattern_cache_bytes = 3*n*n*8
+        for d in range(2, 12):
+            slm.gaussian_ring(n, (16., 16.), float(d), 2.)
+            self.assertLessEqual(sum(slm._nbytes(v)
+                    for v in slm._patterns.values()), slm.pattern_cache_bytes)
+        self.assertEqual(len(slm._patterns), 3)
+
+        # Patterns larger than the limit are not kept
+        slm.clear_caches()
+        slm.gaussian_ring(2*n, (16., 16.), 5., 2.)
+        self.assertEqual(len(slm._patterns), 0)
+
+    def test_out_and_arrays_not_cached(self):
+        out = np.empty((32, 32))
+        z = slm.target_ringlattice(32, (16., 16.), 2., 10., 6, out=out)
+        self.assertIs(z, out)
+        slm.target_squarelattice(32, np.array((16., 16.)), 2., 10., 3)
+        self.assertEqual(len(slm._patterns), 0)
+
+    def test_grid_bytes_limit(self):
+        n = 32
+        slm.grid_cache_bytes = 2*n*n*8
+        for x in range(5):
+            slm.coordinate_grid(n, (x, 0)).R
+        slm.coordinate_grid(n, (0, 1))
+        self.assertLessEqual(sum(g.nbytes for g in slm._grids.values()),
+                slm.grid_cache_bytes)
+
+    def test_lazy_grid_bytes_limit(self):
+        # R and theta count towards the limit when they are built
+        n = 32
+        slm.grid_cache_bytes = 3*n*n*8
+        grid = slm.coordinate_grid(n, (1, 0))
+        for x in range(4):
+            slm.coordinate_grid(n, (x, 0)).R
+            self.assertLessEqual(sum(g.nbytes for g in slm._grids.values()),
+                    slm.grid_cache_bytes)
+        grid.theta
+        grid.R
+        self.assertLessEqual(sum(g.nbytes for g in slm._grids.values()),
+                slm.grid_cache_bytes)
+
+    def test_grid_types(self):
+        # Integer grids for integer centres, separate from float grids
+        self.assertEqual(slm.coordinate_grid(8, (3, 2), dtype=int).X.dtype,
+                np.array(range(8)).dtype)
+        self.assertEqual(slm.coordinate_grid(8, (3., 2.), dtype=int).X.dtype,
+                np.float64)
+        self.assertEqual(slm.coordinate_grid(8, (3, 2)).X.dtype, np.float64)
+        self.assertEqual(len(slm._grids), 3)
+
+    def test_grid(self):
+        grid = slm.coordinate_grid(8, (3., 2.))
+        X, Y = np.meshgrid(np.arange(8.) - 3., np.arange(8.) - 2.)
+        np.testing.assert_array_equal(grid.X, X)
+        np.testing.assert_array_equal(grid.Y, Y)
+        np.testing.assert_allclose(grid.R, np.sqrt(X**2 + Y**2))
+        np.testing.assert_allclose(grid.theta, np.arctan2(X, Y))
+        self.assertFalse(grid.R.flags.writeable)
+
+# Generators before vectorisation, the current versions must give
+# bit-identical results
+
+def baseline_laser_gaussian(n, r0, sigmax, sigmay, A=1.0):
+    x = np.array(range(n)) - n/2
+    X, Y = np.meshgrid(x, x)
+    sigmax = np.power(2,0.5)*sigmax
+    sigmay = np.power(2,0.5)*sigmay
+    return A*np.exp( -2*(np.power((X-r0[0])/sigmax,2) + np.power((Y-r0[1])/sigmay,2) ) )
+
+def baseline_target_gaussian(n, r0, sigmax, sigmay, A=1.0):
+    x = np.array(range(n))
+    X, Y = np.meshgrid(x, x)
+    return A*np.exp( -2*(np.power((X-r0[0])/sigmax,2) + np.power((Y-r0[1])/sigmay,2) ) )
+
+def baseline_phase_guess(n, D, asp, R, ang, B):
+    x = np.array(range(n))*1 - n/2
+    X, Y = np.meshgrid(x, x)
+    KL = D*(X*np.cos(ang)+Y*np.sin(ang));
+    KQ = 3*R*((asp*(np.power(X,2))+(1-asp)*(np.power(Y,2))));
+    KC = B*np.power((np.power(X,2)+np.power(Y,2)),0.5);
+    return np.reshape(KC+KQ+KL, n**2)
+
+def baseline_ringlattice(n, r0, sigma, d, nb_spots=12.):
+    r = d/2
+    x = np.array(range(n))*1.
+    X, Y = np.meshgrid(x, x)
+    z = np.zeros((n,n))
+    delta_theta = 2*np.pi/nb_spots
+    for n0 in range(0,nb_spots):
+            x1 = r*np.cos(n0*delta_theta)
+            y1 = r*np.sin(n0*delta_theta)
+            spot = np.exp( - (np.power((((X-r0[0])+x1)/sigma),2) + np.power((((Y-r0[1])+y1)/sigma),2)))
+            z = z + spot
+    return z
+
+def baseline_squarelattice(n, r0, sigma, d, dim=6):
+    r0 = r0 + d/2 - 0.5*d/dim
+    x1 = np.arange(0,d,d/dim)
+    y1 = x1
+    x = np.array(range(n))*1.
+    X, Y = np.meshgrid(x, x)
+    z = np.zeros((n,n))
+    for n0 in range(0,dim):
+        for n1 in range (0,dim):
+            spot = np.exp( - (np.power((((X-r0[0])+x1[n0])/sigma),2) + np.power((((Y-r0[1])+y1[n1])/sigma),2)))
+            z = z + spot
+    return z
+
+def baseline_graphene(n, r0, l=35, A=1.):
+    z = np.zeros((n,n))
+    x = np.array(range(n))*1.
+    X, Y = np.meshgrid(x, x)
+    for i in range(0,6):
+        z = z+ A*(-1)**(i)*np.exp( 1j*2*np.pi/l*((X-r0[0])*np.cos(2*np.pi*i/6) + (Y-r0[1])*np.sin(2*np.pi*i/6)) )
+    return np.abs(z), np.angle(z)
+
+def baseline_ring_and_barrierM(n, r0, d, sigma):
+    x = np.array(range(n))*1. - n/2
+    X, Y = np.meshgrid(x, x)
+    XT = X+r0[0];
+    YT = Y+r0[1];
+    lambda_ratio = 670./1064;
+    x1=np.rint(r0[0]*(1/lambda_ratio));
+    y1=np.rint(r0[1]*(1/lambda_ratio));
+    d1 = (1/lambda_ratio)*d;
+    XT1 = X+x1;
+    YT1 = Y+y1;
+    sigmax = (1/lambda_ratio)*sigma;
+    sigmay = (1/lambda_ratio)*2*sigma;
+
+    p1 = 0.0001
+    M1 = np.exp( -((np.power(XT1,2)+np.power(YT1,2))/np.power(d,2)));
+    SR670 = np.ones(M1.shape)
+    SR670[np.abs(M1)<p1*M1.max()] = 0
+
+    p2 = 0.01
+    M2 = np.exp( -((np.power(XT,2)+np.power(YT,2))/np.power(d,2)));
+    SR1064 = np.ones(M2.shape)
+    SR1064[np.abs(M2)<p2*M2.max()] = 0
+
+    SR = SR670+SR1064;
+    for iter_n in range(0,len(SR)):
+        for iter_m in range(0,len(SR)):
+            if SR670[iter_n,iter_m]==SR1064[iter_n,iter_m]:
+                SR[iter_n,iter_m]=SR670[iter_n,iter_m]
+
+    Ring = np.exp( -np.power((np.power(np.power(XT,2)+np.power(YT,2),0.5)-d),2)/np.power(sigma,2));
+    Barrier = np.exp( -(np.power(XT1/sigmax,2) + (np.power((YT1-d1)/sigmay,2))));
+    return Ring + Barrier, SR, SR1064
+
+class TestVectorisedTargets(unittest.TestCase):
+
+    sizes = (32, 65, 128)
+
+    def setUp(self):
+        slm.clear_caches()
+
+    def assertIdentical(self, a, b):
+        self.assertEqual(np.shape(a), np.shape(b))
+        self.assertTrue(np.array_equal(a, b), 'results differ')
+
+    def test_gaussians(self):
+        # Integer arguments give the results of the integer grids
+        for n in self.sizes:
+            for r0, sigmax, sigmay, A in (((n//2, n//3), 5, 3, 1),
+                    ((n/2., n/3.), 5., 3.5, 2.), ((3, -5), 4, 4, 1.0)):
+                self.assertIdentical(slm.target_gaussian(n, r0, sigmax,
+                        sigmay, A), baseline_target_gaussian(n, r0, sigmax,
+                        sigmay, A))
+                self.assertIdentical(slm.laser_gaussian(n, r0, sigmax,
+                        sigmay, A), baseline_laser_gaussian(n, r0, sigmax,
+                        sigmay, A))
+
+    def test_phase_guess(self):
+        for n in self.sizes:
+            for args in ((0, 0.5, 0.003, 0, 0), (2, 1, 1, 0.5, 3),
+                    (1.5, 0.3, 0.01, 1., 0.2)):
+                self.assertIdentical(slm.phase_guess(n, *args),
+                        baseline_phase_guess(n, *args))
+
+    def test_ringlattice(self):
+        for n in self.sizes:
+            for r0, sigma, d, nb in (((n/2., n/2.), 2., n/4., 12),
+                    ((n/3., 0.6*n), 1.5, n/5., 7)):
+                expected = baseline_ringlattice(n, r0, sigma, d, nb)
+                self.assertIdentical(slm.target_ringlattice(n, r0, sigma, d,
+                        nb), expected)
+                out = np.empty((n, n))
+                slm.target_ringlattice(n, r0, sigma, d, nb, out=out)
+                self.assertIdentical(out, expected)
+
+    def test_squarelattice(self):
+        for n in self.sizes:
+            for r0, sigma, d, dim in ((np.array((n/2., n/2.)), 2., n/4., 6),
+                    (np.array((n/3., 0.4*n)), 1., n/3., 3)):
+                expected = baseline_squarelattice(n, r0, sigma, d, dim)
+                self.assertIdentical(slm.target_squarelattice(n, r0, sigma,
+                        d, dim), expected)
+                out = np.empty((n, n))
+                slm.target_squarelattice(n, r0, sigma, d, dim, out=out)
+                self.assertIdentical(out, expected)
+
+    def test_graphene(self):
+        for n in self.sizes:
+            for r0, l, A in (((n/2., n/2.), 35, 1.), ((n/3., 0.7*n), 12.5, 2.)):
+                expected = baseline_graphene(n, r0, l, A)
+                result = slm.graphene(n, r0, l, A)
+                self.assertIdentical(result[0], expected[0])
+                self.assertIdentical(result[1], expected[1])
+                out = np.empty((n, n))
+                slm.graphene(n, r0, l, A, out=out)
+                self.assertIdentical(out, expected[0])
+
+    def test_ring_and_barrierM(self):
+        for n in self.sizes:
+            for r0, d, sigma in (((0., 0.), n/4., 2.), ((3., -5.), n/6., 3.)):
+                expected = baseline_ring_and_barrierM(n, r0, d, sigma)
+                result = slm.ring_and_barrierM(n, r0, d, sigma)
+                for a, b in zip(result, expected):
+                    self.assertIdentical(a, b)
+
+    def test_lattice_spots(self):
+        n = 64
+        r0 = (n/2., n/2.)
+        z = slm.target_ringlattice(n, r0, 2., n/4., 12)
+        spots = np.rint(slm.ringlattice_spots(r0, n/4., 12)).astype(int)
+        self.assertEqual(spots.shape, (12, 2))
+        self.assertTrue(np.all(z[spots[:,1], spots[:,0]] > 0.9))
+
+        z = slm.target_squarelattice(n, np.array(r0), 2., n/4., 4)
+        spots = np.rint(slm.squarelattice_spots(r0, n/4., 4)).astype(int)
+        self.assertEqual(spots.shape, (16, 2))
+        self.assertTrue(np.all(z[spots[:,1], spots[:,0]] > 0.9))
+
+if __name__ == '__main__':
+    unittest.main()
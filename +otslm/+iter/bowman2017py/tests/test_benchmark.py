@@ -0,0 +1,44 @@
+# Tests for the benchmark suite in benchmark.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import benchmark
+
+try:
+    import theano
+except ImportError:
+    theano = None
+
+class TestSuite(unittest.TestCase):
+
+    def test_default_engines(self):
+        expected = ('numpy',) if theano is None else ('numpy', 'theano')
+        self.assertEqual(benchmark.default_engines(), expected)
+
+    def test_isolated_case(self):
+        result = benchmark.suite(sizes=(32,), backends=('numpy',),
+                dtypes=('float64',), targets=('gaussian_ring',),
+                engines=('numpy',), iterations=3, imports=False)
+        self.assertEqual(result['meta']['engines'], ['numpy'])
+        r, = result['results']
+        self.assertNotIn('error', r)
+        self.assertEqual(r['NT'], 32)
+        self.assertGreater(r['compile_time'], 0)
+        if r['peak_rss'] is not None:
+            self.assertLessEqual(r['peak_rss_increase'], r['peak_rss'])
+
+    def test_isolated_error(self):
+        r = benchmark.run_case_isolated(NT=32, backend='unknown',
+                dtype='float64', target='gaussian_ring', iterations=3)
+        self.assertIn('unknown', r['error'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,206 @@
+# Tests for the NumPy cost and gradient engine in engine.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+from engine import NumpyEngine, FusedEvaluator, region_of_interest
+from metrics import field_metrics
+
+try:
+    import theano
+except ImportError:
+    theano = None
+
+def random_problem(NT=16, batch=None, seed=0):
+    """ Target, weighting (zero outside a disc) and incident field """
+    rng = np.random.RandomState(seed)
+    lead = () if batch is None else (batch,)
+    n = NT//2
+    target = rng.rand(*(lead + (NT, NT))) * np.exp(2j*np.pi*rng.rand(
+            *(lead + (NT, NT))))
+    x = np.arange(NT) - NT/2.
+    Wcg = (np.add.outer(x**2, x**2) < (NT/4.)**2) * (0.5 + rng.rand(NT, NT))
+    incident = 0.5 + rng.rand(n, n)
+    phi = 2*np.pi*rng.rand(int(np.prod(lead + (n, n))))
+    return target, Wcg, incident, phi
+
+def reference_cost(NT, target, Wcg, incident, steepness, phi):
+    """ cost_SE from the shifted FFT of the padded SLM field """
+    n = NT//2
+    i0 = n//2
+    pad = np.zeros((NT, NT), dtype=complex)
+    pad[i0:i0+n, i0:i0+n] = incident*np.exp(1j*phi.reshape((n, n)))/NT
+    E = np.fft.ifftshift(np.fft.fft2(np.fft.fftshift(pad)))
+    overlap = np.real(np.sum(Wcg*np.conj(target)*E)) / np.sqrt(
+            np.sum(np.abs(target)**2) * np.sum(np.abs(Wcg*E)**2))
+    return np.power(10., steepness)*(1 - overlap)**2
+
+# Plain padded FFTs with shifts on the full output plane
+plain = dict(pruned=False, shift_free=False, roi=False)
+
+class TestNumpyEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.problem = random_problem()
+
+    def engine(self, **options):
+        target, Wcg, incident, phi = self.problem
+        return NumpyEngine(16, target, Wcg, incident, 2.0, **options)
+
+    def assertReferenceCost(self, **options):
+        target, Wcg, incident, phi = self.problem
+        expected = reference_cost(16, target, Wcg, incident, 2.0, phi)
+        self.assertAlmostEqual(self.engine(**options).cost(phi)/expected,
+                1.0, places=10, msg=str(options))
+
+    def assertFiniteDifference(self, **options):
+        phi = self.problem[-1]
+        eng = self.engine(**options)
+        cost, grad = eng.evaluate(phi)
+        h = 1e-6
+        for j in np.random.RandomState(1).randint(phi.size, size=5):
+            step = np.zeros(phi.size)
+            step[j] = h
+            fd = (eng.cost(phi + step) - eng.cost(phi - step))/(2*h)
+            self.assertAlmostEqual(fd, grad[j], delta=1e-6*max(1.0,
+                    abs(fd)), msg=str(options))
+
+    def assertSameAsPlain(self, **options):
+        phi = self.problem[-1]
+        ref = self.engine(**plain).evaluate(phi)
+        cost, grad = self.engine(**options).evaluate(phi)
+        self.assertAlmostEqual(cost/ref[0], 1.0, places=10, msg=str(options))
+        np.testing.assert_allclose(grad, ref[1], rtol=1e-8,
+                atol=1e-10*np.abs(ref[1]).max())
+
+    def test_reference_cost(self):
+        self.assertReferenceCost()
+        self.assertReferenceCost(**plain)
+
+    def test_finite_difference(self):
+        self.assertFiniteDifference()
+        self.assertFiniteDifference(**plain)
+
+    def test_pruned(self):
+        options = dict(plain, pruned=True)
+        self.assertReferenceCost(**options)
+        self.assertFiniteDifference(**options)
+        self.assertSameAsPlain(**options)
+
+    def test_shift_free(self):
+        for pruned in (False, True):
+            options = dict(plain, pruned=pruned, shift_free=True)
+            self.assertReferenceCost(**options)
+            self.assertFiniteDifference(**options)
+            self.assertSameAsPlain(**options)
+
+    def test_roi(self):
+        for pruned in (False, True):
+            for shift_free in (False, True):
+                options = dict(pruned=pruned, shift_free=shift_free, roi=True)
+                self.assertReferenceCost(**options)
+                self.assertFiniteDifference(**options)
+                self.assertSameAsPlain(**options)
+
+    def test_metrics(self):
+        # The same metrics for every variant, from the saved output field
+        target, Wcg, incident, phi = self.problem
+        full = self.engine(**plain)
+        full.evaluate(phi, gradient=False)
+        expected = field_metrics(full.output_field(full.E_out), target, Wcg,
+                np.sum(np.abs(incident)**2))
+        for pruned in (False, True):
+            for shift_free in (False, True):
+                for roi in (False, True):
+                    eng = self.engine(pruned=pruned, shift_free=shift_free,
+                            roi=roi)
+                    eng.evaluate(phi, gradient=False)
+                    result = eng.metrics()
+                    for name in ('fidelity', 'efficiency', 'rms_error'):
+                        self.assertAlmostEqual(result[name], expected[name],
+                                places=8, msg=name)
+
+    def test_region_of_interest(self):
+        Wcg = np.zeros((8, 8))
+        Wcg[2:4, 3:5] = 1
+        np.testing.assert_array_equal(region_of_interest(Wcg),
+                [19, 20, 27, 28])
+        self.assertIsNone(region_of_interest(Wcg, False))
+        self.assertIsNone(region_of_interest(np.ones((8, 8))))
+        self.assertEqual(len(region_of_interest(np.ones((8, 8)), True)), 64)
+
+    def test_float32(self):
+        target, Wcg, incident, phi = random_problem(NT=32)
+        ref = NumpyEngine(32, target, Wcg, incident, 3.0).evaluate(phi)
+        eng = NumpyEngine(32, target, Wcg, incident, 3.0, dtype='float32')
+        cost, grad = eng.evaluate(phi)
+        self.assertEqual(eng.cdtype, np.complex64)
+        self.assertEqual(grad.dtype, np.float64)
+        self.assertAlmostEqual(cost/ref[0], 1.0, places=4)
+        np.testing.assert_allclose(grad, ref[1], rtol=1e-3,
+                atol=1e-4*np.abs(ref[1]).max())
+
+    def test_batch(self):
+        B = 3
+        target, Wcg, incident, phi = random_problem(batch=B)
+        eng = NumpyEngine(16, target, Wcg, incident, 2.0)
+        cost, grad = eng.evaluate(phi)
+        size = phi.size//B
+        for b in range(B):
+            single = NumpyEngine(16, target[b], Wcg, incident, 2.0)
+            c, g = single.evaluate(phi[b*size:(b+1)*size])
+            self.assertAlmostEqual(eng.costs[b]/c, 1.0, places=10)
+            np.testing.assert_allclose(grad[b*size:(b+1)*size], g,
+                    rtol=1e-8, atol=1e-12)
+        self.assertAlmostEqual(cost/np.sum(eng.costs), 1.0, places=12)
+
+    def test_cost_only(self):
+        eng = self.engine()
+        cost, grad = eng.evaluate(self.problem[-1], gradient=False)
+        self.assertIsNone(grad)
+        self.assertEqual(cost, eng.cost(self.problem[-1]))
+
+    @unittest.skipIf(theano is None, 'theano is not installed')
+    def test_theano(self):
+        import wrapper
+        target, Wcg, incident, phi = self.problem
+        ev = wrapper.theano_functions(16, target, incident, Wcg, 2.0, phi,
+                pruned=False)
+        cost, grad = ev(phi)
+        ref = self.engine(**plain).evaluate(phi)
+        self.assertAlmostEqual(cost/ref[0], 1.0, places=8)
+        np.testing.assert_allclose(grad, ref[1], rtol=1e-6,
+                atol=1e-8*np.abs(ref[1]).max())
+
+class TestFusedEvaluator(unittest.TestCase):
+
+    def test_cache(self):
+        calls = []
+        def fn(phi):
+            calls.append(1)
+            return np.sum(phi**2), 2*phi
+        ev = FusedEvaluator(fn, state=lambda: len(calls),
+                metrics=lambda state: {'state': state})
+        x = np.arange(3.)
+        self.assertEqual(ev.cost(x), 5.)
+        np.testing.assert_array_equal(ev.grad(x), 2*x)
+        self.assertEqual(ev.nevals, 1)
+
+        # The key is copied, the optimiser may reuse the buffer
+        y = x.copy()
+        y[0] = 1.
+        self.assertEqual(ev.cost(y), 6.)
+        self.assertEqual(ev.cost(x), 5.)
+        self.assertEqual(ev.nevals, 2)
+        self.assertEqual(ev.metrics(x), {'state': 1})
+
+if __name__ == '__main__':
+    unittest.main()
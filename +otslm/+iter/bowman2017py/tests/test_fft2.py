@@ -0,0 +1,178 @@
+# Tests for the centred and pruned FFTs in fft2.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import shutil
+import pickle
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import fft2
+
+try:
+    import pyfftw
+except ImportError:
+    pyfftw = None
+
+def shifted_fft2(x):
+    return np.fft.ifftshift(np.fft.fft2(np.fft.fftshift(x, axes=(-2, -1))),
+            axes=(-2, -1))
+
+def shifted_ifft2(y):
+    return np.fft.fftshift(np.fft.ifft2(np.fft.ifftshift(y, axes=(-2, -1))),
+            axes=(-2, -1))
+
+def random_field(shape, seed=0):
+    rng = np.random.RandomState(seed)
+    return rng.randn(*shape) + 1j*rng.randn(*shape)
+
+class TestCentred(unittest.TestCase):
+
+    shapes = [(4, 4), (6, 6), (6, 4), (4, 6), (2, 8), (10, 4), (5, 4),
+            (3, 2, 6)]
+
+    def test_fft2_centred(self):
+        for shape in self.shapes:
+            x = random_field(shape)
+            for use in (True, False):
+                np.testing.assert_allclose(fft2.fft2_centred(x,
+                        use_shift_free=use), shifted_fft2(x), atol=1e-10,
+                        err_msg=str((shape, use)))
+
+    def test_ifft2_centred(self):
+        for shape in self.shapes:
+            y = random_field(shape)
+            for use in (True, False):
+                np.testing.assert_allclose(fft2.ifft2_centred(y,
+                        use_shift_free=use), shifted_ifft2(y), atol=1e-10,
+                        err_msg=str((shape, use)))
+
+    def test_overwrite(self):
+        for shape in self.shapes:
+            x = random_field(shape)
+            expected = shifted_fft2(x)
+            np.testing.assert_allclose(fft2.fft2_centred(x.copy(),
+                    overwrite_x=True), expected, atol=1e-10)
+
+    def test_shift_sign(self):
+        self.assertEqual(fft2.shift_sign((4, 4)), 1)
+        self.assertEqual(fft2.shift_sign((6, 4)), -1)
+        self.assertEqual(fft2.shift_sign((2, 6, 6)), 1)
+
+class TestPruned(unittest.TestCase):
+
+    def pad(self, x, NT):
+        n = x.shape[-1]
+        out = np.zeros(x.shape[:-2] + (NT, NT), dtype=complex)
+        i0 = n//2
+        out[..., i0:i0+n, i0:i0+n] = x
+        return out
+
+    def test_fft2_padded(self):
+        for n in (4, 5, 8):
+            NT = 2*n
+            x = random_field((2, n, n))
+            np.testing.assert_allclose(fft2.fft2_padded(x, NT),
+                    shifted_fft2(self.pad(x, NT)), atol=1e-10)
+            np.testing.assert_allclose(fft2.fft2_padded(x, NT, shift=False),
+                    np.fft.fft2(self.pad(x, NT)), atol=1e-10)
+
+    def test_ifft2_cropped(self):
+        for n in (4, 8):
+            NT = 2*n
+            i0 = n//2
+            y = random_field((NT, NT))
+            full = shifted_ifft2(y)*NT*NT
+            np.testing.assert_allclose(fft2.ifft2_cropped(y, n),
+                    full[i0:i0+n, i0:i0+n], atol=1e-8)
+
+            full = np.fft.ifft2(y)*NT*NT
+            np.testing.assert_allclose(fft2.ifft2_cropped(y, n, shift=False),
+                    full[i0:i0+n, i0:i0+n], atol=1e-8)
+
+            # Zero outside the support columns
+            y[:, :3] = 0
+            y[:, 7:] = 0
+            np.testing.assert_allclose(fft2.ifft2_cropped(y, n, shift=False,
+                    support=(3, 7)), np.fft.ifft2(y)[i0:i0+n, i0:i0+n]*NT*NT,
+                    atol=1e-8)
+
+    def test_adjoint(self):
+        n, NT = 6, 12
+        x = random_field((n, n), 1)
+        y = random_field((NT, NT), 2)
+        lhs = np.vdot(y, fft2.fft2_padded(x, NT))
+        rhs = np.vdot(fft2.ifft2_cropped(y, n), x)
+        self.assertAlmostEqual(lhs, rhs, places=8)
+
+@unittest.skipIf(pyfftw is None, 'pyfftw is not installed')
+class TestWisdom(unittest.TestCase):
+
+    def setUp(self):
+        self.wisdom_dir = tempfile.mkdtemp()
+        pyfftw.forget_wisdom()
+        pyfftw.interfaces.cache.disable()
+
+    def tearDown(self):
+        shutil.rmtree(self.wisdom_dir)
+        pyfftw.forget_wisdom()
+
+    def files(self):
+        return sorted(os.listdir(self.wisdom_dir))
+
+    def entries(self, name):
+        with open(os.path.join(self.wisdom_dir, name), 'rb') as fp:
+            return set(l for l in fp.read().splitlines()
+                    if l.startswith(b'  ('))
+
+    def test_default_effort(self):
+        fft, ifft = fft2.use_pyfftw(nthreads=1, wisdom_dir=self.wisdom_dir)
+        x = random_field((8, 8))
+        np.testing.assert_allclose(fft(x), np.fft.fft2(x), atol=1e-12)
+        self.assertEqual(self.files(),
+                ['fft2_' + fft2.wisdom_filename((8, 8), x.dtype, (-2, -1),
+                1, 'MEASURE')])
+
+        # Wisdom is also kept for ESTIMATE
+        fft, ifft = fft2.use_pyfftw(nthreads=1, effort='ESTIMATE',
+                wisdom_dir=self.wisdom_dir)
+        ifft(x)
+        self.assertEqual(len(self.files()), 2)
+
+    def test_keyed_files(self):
+        fft, ifft = fft2.use_pyfftw(nthreads=1, wisdom_dir=self.wisdom_dir)
+        fft(random_field((16, 16)))
+        first = self.files()
+        fft(random_field((12, 10)))
+        second = [f for f in self.files() if f not in first]
+        self.assertEqual(len(second), 1)
+
+        # Each file only has the wisdom of its own transform
+        a, b = self.entries(first[0]), self.entries(second[0])
+        self.assertTrue(a)
+        self.assertTrue(b)
+        self.assertFalse(a & b)
+
+        # Files are plain wisdom text which can be loaded again
+        pyfftw.forget_wisdom()
+        self.assertTrue(fft2.load_wisdom(os.path.join(self.wisdom_dir,
+                first[0])))
+        exported = set(pyfftw.export_wisdom()[0].splitlines())
+        self.assertTrue(a <= exported)
+
+    def test_no_pickle(self):
+        path = os.path.join(self.wisdom_dir, 'old.wisdom')
+        with open(path, 'wb') as fp:
+            pickle.dump(pyfftw.export_wisdom(), fp, protocol=2)
+        self.assertFalse(fft2.load_wisdom(path))
+        self.assertFalse(fft2.load_wisdom(path + '.missing'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+# Tests for the Gerchberg-Saxton initialiser in gs.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+from gs import GerchbergSaxton
+from engine import NumpyEngine
+
+def ring_problem(n=32):
+    """ Normalised ring target in a disc region, as wrapper.prepare_problem """
+    NT = 2*n
+    x = np.arange(NT) - NT/2.
+    R = np.sqrt(np.add.outer(x**2, x**2))
+    Wcg = (R < n/2.)*1.
+    target = np.exp(-(R - n/4.)**2/4.)*Wcg + 0j
+    incident = np.ones((n, n))
+    target *= np.sqrt(np.sum(incident**2)/np.sum(np.abs(target)**2))
+    return NT, target, Wcg, incident
+
+def fidelity(NT, target, Wcg, incident, phi):
+    eng = NumpyEngine(NT, target, Wcg, incident, 9.0)
+    eng.evaluate(phi, gradient=False)
+    return eng.metrics()['fidelity']
+
+class TestGerchbergSaxton(unittest.TestCase):
+
+    def setUp(self):
+        self.problem = ring_problem()
+        n = self.problem[0]//2
+        self.phi = np.random.RandomState(0).uniform(0, 2*np.pi, n*n)
+
+    def test_improves(self):
+        start = fidelity(*(self.problem + (self.phi,)))
+        for options in (dict(), dict(weighted=True), dict(mixing=1.0),
+                dict(adaptive=0.8)):
+            solver = GerchbergSaxton(*self.problem, **options)
+            phi = solver.run(self.phi, 10)
+            self.assertEqual(phi.shape, self.phi.shape)
+            self.assertGreater(fidelity(*(self.problem + (phi,))),
+                    start + 0.2, msg=str(options))
+
+    def test_weighted_spots(self):
+        # Weighted GS evens out the spots of an intensity target
+        NT, target, Wcg, incident = self.problem
+        theta = 2*np.pi*np.arange(8)/8
+        rows = NT//2 + np.round(NT/8.*np.sin(theta)).astype(int)
+        cols = NT//2 + np.round(NT/8.*np.cos(theta)).astype(int)
+        spots = np.zeros((NT, NT), dtype=complex)
+        spots[rows, cols] = 1
+
+        spread = []
+        for weighted in (False, True):
+            solver = GerchbergSaxton(NT, spots, Wcg, incident,
+                    weighted=weighted, free_phase=True)
+            solver.iteration(solver.run(self.phi, 20))
+            I = np.abs(solver.E_out[rows, cols])**2
+            spread.append((I.max() - I.min())/(I.max() + I.min()))
+        self.assertLess(spread[1], 0.05)
+        self.assertLess(spread[1], spread[0])
+
+    def test_metrics(self):
+        # metrics are of the phase given to the last iteration
+        solver = GerchbergSaxton(*self.problem)
+        phi = solver.run(self.phi, 3)
+        last = solver.run(phi, 1)
+        self.assertAlmostEqual(solver.metrics()['fidelity'],
+                fidelity(*(self.problem + (phi,))), places=10)
+        self.assertFalse(np.allclose(last, phi))
+
+    def test_variants_agree(self):
+        ref = GerchbergSaxton(*self.problem, pruned=False,
+                shift_free=False).run(self.phi, 3)
+        for pruned in (True, False):
+            phi = GerchbergSaxton(*self.problem, pruned=pruned).run(
+                    self.phi, 3)
+            np.testing.assert_allclose(np.exp(1j*phi), np.exp(1j*ref),
+                    atol=1e-8)
+
+    def test_batch(self):
+        NT, target, Wcg, incident = self.problem
+        phis = np.stack([self.phi, self.phi[::-1]])
+        solver = GerchbergSaxton(NT, np.stack([target, target]), Wcg,
+                incident, weighted=True)
+        result = solver.run(phis.flatten(), 3).reshape(phis.shape)
+        for b in range(2):
+            single = GerchbergSaxton(*self.problem, weighted=True).run(
+                    phis[b], 3)
+            np.testing.assert_allclose(np.exp(1j*result[b]),
+                    np.exp(1j*single), atol=1e-8)
+
+if __name__ == '__main__':
+    unittest.main()
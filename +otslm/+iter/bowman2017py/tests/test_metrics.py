@@ -0,0 +1,74 @@
+# Tests for the error metrics in metrics.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        shape = (3, 16, 16)
+        self.E = rng.randn(*shape) + 1j*rng.randn(*shape)
+        self.T = rng.rand(16, 16)*np.exp(2j*np.pi*rng.rand(16, 16))
+        self.W = (rng.rand(16, 16) > 0.3)*1.
+
+    def test_perfect(self):
+        E = (2 - 1j)*self.T
+        result = metrics.field_metrics(E, self.T, self.W)
+        self.assertAlmostEqual(result['fidelity'], 1.0, places=12)
+        self.assertAlmostEqual(result['rms_error'], 0.0, places=12)
+        self.assertAlmostEqual(result['efficiency'], np.sum(np.abs(
+                self.T*self.W)**2)/np.sum(np.abs(self.T)**2), places=12)
+
+    def test_stack(self):
+        # Stacks of fields give the values of each field
+        result = metrics.field_metrics(self.E, self.T, self.W,
+                phase=np.angle(self.T))
+        for b in range(len(self.E)):
+            single = metrics.field_metrics(self.E[b], self.T, self.W,
+                    phase=np.angle(self.T))
+            for name in single:
+                self.assertAlmostEqual(result[name][b], single[name],
+                        places=12, msg=name)
+
+    def test_fidelity(self):
+        TW = self.T*self.W
+        EW = self.E[0]*self.W
+        expected = np.abs(np.vdot(EW, TW))**2 / (np.vdot(TW, TW).real
+                * np.vdot(EW, EW).real)
+        self.assertAlmostEqual(metrics.fidelity(self.E[0], self.T, self.W),
+                expected, places=12)
+
+    def test_rms_error_zero_target(self):
+        # Pixels with a zero target are ignored
+        T = np.ones((4, 4))
+        T[0, 0] = 0
+        I_out = np.ones((4, 4))
+        I_out[0, 0] = 5
+        W = np.ones((4, 4))
+        value = metrics.rms_error(I_out, T, W)
+        self.assertTrue(np.isfinite(value))
+        I_out_w = I_out/I_out.sum()
+        expected = np.sqrt(15*(I_out_w[1, 1]*15 - 1)**2/16)
+        self.assertAlmostEqual(value, expected, places=12)
+
+    def test_float32(self):
+        result = metrics.field_metrics(self.E.astype('complex64'),
+                self.T.astype('complex64'), self.W.astype('float32'))
+        expected = metrics.field_metrics(self.E, self.T, self.W)
+        for name in expected:
+            np.testing.assert_allclose(result[name], expected[name],
+                    rtol=1e-4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# Tests for the instrumentation in profiling.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import json
+import atexit
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import profiling
+from engine import NumpyEngine
+from test_engine import random_problem
+
+class TestProfiling(unittest.TestCase):
+
+    def setUp(self):
+        self.state = (profiling.enabled, profiling.trace_path,
+                profiling.max_samples, profiling.max_events)
+        self.tmpdir = tempfile.mkdtemp()
+        profiling.reset()
+
+    def tearDown(self):
+        (profiling.enabled, profiling.trace_path, profiling.max_samples,
+                profiling.max_events) = self.state
+        profiling.reset()
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, name, count, out_bytes=0):
+        for i in range(count):
+            profiling.stop(name, profiling.start(), out_bytes)
+
+    def test_disabled(self):
+        profiling.disable()
+        self.assertIsNone(profiling.start())
+        self.record('section', 3)
+        self.assertEqual(profiling.summary(), {})
+
+    def test_bounded(self):
+        profiling.enable()
+        profiling.max_samples = 5
+        profiling.max_events = 7
+        profiling.reset()
+        self.record('section', 20, 8)
+        stats = profiling.summary()['section']
+        self.assertEqual(stats['calls'], 20)
+        self.assertEqual(stats['out_bytes'], 160)
+        self.assertGreaterEqual(stats['max'], stats['p99'])
+        self.assertEqual(len(profiling._durations['section']), 5)
+        self.assertEqual(len(profiling._events), 7)
+
+    def test_output_bytes(self):
+        profiling.enable()
+        target, Wcg, incident, phi = random_problem()
+        eng = NumpyEngine(16, target, Wcg, incident, 2.0)
+        E_out = eng.forward(eng.incident_field(phi))
+        s = eng.adjoint(E_out)
+        stats = profiling.summary()
+        self.assertEqual(stats['NumpyEngine.forward']['out_bytes'],
+                E_out.nbytes)
+        self.assertEqual(stats['NumpyEngine.adjoint']['out_bytes'], s.nbytes)
+
+    def test_dump(self):
+        path = os.path.join(self.tmpdir, 'trace.json')
+        profiling.enable(path)
+        self.record('section', 3)
+        profiling.dump()
+        self.assertEqual(profiling.summary(), {})
+        with open(path) as fp:
+            events = json.load(fp)['traceEvents']
+        self.assertEqual([e['name'] for e in events], ['section']*3)
+
+        # Nothing recorded, the trace is kept
+        profiling.dump()
+        self.assertTrue(os.path.exists(path))
+
+    def test_enable_registers_dump(self):
+        registered = []
+        register = atexit.register
+        atexit.register = registered.append
+        try:
+            profiling._registered = False
+            profiling.enable()
+            profiling.enable()
+        finally:
+            atexit.register = register
+        self.assertEqual(registered, [profiling.dump])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+# Tests for the spot array problem in spots.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import spots
+from spots import SpotArray
+
+def ring_spots(n, nb_spots=8):
+    """ Spots on a circle, at pixel positions of the target image """
+    theta = 2*np.pi*np.arange(nb_spots)/nb_spots
+    return np.round(np.stack([n/2. + n/4.*np.cos(theta),
+            n/2. + n/4.*np.sin(theta)], axis=1))
+
+def full_field(n, incident, phi):
+    """ Shifted FFT of the padded SLM field, the slm-cg output plane """
+    NT = 2*n
+    i0 = n//2
+    pad = np.zeros((NT, NT), dtype=complex)
+    pad[i0:i0+n, i0:i0+n] = incident*np.exp(1j*phi.reshape((n, n)))/NT
+    return np.fft.ifftshift(np.fft.fft2(np.fft.fftshift(pad)))
+
+class TestSpotArray(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.n = n = 16
+        self.incident = 0.5 + rng.rand(n, n)
+        self.phi = 2*np.pi*rng.rand(n*n)
+        self.spots = ring_spots(n)
+        self.amplitudes = 1 + 0.5*rng.rand(len(self.spots))
+
+    def problem(self, direct, **kwargs):
+        return SpotArray(self.n, self.spots, self.incident,
+                amplitudes=self.amplitudes, steepness=2.0, direct=direct,
+                **kwargs)
+
+    def test_forward(self):
+        E = full_field(self.n, self.incident, self.phi)
+        p = self.spots[:, ::-1].astype(int) + self.n//2
+        expected = E[p[:, 0], p[:, 1]]
+        for direct in (True, False):
+            problem = self.problem(direct)
+            result = problem.forward(problem.incident_field(self.phi))
+            np.testing.assert_allclose(result, expected, rtol=1e-10,
+                    atol=1e-12)
+
+    def test_adjoint(self):
+        rng = np.random.RandomState(2)
+        for direct in (True, False):
+            problem = self.problem(direct)
+            x = rng.randn(self.n, self.n) + 1j*rng.randn(self.n, self.n)
+            G = rng.randn(len(self.spots)) + 1j*rng.randn(len(self.spots))
+            lhs = np.vdot(G, problem.forward(x))
+            rhs = np.vdot(problem.adjoint(G), x)
+            self.assertAlmostEqual(abs(lhs - rhs)/abs(lhs), 0.0, places=10)
+
+    def test_finite_difference(self):
+        rng = np.random.RandomState(1)
+        h = 1e-6
+        for direct in (True, False):
+            problem = self.problem(direct)
+            cost, grad = problem.evaluate(self.phi)
+            for j in rng.randint(self.phi.size, size=5):
+                step = np.zeros(self.phi.size)
+                step[j] = h
+                fd = (problem.cost(self.phi + step)
+                        - problem.cost(self.phi - step))/(2*h)
+                self.assertAlmostEqual(fd, grad[j], delta=1e-6*max(1.0,
+                        abs(fd)))
+
+    def test_sub_pixel(self):
+        # The direct DFT is continuous in the spot position
+        shifted = self.spots + 0.25
+        a = SpotArray(self.n, shifted, self.incident, direct=True)
+        E = a.forward(a.incident_field(self.phi))
+        b = SpotArray(self.n, self.spots, self.incident, direct=True)
+        E0 = b.forward(b.incident_field(self.phi))
+        self.assertFalse(np.allclose(E, E0))
+        self.assertTrue(np.all(np.isfinite(E)))
+
+    def test_float32(self):
+        ref = self.problem(True).evaluate(self.phi)
+        for direct in (True, False):
+            cost, grad = self.problem(direct, dtype='float32').evaluate(
+                    self.phi)
+            self.assertAlmostEqual(cost/ref[0], 1.0, places=4)
+            np.testing.assert_allclose(grad, ref[1], rtol=1e-3,
+                    atol=1e-3*np.abs(ref[1]).max())
+
+    def test_wgs(self):
+        problem = SpotArray(self.n, self.spots, np.ones((self.n, self.n)))
+        phi = problem.wgs(self.phi, 30)
+        problem.evaluate(phi, gradient=False)
+        result = problem.metrics()
+        self.assertGreater(result['uniformity'], 0.95)
+        self.assertGreater(result['fidelity'], 0.99)
+
+    def test_direct_max_spots(self):
+        self.assertTrue(SpotArray(self.n, self.spots, self.incident).direct)
+        many = np.stack(np.meshgrid(np.arange(4, 12), np.arange(4, 12)),
+                axis=-1).reshape((-1, 2))
+        self.assertGreater(len(many), spots.direct_max_spots(2*self.n))
+        self.assertFalse(SpotArray(self.n, many, self.incident).direct)
+
+if __name__ == '__main__':
+    unittest.main()
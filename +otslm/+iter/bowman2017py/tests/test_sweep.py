@@ -0,0 +1,80 @@
+# Tests for the parameter sweeps in sweep.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import sweep
+from test_wrapper import ring_problem
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parameter_grid(self):
+        grid = sweep.parameter_grid({'R': [1, 2], 'steepness': [7, 8, 9],
+                'extra': ['a']})
+        self.assertEqual(len(grid), 6)
+        self.assertEqual(list(grid[0].keys()), ['steepness', 'R', 'extra'])
+        self.assertEqual([(p['steepness'], p['R']) for p in grid[:3]],
+                [(7, 1), (7, 2), (8, 1)])
+
+    def test_shared_array(self):
+        for a in (np.arange(6.).reshape((2, 3)),
+                np.arange(4.).reshape((2, 2)) + 1j):
+            b = sweep.from_shared(sweep.shared_array(a))
+            self.assertEqual(b.dtype, a.dtype)
+            np.testing.assert_array_equal(b, a)
+
+    def test_sweep(self):
+        sz, target, incident, roisize, guess = ring_problem()
+        path = os.path.join(self.tmpdir, 'sweep.jsonl')
+        grid = {'steepness': [8.0, 9.0], 'R': [0.002, 0.003]}
+        best, table = sweep.sweep(sz, target, incident, grid, 5,
+                processes=1, path=path, engine='numpy')
+
+        self.assertEqual(len(table), 4)
+        for params, result in zip(sweep.parameter_grid(grid), table):
+            self.assertNotIn('error', result)
+            self.assertNotIn('pattern', result)
+            for name, value in params.items():
+                self.assertEqual(result[name], value)
+
+        self.assertEqual(best['fidelity'], max(r['fidelity'] for r in table))
+        self.assertEqual(best['pattern'].shape, sz)
+
+        # Same values as a single evaluation
+        single = sweep.evaluate(sz, target, incident, table[0], 5,
+                engine='numpy')
+        self.assertAlmostEqual(single['fidelity'], table[0]['fidelity'],
+                places=10)
+
+        with open(path) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(len(records), 4)
+
+    def test_errors(self):
+        # Failed runs are recorded and do not stop the sweep
+        sz, target, incident, roisize, guess = ring_problem()
+        best, table = sweep.sweep(sz, target, incident,
+                [{'steepness': 9.0}, {'steepness': 9.0, 'roisize': 16.}], 2,
+                processes=1, engine='fortran')
+        self.assertIsNone(best)
+        self.assertTrue(all('error' in r for r in table))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Tests for the per-iteration telemetry stream in telemetry.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import wrapper
+from telemetry import Telemetry, as_telemetry
+from test_wrapper import ring_problem
+
+def optimise(telemetry, nb_iter=10):
+    sz, target, incident, roisize, guess = ring_problem()
+    wrapper.run(sz, target, incident, roisize, 9.0, guess, nb_iter,
+            engine='numpy', telemetry=telemetry)
+
+class TestTelemetry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'telemetry.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_records(self):
+        calls = []
+        telemetry = Telemetry(callback=calls.append)
+        optimise(telemetry)
+        self.assertEqual(list(telemetry.records), calls)
+        self.assertEqual(calls[-1]['iteration'], len(calls))
+
+    def test_file_keeps_no_records(self):
+        telemetry = as_telemetry(self.path)
+        optimise(telemetry)
+        telemetry.close()
+        self.assertEqual(len(telemetry.records), 0)
+        with open(self.path) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertGreater(len(records), 1)
+        self.assertEqual(records[-1]['iteration'], len(records))
+
+    def test_keep(self):
+        telemetry = Telemetry(path=self.path, keep=3)
+        optimise(telemetry)
+        telemetry.close()
+        with open(self.path) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertEqual(list(telemetry.records), records[-3:])
+
+if __name__ == '__main__':
+    unittest.main()
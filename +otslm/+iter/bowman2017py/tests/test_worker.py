@@ -0,0 +1,173 @@
+# Tests for the persistent worker in worker.py
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import stat
+import socket
+import shutil
+import tempfile
+import threading
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import worker
+import wrapper
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+from test_wrapper import ring_problem
+
+def free_port():
+    s = socket.socket()
+    s.bind(('localhost', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def start_worker(address):
+    """ Run worker.serve in a thread, returns once it answers a ping """
+    thread = threading.Thread(target=worker.serve, args=(address,))
+    thread.daemon = True
+    thread.start()
+    for i in range(200):
+        # The worker writes the key file before it listens
+        if os.path.exists(worker.key_file()) and worker.ping(address):
+            break
+        thread.join(0.05)
+    return thread
+
+class TestWorker(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.keydir = tempfile.mkdtemp()
+        cls.environ = dict(os.environ)
+        os.environ.pop('OTSLM_WORKER_AUTHKEY', None)
+        os.environ['OTSLM_WORKER_KEYFILE'] = os.path.join(cls.keydir,
+                'worker.key')
+
+        cls.address = ('localhost', free_port())
+        cls.thread = start_worker(cls.address)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.thread.is_alive():
+            worker.shutdown(cls.address)
+        cls.thread.join(10)
+        os.environ.clear()
+        os.environ.update(cls.environ)
+        shutil.rmtree(cls.keydir)
+
+    def test_ping(self):
+        self.assertTrue(worker.ping(self.address))
+        self.assertFalse(worker.ping(('localhost', free_port())))
+
+    def test_key_file(self):
+        mode = os.stat(worker.key_file()).st_mode
+        if os.name == 'posix':
+            self.assertEqual(stat.S_IMODE(mode) & 0o077, 0)
+        self.assertEqual(worker.authkey(), worker.authkey(create=True))
+
+    def test_submit(self):
+        sz, target, incident, roisize, guess = ring_problem()
+        pattern = worker.submit(sz, target, incident, roisize, 9.0, guess, 5,
+                address=self.address, engine='numpy')
+        expected = wrapper.run(sz, target, incident, roisize, 9.0, guess, 5,
+                engine='numpy')
+        np.testing.assert_array_equal(pattern, expected)
+
+    def test_job_error(self):
+        # Failed jobs are reported, the worker keeps serving
+        with self.assertRaises(RuntimeError):
+            worker._request(self.address, {'cmd': 'unknown'})
+        self.assertTrue(worker.ping(self.address))
+
+    def test_bad_connections(self):
+        # Plain sockets and wrong keys do not stop the worker
+        s = socket.create_connection(self.address)
+        s.close()
+        s = socket.create_connection(self.address)
+        s.sendall(b'not a handshake')
+        s.close()
+        with self.assertRaises(AuthenticationError):
+            Client(self.address, authkey=b'wrong key')
+        self.assertTrue(worker.ping(self.address))
+
+    def test_silent_client(self):
+        # A client which connects and never sends does not block others
+        s = socket.create_connection(self.address)
+        try:
+            sz, target, incident, roisize, guess = ring_problem()
+            pattern = worker.submit(sz, target, incident, roisize, 9.0,
+                    guess, 2, address=self.address, engine='numpy')
+            self.assertEqual(pattern.shape, sz)
+        finally:
+            s.close()
+
+class TestShutdown(unittest.TestCase):
+
+    def test_shutdown(self):
+        keydir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        os.environ.pop('OTSLM_WORKER_AUTHKEY', None)
+        os.environ['OTSLM_WORKER_KEYFILE'] = os.path.join(keydir,
+                'worker.key')
+        try:
+            address = ('localhost', free_port())
+            thread = start_worker(address)
+            self.assertTrue(worker.ping(address))
+            worker.shutdown(address)
+            thread.join(10)
+            self.assertFalse(thread.is_alive())
+            self.assertFalse(worker.ping(address))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(keydir)
+
+class TestAuthkey(unittest.TestCase):
+
+    def setUp(self):
+        self.keydir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop('OTSLM_WORKER_AUTHKEY', None)
+        os.environ['OTSLM_WORKER_KEYFILE'] = os.path.join(self.keydir,
+                'worker.key')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.keydir)
+
+    def test_no_default_key(self):
+        with self.assertRaises(RuntimeError):
+            worker.authkey()
+        self.assertFalse(worker.ping(('localhost', free_port())))
+        key = worker.authkey(create=True)
+        self.assertGreaterEqual(len(key), 32)
+
+        # The key is kept, a new key file has a new key
+        self.assertEqual(worker.authkey(create=True), key)
+        self.assertEqual(os.listdir(self.keydir), ['worker.key'])
+        os.remove(worker.key_file())
+        self.assertNotEqual(worker.authkey(create=True), key)
+
+    def test_environment(self):
+        os.environ['OTSLM_WORKER_AUTHKEY'] = 'secret'
+        self.assertEqual(worker.authkey(), b'secret')
+        self.assertFalse(os.path.exists(worker.key_file()))
+
+    @unittest.skipIf(os.name != 'posix', 'file modes are posix only')
+    def test_readable_key_file(self):
+        worker.authkey(create=True)
+        os.chmod(worker.key_file(), 0o644)
+        with self.assertRaises(RuntimeError):
+            worker.authkey()
+
+if __name__ == '__main__':
+    unittest.main()
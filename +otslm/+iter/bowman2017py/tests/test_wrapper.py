@@ -0,0 +1,241 @@
+# Tests for the optimisation drivers in wrapper.py (numpy engine)
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir))
+import SLM_1 as slm
+import wrapper
+from engine import NumpyEngine
+from spots import SpotArray
+
+try:
+    import theano
+except ImportError:
+    theano = None
+
+def ring_problem(n=32):
+    sz = (n, n)
+    target = slm.gaussian_ring(n, (n/2., n/2.), d=n/4.,
+            sigma=2.).astype('complex128')
+    incident = np.ones(sz)
+    guess = slm.phase_guess(n, 0, 0.5, 0.003, 0, 0).reshape(sz)
+    return sz, target, incident, n/2., guess
+
+def fidelity(sz, target, incident, roisize, pattern):
+    NT, T, S, Wcg = wrapper.prepare_problem(sz, target, incident, roisize)
+    eng = NumpyEngine(NT, T, Wcg, S, 9.0)
+    eng.evaluate(pattern.flatten(), gradient=False)
+    return eng.metrics()['fidelity']
+
+class TestSequence(unittest.TestCase):
+
+    def frames(self, n, count):
+        for i in range(count):
+            yield slm.gaussian_ring(n, (n/2. + i, n/2.), d=n/4.,
+                    sigma=2.).astype('complex128')
+
+    def test_warm_start(self):
+        sz, target, incident, roisize, guess = ring_problem()
+        patterns = list(wrapper.run_sequence(sz, self.frames(sz[0], 3),
+                incident, roisize, 9.0, guess, 5, first_iter=30,
+                engine='numpy'))
+        self.assertEqual(len(patterns), 3)
+        for target, pattern in zip(self.frames(sz[0], 3), patterns):
+            self.assertEqual(pattern.shape, sz)
+            self.assertGreater(fidelity(sz, target, incident, roisize,
+                    pattern), 0.5)
+
+    def test_time_limit(self):
+        # time_limit is accepted as an alias of frame_time
+        sz, target, incident, roisize, guess = ring_problem()
+        patterns = list(wrapper.run_sequence(sz, self.frames(sz[0], 2),
+                incident, roisize, 9.0, guess, 5, engine='numpy',
+                time_limit=60., levels=2, gs_iter=2))
+        self.assertEqual(len(patterns), 2)
+
+class TestRun(unittest.TestCase):
+
+    def setUp(self):
+        self.problem = ring_problem()
+        sz, target, incident, roisize, guess = self.problem
+        self.start = fidelity(sz, target, incident, roisize, guess)
+
+    def optimise(self, nb_iter, **kwargs):
+        sz, target, incident, roisize, guess = self.problem
+        kwargs.setdefault('engine', 'numpy')
+        return wrapper.run(sz, target, incident, roisize, 9.0, guess,
+                nb_iter, **kwargs)
+
+    def check(self, pattern, margin=0.2):
+        sz, target, incident, roisize, guess = self.problem
+        self.assertEqual(pattern.shape, sz)
+        value = fidelity(sz, target, incident, roisize, pattern)
+        self.assertGreater(value, self.start + margin)
+        return value
+
+    def test_numpy(self):
+        self.check(self.optimise(20))
+
+    def test_methods(self):
+        for method in wrapper.optimisers:
+            self.check(self.optimise(20, method=method))
+
+    def test_momentum_convergence(self):
+        # The default momentum step converges as fast as CG
+        cg = self.check(self.optimise(30))
+        momentum = self.check(self.optimise(30, method='momentum'))
+        self.assertGreater(momentum, 0.85)
+        self.assertGreater(momentum, cg - 0.1)
+        self.assertGreater(self.check(self.optimise(100, method='momentum')),
+                0.99)
+
+    def test_precision(self):
+        single = self.check(self.optimise(20, dtype='float32'))
+        double = self.check(self.optimise(20))
+        self.assertAlmostEqual(single, double, places=2)
+
+    def test_pruned(self):
+        a = self.optimise(10, pruned=True)
+        b = self.optimise(10, pruned=False)
+        np.testing.assert_allclose(np.exp(1j*a), np.exp(1j*b), atol=1e-6)
+
+    def test_pyramid(self):
+        self.check(self.optimise(10, levels=2))
+        self.check(self.optimise(10, levels=3, level_iter=[20, 10, 5]))
+
+    def test_gs_iter(self):
+        self.check(self.optimise(5, gs_iter=5))
+        sz, target, incident, roisize, guess = self.problem
+        self.check(wrapper.gs_phase(sz, target, incident, roisize, 10,
+                guess=guess))
+
+    def test_tolerances(self):
+        # Early stopping is off by default
+        records = []
+        self.optimise(20, method='momentum', telemetry=records.append)
+        self.assertEqual(len(records), 21)
+        self.assertEqual([r['iteration'] for r in records],
+                list(range(1, 22)))
+
+        records = []
+        self.optimise(20, method='momentum', telemetry=records.append,
+                gain_tol=1.0, patience=3)
+        self.assertEqual(len(records), 4)
+
+    def test_unknown_engine(self):
+        with self.assertRaises(ValueError):
+            self.optimise(1, engine='fortran')
+
+    @unittest.skipIf(theano is None, 'theano is not installed')
+    def test_theano(self):
+        a = self.optimise(10, engine='theano')
+        b = self.optimise(10)
+        np.testing.assert_allclose(np.exp(1j*a), np.exp(1j*b), atol=1e-4)
+
+class TestPhaseResampling(unittest.TestCase):
+
+    def test_inverse(self):
+        phi = np.add.outer(0.3*np.arange(8), -0.2*np.arange(8))
+        for f in (2, 4):
+            up = wrapper.upsample_phase(phi, f)
+            self.assertEqual(up.shape, (8*f, 8*f))
+            # Linear phases keep their gradient in radians per pixel
+            np.testing.assert_allclose(np.diff(up, axis=0), 0.3)
+            np.testing.assert_allclose(wrapper.downsample_phase(up, f), phi,
+                    atol=1e-12)
+
+class TestBatch(unittest.TestCase):
+
+    def test_batch(self):
+        sz, target, incident, roisize, guess = ring_problem()
+        targets = np.stack([target, np.roll(target, 3, axis=1)])
+        guesses = np.stack([guess, guess])
+        starts = [fidelity(sz, t, incident, roisize, guess)
+                for t in targets]
+        patterns = wrapper.run_batch(sz, targets, incident, roisize, 9.0,
+                guesses, 20)
+        self.assertEqual(patterns.shape, (2,) + sz)
+        for t, p, start in zip(targets, patterns, starts):
+            self.assertGreater(fidelity(sz, t, incident, roisize, p),
+                    start + 0.2)
+
+class TestSpots(unittest.TestCase):
+
+    def test_run_spots(self):
+        n = 32
+        spots = slm.ringlattice_spots((n/2., n/2.), n/4., 8)
+        guess = np.random.RandomState(0).uniform(0, 2*np.pi, (n, n))
+        for options in (dict(), dict(method='cg', wgs_iter=5),
+                dict(direct=False)):
+            pattern = wrapper.run_spots((n, n), spots, np.ones((n, n)),
+                    guess, 20, **options)
+            self.assertEqual(pattern.shape, (n, n))
+            problem = SpotArray(n, spots, np.ones((n, n)))
+            problem.evaluate(pattern.flatten(), gradient=False)
+            result = problem.metrics()
+            self.assertGreater(result['fidelity'], 0.95, msg=str(options))
+
+    def test_non_square(self):
+        spots = slm.ringlattice_spots((16., 16.), 8., 8)
+        with self.assertRaises(ValueError):
+            wrapper.run_spots((32, 16), spots, np.ones((32, 16)),
+                    np.zeros((32, 16)), 5)
+
+class TestJob(unittest.TestCase):
+
+    def setUp(self):
+        self.jobdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.jobdir)
+
+    def write(self, name, a):
+        # Raw column-major data, as written by bowman2017.m
+        a = np.asarray(a)
+        a.T.tofile(os.path.join(self.jobdir, name + '.bin'))
+        return {'file': name + '.bin', 'dtype': a.dtype.str,
+                'shape': list(a.shape)}
+
+    def test_round_trip(self):
+        sz, target, incident, roisize, guess = ring_problem()
+        header = {'sz': list(sz), 'roisize': roisize, 'steepness': 9.0,
+                'iterations': 10, 'engine': 'numpy', 'dtype': 'float64',
+                'telemetry': 'telemetry.jsonl',
+                'arrays': {'target': self.write('target', target),
+                    'incident': self.write('incident', incident),
+                    'guess': self.write('guess', guess)}}
+        with open(os.path.join(self.jobdir, 'job.json'), 'w') as fp:
+            json.dump(header, fp)
+
+        wrapper.run_job(self.jobdir)
+
+        pattern = np.fromfile(os.path.join(self.jobdir, 'pattern.bin'),
+                dtype='<f8').reshape(sz[::-1]).T
+        expected = wrapper.run(sz, target, incident, roisize, 9.0, guess, 10,
+                engine='numpy')
+        np.testing.assert_array_equal(pattern, expected)
+
+        with open(os.path.join(self.jobdir, 'telemetry.jsonl')) as fp:
+            records = [json.loads(line) for line in fp]
+        self.assertGreater(len(records), 0)
+        self.assertLessEqual(len(records), 10)
+
+    def test_read_job_array(self):
+        a = np.arange(12.).reshape((3, 4)) + 1j
+        spec = self.write('a', a)
+        np.testing.assert_array_equal(wrapper.read_job_array(self.jobdir,
+                spec), a)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,337 @@
+# Persistent slm-cg worker process
+#
+# Starting python, importing theano/scipy and starting a MATLAB engine
+# for every hologram takes much longer than short optimisations.  The
+# worker is started once and then accepts jobs over a local socket
+# (or named pipe), keeping the imports, the MATLAB engine, compiled
+# functions and FFT plans alive between jobs.
+#
+# Start the worker with
+#   python wrapper.py --worker [address]
+# and submit a job directory or .mat file written by bowman2017.m with
+#   python worker.py --submit address dataname
+# python wrapper.py --ping address exits with status 0 once the worker
+# is listening.
+#
+# The address is host:port or a path for a unix socket/named pipe,
+# the default is OTSLM_WORKER_ADDRESS or localhost:6017.
+#
+# Jobs are pickled, so connections are authenticated with a key from
+# OTSLM_WORKER_AUTHKEY or a random key which the worker writes to a file
+# only the user can read (see key_file), there is no default key.
+#
+# Copyright 2018 Isaac Lenton
+# This file is part of OTSLM, see LICENSE.md for information about
+# using/distributing this file.
+
+import os
+import sys
+import errno
+import binascii
+import threading
+import traceback
+import profiling
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+from multiprocessing.connection import deliver_challenge, answer_challenge
+
+default_address = 'localhost:6017'
+
+def parse_address(address=None):
+    """ Convert a host:port string to a tuple, other addresses are paths """
+    if address is None:
+        address = os.environ.get('OTSLM_WORKER_ADDRESS', default_address)
+    if isinstance(address, tuple):
+        return address
+
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and os.path.sep not in address:
+        return (host, int(port))
+    return address
+
+def key_file():
+    """ File with the connection key, OTSLM_WORKER_KEYFILE or worker.key
+    in fft2.default_cache_dir() """
+    import fft2
+    return os.environ.get('OTSLM_WORKER_KEYFILE',
+            os.path.join(fft2.default_cache_dir(), 'worker.key'))
+
+def authkey(create=False):
+    """ Shared key for the connection
+
+    The key is OTSLM_WORKER_AUTHKEY if it is set, otherwise the contents
+    of key_file().  With create (used by serve) a random key is written
+    to the file if it does not exist.  The file must only be readable
+    by the user.
+    """
+
+    key = os.environ.get('OTSLM_WORKER_AUTHKEY')
+    if key:
+        return key.encode('ascii')
+
+    path = key_file()
+    if create and not os.path.exists(path):
+        _write_key(path)
+
+    if not os.path.exists(path):
+        raise RuntimeError('No worker key in {0}, start the worker or set '
+                'OTSLM_WORKER_AUTHKEY'.format(path))
+    if os.name == 'posix' and os.stat(path).st_mode & 0o077:
+        raise RuntimeError('Worker key file {0} must only be readable by '
+                'the user (chmod 600)'.format(path))
+
+    with open(path, 'rb') as fp:
+        return fp.read().strip()
+
+def _write_key(path):
+    # Write a random key to a temporary file (mkstemp creates it only
+    # readable by the user) and move it into place, so clients never
+    # read a partial key.  With os.link an existing key (from another
+    # worker starting at the same time) is kept.
+    import tempfile
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory or None)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(binascii.hexlify(os.urandom(32)))
+        if hasattr(os, 'link'):
+            try:
+                os.link(tmp, path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        else:
+            os.rename(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def send_array(conn, a):
+    """ Send the header for and raw bytes of an array """
+    import numpy as np
+    a = np.ascontiguousarray(a)
+    conn.send((a.dtype.str, a.shape))
+    conn.send_bytes(a.data)
+
+def recv_array(conn):
+    """ Receive an array sent with send_array """
+    import numpy as np
+    dtype, shape = conn.recv()
+    return np.frombuffer(conn.recv_bytes(), dtype=dtype).reshape(shape)
+
+class Worker(object):
+    """ Handles jobs for a persistent worker process
+
+    Jobs are dicts with a 'cmd' field:
+      - 'run' -- wrapper.run, followed by the target, incident and guess
+        arrays (send_array).  Other fields are passed to run.
+        The reply is the header {'status': 'ok'} and the pattern array.
+      - 'run_job' -- wrapper.run_job for the directory in 'dataname'
+      - 'run_matfile' -- wrapper.run_matfile for the file in 'dataname'
+      - 'ping' -- check the worker is alive
+      - 'quit' -- stop the worker
+
+    Failed jobs reply {'status': 'error', 'message': ...}.
+    """
+
+    def __init__(self):
+        import wrapper
+        self.wrapper = wrapper
+        self.matlab_engine = None
+        self.running = True
+        self.address = None     # set by serve
+
+    def handle(self, conn):
+        """ Handle one job from the connection """
+
+        job = conn.recv()
+        cmd = job.pop('cmd', None)
+
+        if cmd == 'run':
+            target = recv_array(conn)
+            incident = recv_array(conn)
+            guess = recv_array(conn)
+            pattern = self.wrapper.run(job.pop('sz'), target, incident,
+                    job.pop('roisize'), job.pop('steepness'), guess,
+                    job.pop('nb_iter'), **job)
+            conn.send({'status': 'ok'})
+            send_array(conn, pattern)
+
+        elif cmd == 'run_job':
+            self.wrapper.run_job(job['dataname'])
+            conn.send({'status': 'ok'})
+
+        elif cmd == 'run_matfile':
+            if self.matlab_engine is None:
+                import matlab.engine
+                self.matlab_engine = matlab.engine.start_matlab()
+            self.wrapper.run_matfile(self.matlab_engine, job['dataname'])
+            conn.send({'status': 'ok'})
+
+        elif cmd == 'ping':
+            conn.send({'status': 'ok'})
+
+        elif cmd == 'quit':
+            self.running = False
+            conn.send({'status': 'ok'})
+
+        else:
+            raise ValueError('Unknown worker command: ' + str(cmd))
+
+    def close(self):
+        if self.matlab_engine is not None:
+            self.matlab_engine.quit()
+            self.matlab_engine = None
+
+def _reply_error(conn, e):
+    # Report a failed job to the client, if it is still connected
+    traceback.print_exc()
+    try:
+        conn.send({'status': 'error', 'message': str(e)})
+    except (IOError, OSError, EOFError):
+        pass
+
+def _serve_connection(worker, conn, key, lock):
+    # Authenticate and handle one connection.  Each connection has its
+    # own thread, so a client which never sends only blocks its own
+    # thread.  The jobs themselves are run one at a time.
+    try:
+        deliver_challenge(conn, key)
+        answer_challenge(conn, key)
+    except (AuthenticationError, EOFError, IOError, OSError) as e:
+        # Failed handshake (wrong key, plain socket), keep serving
+        print('slm-cg worker rejected a connection: '
+                '{0}: {1}'.format(type(e).__name__, e))
+        conn.close()
+        return
+
+    try:
+        with lock:
+            if worker.running:
+                try:
+                    worker.handle(conn)
+                finally:
+                    # Summary (and trace) of each job, see OTSLM_PROFILE
+                    profiling.dump()
+    except Exception as e:
+        _reply_error(conn, e)
+    finally:
+        conn.close()
+
+    if not worker.running:
+        # Wake the accept loop of serve
+        try:
+            Client(worker.address).close()
+        except (IOError, OSError, EOFError):
+            pass
+
+def serve(address=None):
+    """ Run a worker at address until it receives a quit job
+
+    Connections are authenticated and handled in their own threads,
+    jobs are run one at a time.
+    """
+
+    address = parse_address(address)
+    worker = Worker()
+    key = authkey(create=True)
+    lock = threading.Lock()
+
+    # The handshake is done by _serve_connection, not by accept
+    listener = Listener(address)
+    worker.address = listener.address
+    print('slm-cg worker listening on ' + str(address))
+
+    try:
+        while worker.running:
+            try:
+                conn = listener.accept()
+            except (IOError, OSError) as e:
+                print('slm-cg worker failed to accept a connection: '
+                        '{0}: {1}'.format(type(e).__name__, e))
+                continue
+
+            if not worker.running:
+                conn.close()
+                break
+
+            thread = threading.Thread(target=_serve_connection,
+                    args=(worker, conn, key, lock))
+            thread.daemon = True
+            thread.start()
+    finally:
+        listener.close()
+        with lock:
+            worker.close()
+
+def _request(address, job, arrays=()):
+    # Send a job and wait for the reply header
+    conn = Client(parse_address(address), authkey=authkey())
+    conn.send(job)
+    for a in arrays:
+        send_array(conn, a)
+
+    reply = conn.recv()
+    if reply.get('status') != 'ok':
+        conn.close()
+        raise RuntimeError('Worker error: ' + str(reply.get('message')))
+
+    return conn, reply
+
+def submit(sz, target, incident, roisize, steepness, guess, nb_iter,
+        address=None, **kwargs):
+    """ Run wrapper.run on a worker, same arguments as wrapper.run """
+
+    job = {'cmd': 'run', 'sz': tuple(sz), 'roisize': roisize,
+            'steepness': steepness, 'nb_iter': nb_iter}
+    job.update(kwargs)
+
+    conn, reply = _request(address, job, [target, incident, guess])
+    try:
+        return recv_array(conn)
+    finally:
+        conn.close()
+
+def submit_job(dataname, address=None):
+    """ Run wrapper.run_job on a worker """
+    conn, reply = _request(address, {'cmd': 'run_job',
+            'dataname': dataname})
+    conn.close()
+
+def submit_matfile(dataname, address=None):
+    """ Run wrapper.run_matfile on a worker """
+    conn, reply = _request(address, {'cmd': 'run_matfile',
+            'dataname': dataname})
+    conn.close()
+
+def ping(address=None):
+    """ Returns True if a worker is listening at address """
+    if not os.environ.get('OTSLM_WORKER_AUTHKEY') \
+            and not os.path.exists(key_file()):
+        # No worker has written its key yet
+        return False
+    try:
+        conn, reply = _request(address, {'cmd': 'ping'})
+    except (IOError, OSError, EOFError):
+        return False
+    conn.close()
+    return True
+
+def shutdown(address=None):
+    """ Ask the worker at address to quit """
+    conn, reply = _request(address, {'cmd': 'quit'})
+    conn.close()
+
+if __name__ == '__main__':
+
+    if len(sys.argv) == 4 and sys.argv[1] == '--submit':
+        if os.path.isdir(sys.argv[3]):
+            submit_job(sys.argv[3], address=sys.argv[2])
+        else:
+            submit_matfile(sys.argv[3], address=sys.argv[2])
+    elif len(sys.argv) in (2, 3) and sys.argv[1] == '--quit':
+        shutdown(sys.argv[2] if len(sys.argv) == 3 else None)
+    else:
+        raise Exception("Usage: worker.py --submit address dataname")
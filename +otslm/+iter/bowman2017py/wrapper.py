@@ -6,17 +6,39 @@
 # This file is part of OTSLM, see LICENSE.md for information about
 # using/distributing this file.
 
+import os
+import json
+import time
 import numpy as np
-import theano
-import theano.tensor as T
 import SLM_1 as slm
-import scipy.optimize
+from collections import OrderedDict
+import fft2
+import profiling
+from engine import NumpyEngine, FusedEvaluator, region_of_interest
+from gs import GerchbergSaxton
+from spots import SpotArray
+from metrics import field_metrics
+from telemetry import as_telemetry
+
+@slm.memoise
+def problem_weighting(NT, roisize):
+    """ Weighting array for a region of interest of diameter roisize
+
+    The result is cached, see SLM_1.memoise.
+    """
 
-def run(sz, target, incident, roisize, steepness, guess, nb_iter):
-    """ Runs slm-cg for the given inputs
+    # From LG file, calculates weighting for circle with Gaussian falloff
+    Weighting = slm.gaussian_top_round(n=NT, r0=(NT/2,NT/2), d=roisize,
+            sigma=2, A=1.0)
+    return slm.weighting_value(M=Weighting, p=1E-4, v=0)
 
-    Ideally this should be called directly from matlab, but we
-    have had some problems so this is called from a python process.
+def prepare_problem(sz, target, incident, roisize, dtype='float64'):
+    """ Pad and normalise the target and incident illumination
+
+    Returns NT, the padded and normalised target, the normalised
+    incident illumination and the weighting array Wcg.  The
+    normalisation is calculated in double precision, the returned
+    arrays are converted to dtype (or its complex counterpart).
     """
 
     # Calculate fft size
@@ -28,12 +50,9 @@ def run(sz, target, incident, roisize, steepness, guess, nb_iter):
     NT = szT[0]
 
     # Pad the target array
-    target = np.pad(target, [(NT/4, NT/4), (NT/4, NT/4)], 'constant')
+    target = np.pad(target, [(NT//4, NT//4), (NT//4, NT//4)], 'constant')
 
-    # From LG file, calculates weighting for circle with Gaussian falloff
-    Weighting = slm.gaussian_top_round(n=NT, r0=(NT/2,NT/2), d=roisize,
-            sigma=2, A=1.0)
-    Wcg = slm.weighting_value(M=Weighting, p=1E-4, v=0)
+    Wcg = problem_weighting(NT, roisize)
 
     #
     # Magic normalisation stuff
@@ -55,69 +74,732 @@ def run(sz, target, incident, roisize, steepness, guess, nb_iter):
     if np.any(np.isnan(target)):
         raise Exception('Encountered nan in normalized target array')
 
-    #
-    # Setup the SLM object
-    #
+    cdtype = np.result_type(dtype, np.complex64)
+    target = target.astype(cdtype)
+    incident = np.asarray(incident).astype(
+            cdtype if np.iscomplexobj(incident) else dtype)
+    Wcg = Wcg.astype(dtype)
 
-    slm_opt = slm.SLM(NT=NT, initial_phi = guess.flatten(),
-            profile_s=incident)
+    return NT, target, incident, Wcg
 
-    #
-    # Generate cost function
-    #
+class TheanoTemplate(object):
+    """ Compiled Theano cost and gradient for one problem shape
 
-    overlap = T.sum(np.abs(target)*slm_opt.E_out_amp*Wcg
-            * T.cos(slm_opt.E_out_p - np.angle(target)))
-    overlap = overlap/(T.pow(T.sum(T.pow(np.abs(target),2))
-            * T.sum(T.pow(slm_opt.E_out_amp*Wcg,2)),0.5))
-    cost_SE = np.power(10,steepness)*T.pow((1 - overlap),2)
+    The symbolic graph and compiled function only depend on NT, the
+    batch size, pruned, dtype, roi and the cost type.  The target,
+    weighting, incident illumination and steepness are shared
+    variables which are swapped for each problem with set_problem.
 
-    #
-    # Generate cost and gradient functions for optimisation
-    #
+    With roi, the output field is gathered at the pixels with non-zero
+    weight (a shared index vector) before the amplitude, phase and
+    overlap sums are calculated.
+
+    Templates hold one problem at a time, evaluators returned by
+    evaluator() use the problem set most recently.
+    """
+
+    def __init__(self, NT, batch=None, pruned=False, dtype='float64',
+            cost='SE', roi=False):
+
+        import theano
+        import theano.tensor as T
+
+        if cost != 'SE':
+            raise ValueError('Unknown cost type: ' + str(cost))
+
+        self.NT = NT
+        self.batch = batch
+        self.dtype = dtype
+        self.roi = roi
+
+        shape = (NT, NT) if batch is None else (batch, NT, NT)
+        axes = (len(shape)-2, len(shape)-1)
+
+        # Problem arrays are flattened to the region of interest
+        weight_shape = (NT, NT)
+        if roi:
+            shape = shape[:-2] + (NT*NT,)
+            axes = (len(shape)-1,)
+            weight_shape = (NT*NT,)
+
+        #
+        # Setup the SLM object
+        #
+
+        n = NT//2
+        self.size = n*n*(1 if batch is None else batch)
+        self.slm = slm.SLM(NT=NT, initial_phi=np.zeros(self.size),
+                profile_s=np.ones(shape[:-len(axes)] + (n, n)),
+                pruned=pruned, batch=batch, dtype=dtype)
+
+        #
+        # Problem specific inputs
+        #
+
+        self.target_amp = theano.shared(np.zeros(shape, dtype=dtype),
+                name='target_amp')
+        self.target_phase = theano.shared(np.zeros(shape, dtype=dtype),
+                name='target_phase')
+        self.Wcg = theano.shared(np.zeros(weight_shape, dtype=dtype),
+                name='Wcg')
+        self.scale = theano.shared(np.float64(1.0), name='scale')
+
+        #
+        # Generate cost function
+        #
+
+        slm_opt = self.slm
+        target_amp = self.target_amp
+        target_phase = self.target_phase
+        Wcg = self.Wcg
+
+        E_out_amp = slm_opt.E_out_amp
+        E_out_p = slm_opt.E_out_p
+        if roi:
+            self.roi_index = theano.shared(np.arange(NT*NT, dtype='int64'),
+                    name='roi_index')
+            flat = shape[:-1] + (NT*NT,)
+            E_out_r = T.take(T.reshape(slm_opt.E_out_r, flat),
+                    self.roi_index, axis=len(flat)-1)
+            E_out_i = T.take(T.reshape(slm_opt.E_out_i, flat),
+                    self.roi_index, axis=len(flat)-1)
+            E_out_amp = T.sqrt(T.pow(E_out_r, 2) + T.pow(E_out_i, 2))
+            E_out_p = T.arctan2(E_out_i, E_out_r)
+
+        # The target intensity includes pixels outside the region
+        self.I_target = theano.shared(np.ones(shape[:-len(axes)]),
+                name='I_target')
+
+        overlap = T.sum(target_amp*E_out_amp*Wcg
+                * T.cos(E_out_p - target_phase), axis=axes,
+                acc_dtype='float64')
+        overlap = overlap/(T.pow(self.I_target
+                * T.sum(T.pow(E_out_amp*Wcg,2), axis=axes,
+                acc_dtype='float64'),0.5))
+        cost_SE = self.scale*T.pow((1 - overlap),2)
+
+        #
+        # Generate cost and gradient functions for optimisation
+        #
+
+        cost = T.sum(cost_SE)
+        cost_grad = T.grad(cost, wrt=slm_opt.phi)
+
+        # The output field is returned for the error metrics
+        self.fused_fn = theano.function([], [cost, cost_grad,
+                slm_opt.E_out_r, slm_opt.E_out_i], on_unused_input='warn')
+
+    def set_problem(self, target, incident, Wcg, steepness):
+        """ Swap the problem specific inputs """
+
+        dtype = self.dtype
+        target = np.asarray(target)
+        Wcg = np.asarray(Wcg)
+        incident = np.asarray(incident)
+
+        # For field_metrics of the full output plane
+        self.metric_inputs = (target, Wcg, np.sum(np.power(np.abs(incident),
+                2), axis=(-2, -1)))
+
+        self.I_target.set_value(np.sum(np.power(np.abs(target), 2),
+                axis=(-2, -1), dtype='float64'))
+
+        if self.roi:
+            index = region_of_interest(Wcg, True)
+            NT2 = self.NT*self.NT
+            target = target.reshape(target.shape[:-2] + (NT2,))[..., index]
+            Wcg = Wcg.reshape(NT2)[index]
+            self.roi_index.set_value(index.astype('int64'))
+
+        self.target_amp.set_value(np.abs(target).astype(dtype))
+        self.target_phase.set_value(np.angle(target).astype(dtype))
+        self.Wcg.set_value(Wcg.astype(dtype))
+        self.scale.set_value(np.float64(np.power(10., steepness)))
+
+        self.slm.S_r.set_value(incident.real.astype(dtype))
+        self.slm.S_i.set_value(incident.imag.astype(dtype))
+
+    def evaluator(self):
+        """ FusedEvaluator of the flat phase vector for the current problem """
+
+        state = {}
+
+        def wrapped_fused_fn(phi):
+            self.slm.phi.set_value(phi[0:self.size].astype(self.dtype,
+                    copy=False), borrow=True)
+            t0 = profiling.start()
+            cost, grad, state['E_out_r'], state['E_out_i'] = self.fused_fn()
+            profiling.stop('TheanoTemplate.fused_fn', t0)
+            return cost, grad.astype('float64')
+
+        def metrics(fields):
+            T, W, I_total = self.metric_inputs
+            return field_metrics(fields[0] + 1j*fields[1], T, W, I_total)
+
+        return FusedEvaluator(wrapped_fused_fn,
+                state=lambda: (state['E_out_r'], state['E_out_i']),
+                metrics=metrics)
+
+# Compiled templates, least recently used first, see get_template
+_templates = OrderedDict()
+template_cache_size = 4
+
+def get_template(NT, batch=None, pruned=False, dtype='float64', cost='SE',
+        roi=False):
+    """ Return a cached TheanoTemplate, compiling it if required
+
+    At most template_cache_size templates are kept, the least recently
+    used template is discarded first.
+    """
+
+    key = (NT, batch, pruned, np.dtype(dtype).name, cost, roi)
+    if key in _templates:
+        template = _templates.pop(key)
+    else:
+        template = TheanoTemplate(NT, batch=batch, pruned=pruned,
+                dtype=dtype, cost=cost, roi=roi)
+
+    _templates[key] = template
+    while len(_templates) > template_cache_size:
+        _templates.popitem(last=False)
+
+    return template
+
+def theano_functions(NT, target, incident, Wcg, steepness, guess,
+        pruned=False, dtype='float64', roi=None):
+    """ Get the compiled Theano cost and gradient function
+
+    Returns a FusedEvaluator for the flat phase vector, the cost and
+    gradient are compiled into one function sharing the forward pass.
+    The compiled function is reused for problems of the same shape,
+    see get_template.
+
+    If target has a leading batch axis, the B problems are evaluated
+    together and the cost is the sum of the individual costs.
 
-    cost = cost_SE
-    cost_fn = theano.function([], cost, on_unused_input='warn')
-    cost_grad = T.grad(cost, wrt=slm_opt.phi)
-    grad_fn = theano.function([], cost_grad, on_unused_input='warn')
+    dtype sets the precision of the SLM fields and FFTs, the overlap
+    sums are accumulated in double precision.
 
-    def wrapped_cost_fn(phi):
-        slm_opt.phi.set_value(phi[0:(NT/2)**2], borrow=True)
-        return cost_fn()
+    roi restricts the overlap to the pixels with non-zero weight, see
+    engine.region_of_interest (None chooses automatically).
+    """
+
+    batch = target.shape[0] if target.ndim == 3 else None
+    assert guess.size == (NT//2)**2 * (1 if batch is None else batch), \
+        'guess is wrong size'
+
+    roi = region_of_interest(Wcg, roi) is not None
+    template = get_template(NT, batch=batch, pruned=pruned, dtype=dtype,
+            roi=roi)
+    template.set_problem(target, incident, Wcg, steepness)
+
+    return template.evaluator()
+
+def numpy_functions(NT, target, incident, Wcg, steepness, pruned=True,
+        dtype='float64', roi=None):
+    """ Construct the NumPy cost and gradient function
+
+    Same as theano_functions but without graph compilation, see
+    engine.NumpyEngine for details.
+    """
+
+    eng = NumpyEngine(NT, target, Wcg, incident, steepness, pruned=pruned,
+            dtype=dtype, roi=roi)
+    return FusedEvaluator(eng.evaluate, state=lambda: eng.E_out,
+            metrics=eng.metrics)
+
+class StopOptimisation(Exception):
+    """ Raised by a Monitor to stop the optimiser """
+    pass
+
+class Monitor(object):
+    """ Tracks the best phase and stopping criteria during an optimisation
+
+    Called with the phase vector after each iteration.  The cost is
+    taken from the FusedEvaluator cache (the optimisers have already
+    evaluated the new point).  The fidelity is the overlap of the
+    cost function, 1 - sqrt(cost/scale), averaged over the batch.
+
+    If telemetry (a telemetry.Telemetry) is given, a record is emitted
+    for each iteration.
+
+    Stopping criteria (None to disable)
+      - time_limit -- wall-clock budget in seconds
+      - cost_tol -- stop once the cost is at most cost_tol
+      - gain_tol -- stop once the fidelity gain over the last patience
+        iterations is less than patience*gain_tol
+    """
 
-    def wrapped_grad_fn(phi):
-        slm_opt.phi.set_value(phi, borrow=True)
-        return grad_fn()
+    def __init__(self, evaluator, scale=1.0, time_limit=None, cost_tol=None,
+            gain_tol=None, patience=10, telemetry=None):
+
+        self.evaluator = evaluator
+        self.telemetry = telemetry
+        if telemetry is not None:
+            telemetry.start(evaluator)
+        self.scale = scale
+        self.time_limit = time_limit
+        self.cost_tol = cost_tol
+        self.gain_tol = gain_tol
+        self.patience = patience
+
+        self.start = time.time()
+        self.best_x = None
+        self.best_cost = np.inf
+        self.fidelity = []
+        self.reason = None
+
+    def fidelity_of(self, cost):
+        """ Overlap corresponding to a cost of scale*(1 - overlap)^2 """
+        return 1.0 - np.sqrt(max(cost, 0.0)/self.scale)
+
+    def update(self, x, cost):
+        """ Record the cost at x, raise StopOptimisation to stop """
+
+        if self.telemetry is not None:
+            self.telemetry.record(x, cost)
+
+        if cost < self.best_cost:
+            self.best_cost = cost
+            self.best_x = np.array(x, copy=True)
+        self.fidelity.append(self.fidelity_of(cost))
+
+        if self.cost_tol is not None and cost <= self.cost_tol:
+            self.reason = 'cost below {0}'.format(self.cost_tol)
+        elif self.time_limit is not None \
+                and time.time() - self.start > self.time_limit:
+            self.reason = 'time limit of {0} s'.format(self.time_limit)
+        elif self.gain_tol is not None and len(self.fidelity) > self.patience:
+            gain = self.fidelity[-1] - self.fidelity[-1-self.patience]
+            if gain < self.patience*self.gain_tol:
+                self.reason = 'fidelity gain below {0} per iteration'.format(
+                        self.gain_tol)
+
+        if self.reason is not None:
+            raise StopOptimisation(self.reason)
+
+    def __call__(self, x):
+        self.update(x, self.evaluator.cost(x))
+
+optimisers = ['cg', 'lbfgs', 'momentum']
+
+def _momentum(evaluator, x0, nb_iter, monitor, learning_rate=0.5,
+        momentum=0.9):
+    # Gradient descent with momentum (the phi_rate update of SLM_1.SLM),
+    # the step is normalised by the rms gradient so learning_rate is
+    # in radians and independent of the cost steepness.  A step which
+    # increases the cost is undone and the learning rate halved, so the
+    # default converges as fast as CG for the wrapper's problems.
+    phi = np.array(x0, dtype='float64', copy=True)
+    phi_rate = np.zeros_like(phi)
+    best = None
+    for i in range(nb_iter):
+        cost, grad = evaluator(phi)
+        monitor.update(phi, cost)
+        if best is not None and cost > best[0]:
+            cost, phi, grad = best
+            phi_rate = np.zeros_like(phi)
+            learning_rate *= 0.5
+        else:
+            best = (cost, phi, grad)
+        rms = np.sqrt(np.mean(grad**2))
+        if rms == 0:
+            break
+        phi_rate = momentum*phi_rate - learning_rate*grad/rms
+        phi = phi + phi_rate
+    monitor(phi)
+    return phi
+
+def minimise(evaluator, x0, nb_iter, method='cg', scale=1.0, time_limit=None,
+        cost_tol=None, gain_tol=None, patience=10, telemetry=None, **kwargs):
+    """ Minimise a FusedEvaluator from x0
+
+    method is one of optimisers
+      - 'cg' -- scipy.optimize.fmin_cg
+      - 'lbfgs' -- L-BFGS-B using scipy.optimize.minimize
+      - 'momentum' -- gradient descent with momentum, kwargs are
+        learning_rate (radians) and momentum
+
+    Runs for at most nb_iter iterations, see Monitor for the other
+    stopping criteria.  Returns the phase vector with the lowest cost
+    seen by the monitor (or the optimiser result if it is lower).
+
+    telemetry is a telemetry.Telemetry, a callback for each record or
+    the name of a JSON lines file, see telemetry.as_telemetry.
+    """
+
+    import scipy.optimize
+
+    telemetry = as_telemetry(telemetry)
+    monitor = Monitor(evaluator, scale=scale, time_limit=time_limit,
+            cost_tol=cost_tol, gain_tol=gain_tol, patience=patience,
+            telemetry=telemetry)
+
+    x = x0
+    try:
+        if method == 'cg':
+            x = scipy.optimize.fmin_cg(
+                    retall=False,
+                    full_output=False,
+                    disp=True,
+                    f=evaluator.cost,
+                    x0=x0,
+                    fprime=evaluator.grad,
+                    maxiter=nb_iter,
+                    callback=monitor)
+        elif method == 'lbfgs':
+            res = scipy.optimize.minimize(evaluator, x0, jac=True,
+                    method='L-BFGS-B', callback=monitor,
+                    options={'maxiter': nb_iter, 'disp': True})
+            x = res.x
+        elif method == 'momentum':
+            x = _momentum(evaluator, x0, nb_iter, monitor, **kwargs)
+        else:
+            raise ValueError('Unknown optimiser: ' + str(method))
+    except StopOptimisation as e:
+        print('Stopped after {0} iterations: {1}'.format(
+                len(monitor.fidelity), e))
+    finally:
+        if telemetry is not None:
+            telemetry.close()
+
+    if monitor.best_x is not None and monitor.best_cost < evaluator.cost(x):
+        x = monitor.best_x
+    return x
+
+def run(sz, target, incident, roisize, steepness, guess, nb_iter,
+        engine='theano', pruned=True, dtype='float64', levels=1,
+        level_iter=None, level_time=None, method='cg', time_limit=None,
+        cost_tol=None, gain_tol=None, patience=10, telemetry=None,
+        gs_iter=0):
+    """ Runs slm-cg for the given inputs
+
+    Ideally this should be called directly from matlab, but we
+    have had some problems so this is called from a python process.
+
+    engine selects how the cost and gradient are evaluated, either
+    'theano' (symbolic gradient) or 'numpy' (closed form adjoint,
+    no graph compilation).
+
+    pruned uses FFTs which skip the zero padding around the SLM
+    (fft2.fft2_padded and fft2.ifft2_cropped).
+
+    dtype is the precision of the fields and FFTs: 'float64' or
+    'float32' (complex64 FFTs, enough for 8-bit SLM phase depth).
+
+    levels > 1 solves a coarse to fine pyramid, see run_pyramid.
+    level_iter and level_time are the iterations and time limit (in
+    seconds) for each level, coarsest first.  For a single level
+    level_time[0] overrides time_limit.
+
+    method selects the optimiser ('cg', 'lbfgs' or 'momentum').  The
+    optimisation stops after nb_iter iterations, after time_limit
+    seconds, when the cost is below cost_tol or when the fidelity
+    gain is less than gain_tol per iteration over the last patience
+    iterations (see Monitor).  The tolerances are off by default, so
+    nb_iter iterations are run.  The best phase found is returned.
+
+    telemetry emits a record for each iteration, see minimise.
+
+    gs_iter Gerchberg-Saxton iterations from guess (see gs_phase) give
+    the starting phase of the optimisation.  With levels > 1 they are
+    run for the coarsest level.
+    """
+
+    options = dict(method=method, time_limit=time_limit, cost_tol=cost_tol,
+            gain_tol=gain_tol, patience=patience,
+            telemetry=as_telemetry(telemetry))
+
+    if levels > 1:
+        return run_pyramid(sz, target, incident, roisize, steepness, guess,
+                nb_iter, levels=levels, level_iter=level_iter,
+                level_time=level_time, engine=engine, pruned=pruned,
+                dtype=dtype, gs_iter=gs_iter, **options)
+
+    if level_iter is not None:
+        nb_iter = level_iter[0]
+    if level_time is not None:
+        options['time_limit'] = level_time[0]
+
+    NT, target, incident, Wcg = prepare_problem(sz, target, incident, roisize,
+            dtype=dtype)
+    fft2.tune_for((NT, NT), np.result_type(dtype, np.complex64))
+
+    if gs_iter > 0:
+        solver = GerchbergSaxton(NT, target, Wcg, incident, pruned=pruned,
+                dtype=dtype)
+        guess = solver.run(np.asarray(guess).flatten(), gs_iter)
+
+    if engine == 'theano':
+        evaluator = theano_functions(NT, target, incident, Wcg,
+                steepness, guess, pruned=pruned, dtype=dtype)
+    elif engine == 'numpy':
+        evaluator = numpy_functions(NT, target, incident, Wcg,
+                steepness, pruned=pruned, dtype=dtype)
+    else:
+        raise ValueError('Unknown engine: ' + str(engine))
 
     #
     # Run the optimisation
     #
 
-    res = scipy.optimize.fmin_cg(
-            retall=False,
-            full_output=False,
-            disp=True,
-            f=wrapped_cost_fn,
-            x0=guess.flatten(),
-            fprime=wrapped_grad_fn,
-            maxiter=nb_iter)
+    res = minimise(evaluator, guess.flatten(), nb_iter,
+            scale=np.power(10., steepness), **options)
 
     return res.reshape(sz)
 
-if __name__ == '__main__':
+def gs_phase(sz, target, incident, roisize, nb_iter, guess=None,
+        weighted=False, mixing=0.3, free_phase=False, pruned=True,
+        dtype='float64'):
+    """ Phase pattern from nb_iter Gerchberg-Saxton iterations
 
-    import matlab
-    import matlab.engine
+    The target is padded and normalised as for run and the iterations
+    start from guess (default: random phases, as SLM_1.SLM).  weighted,
+    mixing and free_phase select the variant, see gs.GerchbergSaxton.
+    Returns the sz phase pattern, which can be used as the guess for run.
+    """
 
-    # Get the data file name
-    import sys
-    if len(sys.argv) == 2:
-        dataname = sys.argv[1]
+    NT, target, incident, Wcg = prepare_problem(sz, target, incident, roisize,
+            dtype=dtype)
+    fft2.tune_for((NT, NT), np.result_type(dtype, np.complex64))
+
+    if guess is None:
+        guess = np.random.uniform(low=0, high=2*np.pi, size=sz)
+
+    solver = GerchbergSaxton(NT, target, Wcg, incident, weighted=weighted,
+            mixing=mixing, free_phase=free_phase, pruned=pruned, dtype=dtype)
+    return solver.run(np.asarray(guess).flatten(), nb_iter).reshape(sz)
+
+def run_spots(sz, spots, incident, guess, nb_iter, amplitudes=None,
+        steepness=9.0, method='wgs', direct=None, dtype='float64',
+        wgs_iter=0, time_limit=None, cost_tol=None, gain_tol=None,
+        patience=10, telemetry=None):
+    """ Phase pattern for an array of spots, see spots.SpotArray
+
+    spots is a K x 2 array of spot positions (x, y) in the sz target
+    image (e.g. SLM_1.ringlattice_spots) and amplitudes their target
+    amplitudes (default: uniform).  Only the field at the spots is
+    evaluated, with a direct DFT for small arrays (direct=None chooses
+    automatically, see spots.direct_max_spots) or the pruned FFTs.
+
+    method is 'wgs' for nb_iter weighted GS iterations, or one of the
+    optimisers of minimise for the spot overlap cost with the given
+    steepness, started from wgs_iter weighted GS iterations.  The
+    stopping criteria and telemetry are the same as for run.  The
+    SLM (sz) must be square.
+    """
+
+    if sz[0] != sz[1]:
+        raise ValueError('run_spots needs a square SLM, got {0} x {1} '
+                'pixels'.format(sz[0], sz[1]))
+
+    problem = SpotArray(sz[0], spots, incident, amplitudes=amplitudes,
+            steepness=steepness, direct=direct, dtype=dtype)
+    if not problem.direct:
+        fft2.tune_for((problem.NT, problem.NT),
+                np.result_type(dtype, np.complex64))
+
+    phi = np.asarray(guess).flatten()
+    if method == 'wgs':
+        return problem.wgs(phi, nb_iter).reshape(sz)
+
+    phi = problem.wgs(phi, wgs_iter)
+    evaluator = FusedEvaluator(problem.evaluate,
+            state=lambda: problem.E_out, metrics=problem.metrics)
+    res = minimise(evaluator, phi, nb_iter, method=method,
+            scale=np.power(10., steepness), time_limit=time_limit,
+            cost_tol=cost_tol, gain_tol=gain_tol, patience=patience,
+            telemetry=telemetry)
+
+    return res.reshape(sz)
+
+def block_mean(a, f):
+    """ Mean of f x f blocks over the last two axes of a """
+    a = np.asarray(a)
+    n0, n1 = a.shape[-2:]
+    a = a.reshape(a.shape[:-2] + (n0//f, f, n1//f, f))
+    return a.mean(axis=(-3, -1))
+
+def upsample_phase(phi, f):
+    """ Upsample an unwrapped phase pattern by the integer factor f
+
+    The phase is linearly interpolated (and extrapolated at the edges)
+    between the pixel centres and multiplied by f, so the local phase
+    gradient in radians per pixel, and hence the position of each part
+    of the pattern relative to the output plane, is unchanged.  This is
+    the inverse of downsample_phase.
+    """
+
+    def interp(a, axis):
+        n = a.shape[axis]
+        pos = (np.arange(n*f) + 0.5)/f - 0.5
+        i0 = np.clip(np.floor(pos).astype(int), 0, max(n-2, 0))
+        i1 = np.minimum(i0 + 1, n-1)
+        t = pos - i0
+        shape = [1]*a.ndim
+        shape[axis] = n*f
+        t = t.reshape(shape)
+        return (1 - t)*np.take(a, i0, axis=axis) + t*np.take(a, i1, axis=axis)
+
+    phi = np.asarray(phi, dtype='float64')
+    return f*interp(interp(phi, phi.ndim-2), phi.ndim-1)
+
+def downsample_phase(phi, f):
+    """ Downsample an unwrapped phase pattern, see upsample_phase """
+    return block_mean(phi, f)/f
+
+def run_pyramid(sz, target, incident, roisize, steepness, guess, nb_iter,
+        levels=3, level_iter=None, level_time=None, **kwargs):
+    """ Runs slm-cg from coarse to fine resolution
+
+    Level l (l = levels-1 down to 0) solves the problem with the target,
+    incident illumination and guess downsampled by 2^l (and the
+    gaussian_top_round weighting diameter roisize/2^l).  The solution
+    of each level is upsampled with upsample_phase as the guess for
+    the next level, so most of the iterations finding the coarse phase
+    structure use small FFTs.
+
+    level_iter and level_time are lists of the iterations and time
+    limit (seconds, None for no limit) for each level, coarsest first.
+    The default is nb_iter iterations for every level and time_limit
+    (if given) for every level.  The number of
+    levels is reduced if sz is not divisible by 2^(levels-1).  gs_iter
+    Gerchberg-Saxton iterations are only used for the coarsest level.
+    Other keyword arguments are passed to run.
+    """
+
+    sz = tuple(sz)
+    while levels > 1 and any(s % 2**(levels-1) for s in sz):
+        levels -= 1
+
+    if level_iter is None:
+        level_iter = [nb_iter]*levels
+    if level_time is None:
+        level_time = [kwargs.pop('time_limit', None)]*levels
+    assert len(level_iter) >= levels and len(level_time) >= levels, \
+        'level_iter and level_time need an entry for each level'
+    level_iter = list(level_iter)[-levels:]
+    level_time = list(level_time)[-levels:]
+    gs_iter = kwargs.pop('gs_iter', 0)
+
+    target = np.asarray(target)
+    incident = np.asarray(incident)
+    f = 2**(levels-1)
+    phi = downsample_phase(guess, f)
+
+    for i in range(levels):
+        f = 2**(levels-1-i)
+        if i > 0:
+            phi = upsample_phase(phi, 2)
+
+        lsz = (sz[0]//f, sz[1]//f)
+        phi = run(lsz, block_mean(target, f), block_mean(incident, f),
+                roisize/float(f), steepness, phi, level_iter[i],
+                level_iter=[level_iter[i]], level_time=[level_time[i]],
+                gs_iter=gs_iter if i == 0 else 0, **kwargs)
+
+    return phi
+
+def run_batch(sz, targets, incidents, roisize, steepness, guesses, nb_iter,
+        engine='numpy', pruned=True, dtype='float64', **kwargs):
+    """ Runs slm-cg for a stack of B problems of the same size
+
+    targets, incidents and guesses have a leading batch axis (B x sz).
+    incidents may also be a single sz array shared by all problems.
+    The B costs are summed and optimised together, so each iteration
+    uses stacked FFTs over the last two axes instead of B separate
+    transforms.  Returns the B x sz stack of phase patterns.
+
+    Other keyword arguments (method, tolerances) are passed to minimise.
+    """
+
+    targets = np.asarray(targets)
+    guesses = np.asarray(guesses)
+    B = targets.shape[0]
+
+    incidents = np.asarray(incidents)
+    if incidents.ndim == 2:
+        incidents = np.broadcast_to(incidents, (B,) + incidents.shape)
+
+    problems = [prepare_problem(sz, targets[i], incidents[i], roisize,
+            dtype=dtype) for i in range(B)]
+    NT = problems[0][0]
+    target = np.stack([p[1] for p in problems])
+    incident = np.stack([p[2] for p in problems])
+    Wcg = problems[0][3]
+    fft2.tune_for(target.shape, target.dtype)
+
+    if engine == 'theano':
+        evaluator = theano_functions(NT, target, incident, Wcg,
+                steepness, guesses, pruned=pruned, dtype=dtype)
+    elif engine == 'numpy':
+        evaluator = numpy_functions(NT, target, incident, Wcg,
+                steepness, pruned=pruned, dtype=dtype)
     else:
-        raise Exception("No data filename provided")
+        raise ValueError('Unknown engine: ' + str(engine))
+
+    res = minimise(evaluator, guesses.flatten(), nb_iter,
+            scale=B*np.power(10., steepness), **kwargs)
+
+    return res.reshape((B,) + tuple(sz))
+
+def run_sequence(sz, targets, incident, roisize, steepness, guess, nb_iter,
+        frame_time=None, first_iter=None, first_time=None, **kwargs):
+    """ Runs slm-cg for a sequence of targets, yielding each pattern
+
+    targets is an iterable of sz target arrays, e.g. a generator of
+    SLM_1.target_ringlattice frames with a moving r0.  It is consumed
+    one frame at a time, so frames can be generated (and the patterns
+    displayed) while the sequence runs.  The first frame starts from
+    guess, every later frame is warm started from the previous pattern,
+    so small changes between frames need few iterations.
+
+    nb_iter and frame_time (seconds, None for no limit, time_limit is
+    accepted as an alias) are the budget of each frame.  first_iter and first_time override them for the
+    first frame, which usually needs more iterations.  levels (a
+    resolution pyramid, see run_pyramid) and gs_iter are only used for
+    the first frame.  Other keyword arguments are passed to run, a telemetry
+    stream receives the records of all frames.
+
+    The compiled Theano functions (get_template) and FFT plans are
+    kept between frames, so the frame rate is steady after the first.
+    """
+
+    # time_limit (as for run) is the same as frame_time
+    time_limit = kwargs.pop('time_limit', None)
+    if frame_time is None:
+        frame_time = time_limit
+
+    first = dict(kwargs)
+    for name in ('levels', 'level_iter', 'level_time', 'gs_iter'):
+        kwargs.pop(name, None)
+    kwargs['telemetry'] = first['telemetry'] = as_telemetry(
+            kwargs.get('telemetry'))
+
+    sz = tuple(sz)
+    phi = np.asarray(guess)
+    for i, target in enumerate(targets):
+        if i == 0:
+            phi = run(sz, target, incident, roisize, steepness, phi,
+                    first_iter if first_iter is not None else nb_iter,
+                    time_limit=first_time if first_time is not None
+                    else frame_time, **first)
+        else:
+            phi = run(sz, target, incident, roisize, steepness, phi,
+                    nb_iter, time_limit=frame_time, **kwargs)
+        yield phi
+
+def run_matfile(eng, dataname):
+    """ Run slm-cg for the problem in a .mat file written by bowman2017.m
+
+    bowman2017.m uses .mat files with MATLAB before R2016b, which has
+    no jsonencode for run_job.  eng is a running matlab.engine, the result is stored in the
+    pattern field of the same file.
+    """
+
+    import matlab
 
     # Get the data from the workspace
-    eng = matlab.engine.start_matlab()
     data = eng.load(dataname);
 
     sz = data['target'].size
@@ -140,14 +822,97 @@ if __name__ == '__main__':
     steepness = data['steepness']
     guess = np.array(data['guess']._data).reshape(sz)
     iterations = data['iterations']
+    engine = data.get('engine', 'theano')
+    dtype = data.get('dtype', 'float64')
 
     # Run the method
-    pattern = run(sz, target, incident, roisize, steepness, guess, iterations)
+    pattern = run(sz, target, incident, roisize, steepness, guess, iterations,
+            engine=engine, dtype=dtype, levels=int(data.get('levels', 1)),
+            gs_iter=int(data.get('gs_iter', 0)),
+            gain_tol=data.get('gain_tol'))
 
     # Store the result
     data["pattern"] = matlab.double(pattern.tolist(),
         size=sz, is_complex=False);
     eng.workspace['data'] = data;
     eng.save(dataname, '-struct', 'data', nargout=0);
-    eng.quit();
 
+def read_job_array(jobdir, spec):
+    """ Memory-map an array described by a job header entry
+
+    spec has the file name (relative to jobdir), numpy dtype string and
+    shape.  Files are raw column-major (MATLAB) data, so the array has
+    the same orientation as in MATLAB.
+    """
+    return np.memmap(os.path.join(jobdir, spec['file']), dtype=spec['dtype'],
+            mode='r', shape=tuple(spec['shape']), order='F')
+
+def run_job(jobdir):
+    """ Run slm-cg for a binary job directory written by bowman2017.m
+
+    The directory contains job.json with the parameters (sz, roisize,
+    steepness, iterations, engine, dtype, levels and optionally gs_iter,
+    method, time_limit, gain_tol and telemetry, a JSON lines file name)
+    and the
+    'arrays' target, incident and guess, each a raw binary file read
+    with read_job_array.  The pattern is written as raw column-major
+    float64 data to the 'result' file (default pattern.bin).
+    No MATLAB engine and no list conversion is needed.
+    """
+
+    with open(os.path.join(jobdir, 'job.json')) as fp:
+        header = json.load(fp)
+
+    telemetry = header.get('telemetry')
+    if telemetry is not None:
+        telemetry = os.path.join(jobdir, telemetry)
+
+    arrays = header['arrays']
+    target = read_job_array(jobdir, arrays['target'])
+    incident = read_job_array(jobdir, arrays['incident'])
+    guess = read_job_array(jobdir, arrays['guess'])
+
+    pattern = run(tuple(header['sz']), target, incident, header['roisize'],
+            header['steepness'], guess, int(header['iterations']),
+            engine=header.get('engine', 'theano'),
+            dtype=header.get('dtype', 'float64'),
+            levels=int(header.get('levels', 1)),
+            gs_iter=int(header.get('gs_iter', 0)),
+            method=header.get('method', 'cg'),
+            time_limit=header.get('time_limit'),
+            gain_tol=header.get('gain_tol'),
+            telemetry=telemetry)
+
+    # tofile writes C order, the transpose gives MATLAB's column-major order
+    result = header.get('result', {}).get('file', 'pattern.bin')
+    pattern.astype('<f8').T.tofile(os.path.join(jobdir, result))
+
+if __name__ == '__main__':
+
+    # Get the data file name
+    import sys
+    if len(sys.argv) >= 2 and sys.argv[1] == '--worker':
+        # Persistent worker mode, see worker.py
+        import worker
+        worker.serve(sys.argv[2] if len(sys.argv) == 3 else None)
+        sys.exit(0)
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--ping':
+        # Exit status 0 if a worker is listening, see worker.ping
+        import worker
+        sys.exit(0 if worker.ping(sys.argv[2] if len(sys.argv) == 3
+                else None) else 1)
+    elif len(sys.argv) == 2:
+        dataname = sys.argv[1]
+    else:
+        raise Exception("No data filename provided")
+
+    if os.path.isdir(dataname):
+        # Binary job, see run_job
+        run_job(dataname)
+        sys.exit(0)
+
+    import matlab.engine
+
+    eng = matlab.engine.start_matlab()
+    run_matfile(eng, dataname)
+    eng.quit();
@@ -14,3 +14,124 @@ function testSimple(tests)
     'incident', incident, 'iterations', 2);
 
 end
+
+function testNumpyEngine(testCase)
+
+  addpath('../../');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 5, 'engine', 'numpy');
+  testCase.verifySize(pattern, sz);
+
+end
+
+function testSinglePrecision(testCase)
+
+  addpath('../../');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 5, 'engine', 'numpy', 'precision', 'single');
+  testCase.verifySize(pattern, sz);
+
+end
+
+function testWorker(testCase)
+
+  addpath('../../');
+
+  pypath = fullfile(fileparts(which('otslm.iter.bowman2017')), 'bowman2017py');
+  wrapper = fullfile(pypath, 'wrapper.py');
+
+  % Port from OTSLM_TEST_WORKER_PORT or a free port
+  port = getenv('OTSLM_TEST_WORKER_PORT');
+  if isempty(port)
+    probe = java.net.ServerSocket(0);
+    port = num2str(probe.getLocalPort());
+    probe.close();
+  end
+  address = ['localhost:', port];
+
+  % The worker and the client share a key file only used by this test
+  keyfile = [tempname, '.key'];
+  oldkeyfile = getenv('OTSLM_WORKER_KEYFILE');
+  setenv('OTSLM_WORKER_KEYFILE', keyfile);
+  testCase.addTeardown(@() setenv('OTSLM_WORKER_KEYFILE', oldkeyfile));
+  testCase.addTeardown(@() delete(keyfile));
+
+  % Start the worker in the background (works on all platforms)
+  builder = java.lang.ProcessBuilder({'python', wrapper, '--worker', address});
+  builder.environment().put('OTSLM_WORKER_KEYFILE', keyfile);
+  builder.redirectErrorStream(true);
+  logfile = [tempname, '.log'];
+  builder.redirectOutput(java.io.File(logfile));
+  testCase.addTeardown(@() delete(logfile));
+  proc = builder.start();
+  testCase.addTeardown(@() proc.destroy());
+  testCase.addTeardown(@() system(['python ', ...
+      fullfile(pypath, 'worker.py'), ' --quit ', address]));
+
+  % Wait until the worker answers a ping
+  started = tic;
+  status = 1;
+  while status ~= 0 && toc(started) < 120
+    status = system(['python ', wrapper, ' --ping ', address]);
+    if status ~= 0
+      testCase.assertTrue(proc.isAlive(), 'worker exited during start up');
+      pause(0.5);
+    end
+  end
+  testCase.assertEqual(status, 0, 'worker did not start within 120 s');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 5, 'engine', 'numpy', 'worker', address);
+  testCase.verifySize(pattern, sz);
+
+end
+
+function testLevels(testCase)
+
+  addpath('../../');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 5, 'engine', 'numpy', 'levels', 2);
+  testCase.verifySize(pattern, sz);
+
+end
+
+function testGainTolerance(testCase)
+
+  addpath('../../');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 50, 'engine', 'numpy', 'gain_tolerance', 1e-3);
+  testCase.verifySize(pattern, sz);
+
+end
+
+function testGsIterations(testCase)
+
+  addpath('../../');
+
+  sz = [128, 128];
+  target = otslm.simple.aperture(sz, sz(1)/4);
+
+  pattern = otslm.iter.bowman2017(target, ...
+    'iterations', 5, 'engine', 'numpy', 'gs_iterations', 5);
+  testCase.verifySize(pattern, sz);
+
+end